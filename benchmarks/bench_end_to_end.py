@@ -0,0 +1,145 @@
+"""End-to-end benchmark: station sync, device sync and fetch_historical_data against the offline mock gateway and fake PostgREST.
+
+Reports wall time, rows/sec, API calls per device-day and peak memory per phase as JSON. Threshold
+options turn it into a CI regression check (exit status 1 when a threshold is missed). Both servers
+run in this process, so absolute rows/sec understate a real deployment; compare runs with each other.
+
+Usage: python benchmarks/bench_end_to_end.py [--days 7] [--stations 20] [--inverters-per-station 10] [--concurrency 4]
+                                            [--error-rate 0.01] [--trace-memory] [--max-calls-per-device-day 0.2] ...
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gateway import add_gateway_arguments, gateway_from_args
+from fake_postgrest import FakePostgrest, FAKE_ANON_KEY
+
+HISTORICAL_TABLE = "isolarcloud_historical_data"
+
+
+def _configure_environment(gateway_url, postgrest_url, state_dir, calls_per_hour):
+    """Points the harvester at the local servers; must run before isolarcloud_harvester_src is imported."""
+    os.environ.update({
+        "ISOLARCLOUD_BASE_URL": gateway_url,
+        "ISOLARCLOUD_APP_KEY": "bench-app-key",
+        "ISOLARCLOUD_SECRET_KEY": "bench-secret",
+        "ISOLARCLOUD_USERNAME": "bench",
+        "ISOLARCLOUD_PASSWORD": "bench",
+        "SUPABASE_URL": postgrest_url,
+        "SUPABASE_ANON_KEY": FAKE_ANON_KEY,
+        "HARVESTER_STATE_DIR": state_dir,
+        "ISOLARCLOUD_CALLS_PER_HOUR_LIMIT": str(calls_per_hour),
+    })
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KiB on Linux
+
+
+def _run_phase(name, gateway, sink, trace_memory, func, *args):
+    calls_before = sum(gateway.stats["calls"].values())
+    minute_calls_before = gateway.stats["calls"].get("/openapi/getDevicePointMinuteDataList", 0)
+    rows_before = len(sink.rows(HISTORICAL_TABLE))
+    if trace_memory:
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started
+    result = {
+        "phase": name,
+        "seconds": round(elapsed, 3),
+        "api_calls": sum(gateway.stats["calls"].values()) - calls_before,
+        "minute_data_calls": gateway.stats["calls"].get("/openapi/getDevicePointMinuteDataList", 0) - minute_calls_before,
+        "historical_rows_stored": len(sink.rows(HISTORICAL_TABLE)) - rows_before,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+    if trace_memory:
+        result["peak_python_heap_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_gateway_arguments(parser)
+    parser.add_argument("--days", type=int, default=2, help="Days of history to fetch.")
+    parser.add_argument("--start-date", default=(datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d"))
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--calls-per-hour", type=int, default=10 ** 9, help="Harvester rate-limit budget (default: effectively unlimited).")
+    parser.add_argument("--write-latency-ms", type=float, default=0.0, help="Latency the fake PostgREST adds to every upsert.")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report the peak Python heap per phase (slows the run).")
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    parser.add_argument("--max-calls-per-device-day", type=float, help="Fail if the fetch needs more minute-data calls per device-day.")
+    parser.add_argument("--min-rows-per-second", type=float, help="Fail if the fetch stores fewer rows per second.")
+    parser.add_argument("--max-peak-rss-mb", type=float, help="Fail if the process peak RSS exceeds this.")
+    parser.add_argument("--verbose", action="store_true", help="Show the harvester's own INFO logs.")
+    args = parser.parse_args()
+
+    gateway = gateway_from_args(args)
+    sink = FakePostgrest(args.write_latency_ms)
+    state_dir = tempfile.mkdtemp(prefix="harvester-bench-")
+    _configure_environment(gateway.start(), sink.start(), state_dir, args.calls_per_hour)
+
+    from isolarcloud_harvester_src.db_operations import init_supabase_client, sync_power_stations, sync_all_devices, get_power_station_ids
+    from isolarcloud_harvester_src.api_client import login_isolarcloud
+    from isolarcloud_harvester_src.data_processing import fetch_historical_data
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.trace_memory:
+        tracemalloc.start()
+
+    client = init_supabase_client()
+    if not client or not login_isolarcloud():
+        sys.exit("Could not connect the harvester to the local mock servers.")
+
+    end_date = (datetime.strptime(args.start_date, "%Y-%m-%d") + timedelta(days=args.days - 1)).strftime("%Y-%m-%d")
+    phases = [
+        _run_phase("sync_power_stations", gateway, sink, args.trace_memory, sync_power_stations),
+        _run_phase("sync_all_devices", gateway, sink, args.trace_memory,
+                   lambda: sync_all_devices(get_power_station_ids(), args.concurrency)),
+        _run_phase("fetch_historical_data", gateway, sink, args.trace_memory,
+                   fetch_historical_data, client, args.start_date, end_date, None, None, args.concurrency),
+    ]
+    fetch = phases[-1]
+    device_days = gateway.device_count * args.days
+    fetch["rows_per_second"] = round(fetch["historical_rows_stored"] / fetch["seconds"], 1) if fetch["seconds"] else None
+    fetch["calls_per_device_day"] = round(fetch["minute_data_calls"] / device_days, 4) if device_days else None
+
+    report = {
+        "fleet": {"stations": len(gateway.stations), "devices": gateway.device_count, "days": args.days},
+        "settings": {"concurrency": args.concurrency, "latency_ms": args.latency_ms, "error_rate": args.error_rate,
+                     "rate_limit_per_minute": args.rate_limit_per_minute, "token_ttl_seconds": args.token_ttl_seconds},
+        "phases": phases,
+        "gateway": gateway.stats,
+        "sink": sink.stats,
+    }
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json)
+
+    failures = []
+    if args.max_calls_per_device_day is not None and fetch["calls_per_device_day"] > args.max_calls_per_device_day:
+        failures.append(f"calls per device-day {fetch['calls_per_device_day']} > {args.max_calls_per_device_day}")
+    if args.min_rows_per_second is not None and (fetch["rows_per_second"] or 0) < args.min_rows_per_second:
+        failures.append(f"rows/sec {fetch['rows_per_second']} < {args.min_rows_per_second}")
+    if args.max_peak_rss_mb is not None and fetch["peak_rss_mb"] > args.max_peak_rss_mb:
+        failures.append(f"peak RSS {fetch['peak_rss_mb']} MB > {args.max_peak_rss_mb} MB")
+    gateway.stop()
+    sink.stop()
+    if failures:
+        print("Benchmark thresholds missed: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Load benchmark and correctness check for the direct Postgres COPY sink (storage.PostgresStorage).
+
+Creates a scratch table shaped like isolarcloud_historical_data in the given database, loads synthetic
+rows through HistoricalDataWriter, re-writes part of them to exercise the ON CONFLICT merge, and checks
+the stored row count and merged values. Run it against a local Postgres, never a production database.
+
+Usage: python benchmarks/bench_postgres_sink.py --dsn postgresql://postgres@localhost/postgres [--devices 200] [--points 43] [--days 2]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from isolarcloud_harvester_src.storage import PostgresStorage
+from isolarcloud_harvester_src.db_operations import HistoricalDataWriter
+
+
+def make_rows(devices, points, days, value=None):
+    """Synthetic 5-minute rows as transform.rows_from_result_data produces them."""
+    start = datetime(2024, 6, 1)
+    rows = []
+    for slot in range(days * 288):
+        timestamp = (start + timedelta(minutes=5 * slot)).isoformat()
+        for device in range(devices):
+            row = {"device_ps_key": f"1000_1_{device}_1", "timestamp": timestamp}
+            for point in range(1, points + 1):
+                row[f"p{point}"] = value if value is not None else random.uniform(0, 5000)
+            rows.append(row)
+    return rows
+
+
+def load(storage, rows):
+    writer = HistoricalDataWriter(storage).start()
+    started = time.perf_counter()
+    for i in range(0, len(rows), 5000):
+        writer.enqueue(rows[i:i + 5000])
+    writer.close()
+    elapsed = time.perf_counter() - started
+    return {"rows": len(rows), "rows_written": writer.rows_written, "rows_failed": writer.rows_failed,
+            "seconds": round(elapsed, 3), "rows_per_second": round(writer.rows_written / elapsed, 1) if elapsed else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dsn", default=os.getenv("HARVESTER_POSTGRES_DSN"), help="Connection string (default: HARVESTER_POSTGRES_DSN).")
+    parser.add_argument("--table", default="bench_historical_data", help="Scratch table to (re)create.")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--points", type=int, default=43)
+    parser.add_argument("--days", type=int, default=2)
+    args = parser.parse_args()
+    if not args.dsn:
+        sys.exit("Pass --dsn or set HARVESTER_POSTGRES_DSN.")
+
+    storage = PostgresStorage(args.dsn, table_name=args.table)
+    point_columns = ", ".join(f"p{point} double precision" for point in range(1, args.points + 1))
+    with storage.pool.connection() as conn:
+        conn.execute(f'DROP TABLE IF EXISTS "{args.table}"')
+        conn.execute(f'CREATE TABLE "{args.table}" (device_ps_key text NOT NULL, "timestamp" timestamp NOT NULL, {point_columns}, '
+                     f'PRIMARY KEY (device_ps_key, "timestamp"))')
+
+    rows = make_rows(args.devices, args.points, args.days)
+    insert = load(storage, rows)
+    # Re-write the first day with a marker value; the merge must update those rows in place
+    updated_rows = make_rows(args.devices, args.points, 1, value=-1.0)
+    update = load(storage, updated_rows)
+
+    with storage.pool.connection() as conn:
+        stored = conn.execute(f'SELECT COUNT(*) FROM "{args.table}"').fetchone()[0]
+        marked = conn.execute(f'SELECT COUNT(*) FROM "{args.table}" WHERE p1 = -1').fetchone()[0]
+    coverage = storage.fetch_coverage(["1000_1_0_1"], datetime(2024, 6, 1), datetime(2024, 6, 1, 23, 59, 59))
+    storage.close()
+
+    report = {"insert": insert, "update": update, "stored_rows": stored, "updated_rows": marked,
+              "coverage_slots_day1_device0": len(coverage["1000_1_0_1"])}
+    print(json.dumps(report, indent=2))
+    problems = []
+    if stored != len(rows):
+        problems.append(f"stored {stored} rows, expected {len(rows)}")
+    if marked != len(updated_rows):
+        problems.append(f"{marked} rows carry the updated value, expected {len(updated_rows)}")
+    if report["coverage_slots_day1_device0"] != 288:
+        problems.append("fetch_coverage did not return the 288 slots of day one")
+    if problems:
+        sys.exit("Postgres sink check failed: " + "; ".join(problems))
+
+
+if __name__ == "__main__":
+    main()
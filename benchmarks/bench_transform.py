@@ -0,0 +1,91 @@
+"""Microbenchmark: per-record minute-data parsing loop vs. the columnar transform in transform.py.
+
+Usage: python benchmarks/bench_transform.py [--devices 50] [--points 43] [--slots 288] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from isolarcloud_harvester_src.transform import rows_from_result_data, columnar_from_result_data
+
+
+def legacy_rows_from_result_data(result_data):
+    """The per-record loop fetch_and_store_minute_data used before the columnar transform."""
+    rows = []
+    for device_api_ps_key, point_data_records in result_data.items():
+        if not isinstance(point_data_records, list):
+            continue
+        for point_data_item in point_data_records:
+            timestamp_api_str = point_data_item.get("time_stamp")
+            if not timestamp_api_str or not device_api_ps_key:
+                continue
+            try:
+                naive_dt = datetime.strptime(timestamp_api_str, '%Y%m%d%H%M%S')
+                converted_utc_timestamp = naive_dt.isoformat()
+            except ValueError:
+                continue
+            row_data = {
+                "device_ps_key": device_api_ps_key,
+                "timestamp": converted_utc_timestamp,
+            }
+            for key, value in point_data_item.items():
+                if key.lower() != "time_stamp":
+                    row_data[key] = value
+            rows.append(row_data)
+    return rows
+
+
+def make_result_data(devices, points, slots, missing_ratio=0.1):
+    """Builds a synthetic result_data payload shaped like getDevicePointMinuteDataList output."""
+    start = datetime(2024, 6, 1)
+    point_names = [f"p{i}" for i in range(1, points + 1)]
+    timestamps = [(start + timedelta(minutes=5 * slot)).strftime('%Y%m%d%H%M%S') for slot in range(slots)]
+    result_data = {}
+    for device in range(devices):
+        records = []
+        for timestamp in timestamps:
+            record = {"time_stamp": timestamp}
+            for point_name in point_names:
+                record[point_name] = "" if random.random() < missing_ratio else f"{random.uniform(0, 5000):.3f}"
+            records.append(record)
+        result_data[f"1000_1_{device}_1"] = records
+    return result_data
+
+
+def bench(label, func, result_data, repeat):
+    timings = []
+    output = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = func(result_data)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    records = len(output.device_ps_keys) if hasattr(output, "device_ps_keys") else len(output)
+    print(f"{label:<16} best {best * 1000:8.1f} ms  ({records / best:12,.0f} records/s, {records} records)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--points", type=int, default=43)
+    parser.add_argument("--slots", type=int, default=288)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    result_data = make_result_data(args.devices, args.points, args.slots)
+    print(f"Payload: {args.devices} ps_keys x {args.slots} slots x {args.points} points")
+    legacy = bench("legacy", legacy_rows_from_result_data, result_data, args.repeat)
+    rows = bench("columnar->rows", rows_from_result_data, result_data, args.repeat)
+    arrays = bench("columnar arrays", columnar_from_result_data, result_data, args.repeat)
+    print(f"Speed-up: upsert rows {legacy / rows:.2f}x, float arrays {legacy / arrays:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""In-memory stand-in for Supabase's PostgREST endpoint, so the real supabase client can be benchmarked offline.
+
+Supports what the harvester uses: upserts (POST with on_conflict and merge-duplicates), selects with
+eq/in/like/gte/lte/gt/lt filters, order and offset/limit paging, and the isolarcloud_historical_coverage
+function (POST /rest/v1/rpc/...). GET /__stats returns request counters.
+
+Usage: python benchmarks/fake_postgrest.py [--port 8081]
+Then set SUPABASE_URL=http://127.0.0.1:8081 and any JWT-shaped SUPABASE_ANON_KEY (e.g. "bench.bench.bench").
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+FAKE_ANON_KEY = "bench.bench.bench" # Shaped like a JWT, which is all supabase.create_client checks
+
+
+def _parse_in_list(value):
+    """Parses a PostgREST in-list body such as ("a","b",c) into ["a", "b", "c"]."""
+    items = []
+    for item in value.strip("()").split(","):
+        item = item.strip()
+        if len(item) >= 2 and item[0] == item[-1] == '"':
+            item = item[1:-1]
+        if item:
+            items.append(item)
+    return items
+
+
+def _like_pattern(value):
+    """Compiles a PostgREST like pattern (% or * for any run, _ for one character) into a regex."""
+    return re.compile("".join(".*" if char in "%*" else "." if char == "_" else re.escape(char) for char in value) + r"\Z", re.S)
+
+
+def _comparable(value):
+    return "" if value is None else str(value)
+
+
+class FakePostgrest:
+    """Tables are dicts of rows keyed by their on_conflict columns (or insertion order without one)."""
+
+    def __init__(self, write_latency_ms=0.0):
+        self.write_latency_ms = write_latency_ms
+        self.tables = {}
+        self._lock = threading.Lock()
+        self.stats = {"selects": 0, "upserts": 0, "rpcs": 0, "rows_upserted": {}, "rows_selected": 0, "request_bytes": 0}
+        self._server = None
+
+    def rows(self, table):
+        with self._lock:
+            return list(self.tables.get(table, {}).values())
+
+    def upsert(self, table, rows, on_conflict):
+        key_columns = [column.strip() for column in on_conflict.split(",")] if on_conflict else []
+        if self.write_latency_ms:
+            time.sleep(self.write_latency_ms / 1000)
+        with self._lock:
+            stored = self.tables.setdefault(table, {})
+            for row in rows:
+                key = tuple(_comparable(row.get(column)) for column in key_columns) if key_columns else len(stored)
+                if key in stored:
+                    stored[key].update(row)
+                else:
+                    stored[key] = dict(row)
+            self.stats["upserts"] += 1
+            self.stats["rows_upserted"][table] = self.stats["rows_upserted"].get(table, 0) + len(rows)
+
+    def select(self, table, params):
+        with self._lock:
+            rows = list(self.tables.get(table, {}).values())
+        rows = self._query(rows, params)
+        with self._lock:
+            self.stats["selects"] += 1
+            self.stats["rows_selected"] += len(rows)
+        return rows
+
+    def rpc(self, function, arguments, params):
+        """Runs isolarcloud_historical_coverage (see storage.SupabaseStorage); returns None for unknown functions."""
+        if function != "isolarcloud_historical_coverage":
+            return None
+        step = timedelta(minutes=int(arguments["step_minutes"]))
+        wanted = set(arguments["ps_keys"])
+        start, end = datetime.fromisoformat(arguments["start_ts"]), datetime.fromisoformat(arguments["end_ts"])
+        slots = {}
+        for row in self.rows("isolarcloud_historical_data"):
+            timestamp = datetime.fromisoformat(str(row["timestamp"]))
+            if row["device_ps_key"] in wanted and start <= timestamp <= end:
+                slots.setdefault(row["device_ps_key"], []).append(timestamp)
+        ranges = []
+        for ps_key, timestamps in slots.items():
+            timestamps.sort()
+            range_start = previous = timestamps[0]
+            for timestamp in timestamps[1:] + [None]:
+                if timestamp is None or timestamp - previous != step:
+                    ranges.append({"device_ps_key": ps_key, "range_start": range_start.isoformat(), "range_end": previous.isoformat()})
+                    range_start = timestamp
+                previous = timestamp
+        with self._lock:
+            self.stats["rpcs"] += 1
+        return self._query(ranges, params)
+
+    def _query(self, rows, params):
+        columns, filters, order, offset, limit = None, [], [], 0, None
+        for name, value in params:
+            if name == "select":
+                columns = None if value.strip() == "*" else [column.strip() for column in value.split(",")]
+            elif name == "order":
+                for term in value.split(","):
+                    column, _, direction = term.strip().partition(".")
+                    order.append((column, direction.startswith("desc")))
+            elif name == "offset":
+                offset = int(value)
+            elif name == "limit":
+                limit = int(value)
+            else:
+                operator, _, operand = value.partition(".")
+                filters.append((name, operator, _parse_in_list(operand) if operator == "in" else operand))
+
+        for column, operator, operand in filters:
+            if operator == "eq":
+                rows = [row for row in rows if _comparable(row.get(column)) == operand]
+            elif operator == "in":
+                wanted = set(operand)
+                rows = [row for row in rows if _comparable(row.get(column)) in wanted]
+            elif operator == "like":
+                pattern = _like_pattern(operand)
+                rows = [row for row in rows if pattern.match(_comparable(row.get(column)))]
+            elif operator in ("gte", "lte", "gt", "lt"):
+                compare = {"gte": str.__ge__, "lte": str.__le__, "gt": str.__gt__, "lt": str.__lt__}[operator]
+                rows = [row for row in rows if row.get(column) is not None and compare(_comparable(row.get(column)), operand)]
+        for column, descending in reversed(order):
+            rows.sort(key=lambda row: _comparable(row.get(column)), reverse=descending)
+        rows = rows[offset:offset + limit if limit is not None else None]
+        if columns:
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+    def _handler_class(self):
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send(self, status, body):
+                content = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _table(self):
+                path = urlsplit(self.path).path
+                return path[len("/rest/v1/"):] if path.startswith("/rest/v1/") else None
+
+            def do_GET(self):
+                if self.path == "/__stats":
+                    with sink._lock:
+                        self._send(200, json.loads(json.dumps(sink.stats)))
+                    return
+                table = self._table()
+                if table is None:
+                    self._send(404, {"message": "Not found"})
+                    return
+                self._send(200, sink.select(table, parse_qsl(urlsplit(self.path).query, keep_blank_values=True)))
+
+            def do_POST(self):
+                table = self._table()
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with sink._lock:
+                    sink.stats["request_bytes"] += len(body)
+                if table is None:
+                    self._send(404, {"message": "Not found"})
+                    return
+                if table.startswith("rpc/"):
+                    result = sink.rpc(table[len("rpc/"):], json.loads(body or b"{}"), parse_qsl(urlsplit(self.path).query, keep_blank_values=True))
+                    if result is None:
+                        self._send(404, {"code": "PGRST202", "details": None, "hint": None, "message": f"Could not find the function {table}"})
+                    else:
+                        self._send(200, result)
+                    return
+                rows = json.loads(body or b"[]")
+                rows = rows if isinstance(rows, list) else [rows]
+                params = dict(parse_qsl(urlsplit(self.path).query))
+                sink.upsert(table, rows, params.get("on_conflict"))
+                self._send(201, rows if "return=representation" in self.headers.get("Prefer", "") else None)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serves from a background thread and returns the URL to use as SUPABASE_URL."""
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-postgrest", daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--write-latency-ms", type=float, default=0.0, help="Latency added to every upsert.")
+    args = parser.parse_args()
+
+    sink = FakePostgrest(args.write_latency_ms)
+    print(f"Fake PostgREST at {sink.start(args.host, args.port)} (use SUPABASE_ANON_KEY={FAKE_ANON_KEY})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sink.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Offline stand-in for the iSolarCloud OpenAPI gateway, for benchmarks and experiments that must not spend API quota.
+
+Implements /openapi/login, /openapi/getPowerStationList, /openapi/getDeviceList and
+/openapi/getDevicePointMinuteDataList over a synthetic fleet, with configurable latency, 5xx error
+rate, token expiry, oversized-response failures and rate limiting. GET /__stats returns call counters.
+
+Usage: python benchmarks/mock_gateway.py [--port 8080] [--stations 20] [--inverters-per-station 10] [--latency-ms 50] ...
+Then point the harvester at it with ISOLARCLOUD_BASE_URL=http://127.0.0.1:8080.
+"""
+import argparse
+import gzip
+import json
+import math
+import random
+import secrets
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_MAX_PS_KEYS = 50
+API_MAX_POINTS = 50
+
+# (device_type code, type_name) of the synthetic devices generated for each station
+INVERTER = (1, "Inverter")
+METEO_STATION = (5, "Meteo Station")
+METER = (7, "Meter")
+
+
+class MockGateway:
+    """Synthetic iSolarCloud fleet served over HTTP. ``start`` returns the base URL to configure the harvester with."""
+
+    def __init__(self, stations=20, inverters_per_station=10, meters_per_station=1, meteo_stations_per_station=0,
+                 latency_ms=0.0, latency_per_1k_values_ms=0.0, error_rate=0.0, token_ttl_seconds=3600.0,
+                 rate_limit_per_minute=0, rate_limit_result_code=None, max_values_per_response=None, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_per_1k_values_ms = latency_per_1k_values_ms
+        self.error_rate = error_rate
+        self.token_ttl_seconds = token_ttl_seconds
+        self.rate_limit_per_minute = rate_limit_per_minute
+        self.rate_limit_result_code = rate_limit_result_code
+        self.max_values_per_response = max_values_per_response
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._call_times = deque()
+        self.stats = {"calls": {}, "http_500": 0, "http_504": 0, "rate_limited": 0, "token_expired": 0,
+                      "logins": 0, "minute_values_served": 0, "response_bytes": 0}
+
+        self.stations = []
+        self.devices_by_station = {}
+        for station_index in range(stations):
+            ps_id = 5000000 + station_index
+            self.stations.append({
+                "ps_id": ps_id, "ps_name": f"Mock station {station_index}", "install_date": "2021-03-01 00:00:00",
+                "latitude": 22.3 + station_index * 0.01, "longitude": 114.1 + station_index * 0.01,
+                "online_status": 1, "description": None, "valid_flag": 1, "grid_connection_status": 1,
+                "ps_fault_status": 3, "ps_location": "Mock", "update_time": "2024-01-01 00:00:00",
+                "ps_current_time_zone": "GMT+8", "grid_connection_time": "2021-03-01 00:00:00",
+                "connect_type": 1, "build_status": 1, "ps_type": 1,
+            })
+            devices = []
+            for (device_type, type_name), count in ((INVERTER, inverters_per_station), (METER, meters_per_station),
+                                                     (METEO_STATION, meteo_stations_per_station)):
+                for device_index in range(count):
+                    devices.append({
+                        "ps_key": f"{ps_id}_{device_type}_{device_index + 1}_1", "ps_id": ps_id,
+                        "device_type": device_type, "type_name": type_name,
+                        "device_sn": f"SN{ps_id}{device_type}{device_index:03d}", "dev_status": 1,
+                        "factory_name": "Mock", "uuid": ps_id * 1000 + device_type * 100 + device_index,
+                        "grid_connection_date": "2021-03-01", "device_name": f"{type_name} {device_index + 1}",
+                        "dev_fault_status": 4, "rel_state": 1, "device_code": device_index + 1,
+                        "device_model_id": 100 + device_type, "communication_dev_sn": f"COM{ps_id}",
+                        "device_model_code": f"MOCK-{device_type}",
+                    })
+            self.devices_by_station[ps_id] = devices
+        self.device_count = sum(len(devices) for devices in self.devices_by_station.values())
+        self._server = None
+
+    # --- request handling -------------------------------------------------------------------------
+
+    def _count_call(self, endpoint):
+        with self._lock:
+            self.stats["calls"][endpoint] = self.stats["calls"].get(endpoint, 0) + 1
+
+    def _rate_limited(self):
+        if not self.rate_limit_per_minute:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._call_times and now - self._call_times[0] >= 60:
+                self._call_times.popleft()
+            if len(self._call_times) >= self.rate_limit_per_minute:
+                self.stats["rate_limited"] += 1
+                return True
+            self._call_times.append(now)
+            return False
+
+    def _token_valid(self, token):
+        with self._lock:
+            expires_at = self._tokens.get(token)
+            if expires_at is not None and time.monotonic() < expires_at:
+                return True
+            self.stats["token_expired"] += 1
+            return False
+
+    def handle(self, endpoint, payload):
+        """Returns (http_status, response dict or None, extra headers) for one API call."""
+        self._count_call(endpoint)
+        if self._rate_limited():
+            if self.rate_limit_result_code:
+                return 200, {"result_code": self.rate_limit_result_code, "result_msg": "Request too frequent"}, {}
+            return 429, None, {"Retry-After": "1"}
+
+        value_count = 0
+        if endpoint == "/openapi/getDevicePointMinuteDataList":
+            value_count = self._minute_value_count(payload)
+        delay = self.latency_ms + self.latency_per_1k_values_ms * value_count / 1000
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if self.error_rate and self._random.random() < self.error_rate:
+            with self._lock:
+                self.stats["http_500"] += 1
+            return 500, None, {}
+
+        if endpoint == "/openapi/login":
+            return 200, self._login(payload), {}
+        if not self._token_valid(payload.get("token")):
+            return 200, {"result_code": "30001", "result_msg": "Token expired"}, {}
+        if endpoint == "/openapi/getPowerStationList":
+            return 200, self._page(self.stations, payload), {}
+        if endpoint == "/openapi/getDeviceList":
+            devices = self.devices_by_station.get(int(payload.get("ps_id", 0)), [])
+            return 200, self._page(devices, payload), {}
+        if endpoint == "/openapi/getDevicePointMinuteDataList":
+            if self.max_values_per_response and value_count > self.max_values_per_response:
+                with self._lock:
+                    self.stats["http_504"] += 1
+                return 504, None, {} # The real gateway times out on oversized windows
+            return 200, self._minute_data(payload, value_count), {}
+        return 404, None, {}
+
+    def _login(self, payload):
+        if not payload.get("user_account") or not payload.get("user_password"):
+            return {"result_code": "E00001", "result_msg": "Missing credentials"}
+        token = secrets.token_hex(16)
+        with self._lock:
+            self._tokens[token] = time.monotonic() + self.token_ttl_seconds
+            self.stats["logins"] += 1
+        return {"result_code": "1", "result_msg": "success", "result_data": {"token": token, "user_account": payload["user_account"]}}
+
+    @staticmethod
+    def _page(items, payload):
+        page, size = int(payload.get("curPage", 1)), int(payload.get("size", 20))
+        page_items = items[(page - 1) * size:page * size]
+        return {"result_code": "1", "result_msg": "success", "result_data": {"pageList": page_items, "rowCount": len(items)}}
+
+    @staticmethod
+    def _slots(payload):
+        start = datetime.strptime(payload["start_time_stamp"], "%Y%m%d%H%M%S")
+        end = datetime.strptime(payload["end_time_stamp"], "%Y%m%d%H%M%S")
+        step = timedelta(minutes=int(payload.get("minute_interval", 5)))
+        first = start + (datetime.min - start) % step # Slots are aligned to the interval
+        return [first + step * i for i in range(max(0, int((end - first) / step) + 1))]
+
+    def _minute_value_count(self, payload):
+        try:
+            points = [point for point in str(payload.get("points", "")).split(",") if point]
+            return len(payload.get("ps_key_list", [])) * len(points) * len(self._slots(payload))
+        except (KeyError, ValueError):
+            return 0
+
+    def _minute_data(self, payload, value_count):
+        ps_keys = payload.get("ps_key_list", [])
+        points = [point for point in str(payload.get("points", "")).split(",") if point]
+        if not ps_keys or not points or len(ps_keys) > API_MAX_PS_KEYS or len(points) > API_MAX_POINTS:
+            return {"result_code": "E00003", "result_msg": "Parameter error"}
+        slots = self._slots(payload)
+        result_data = {}
+        for ps_key in ps_keys:
+            seed = sum(map(ord, ps_key)) % 97
+            records = []
+            for slot in slots:
+                daylight = max(0.0, math.sin((slot.hour * 60 + slot.minute - 360) / 720 * math.pi))
+                record = {"time_stamp": slot.strftime("%Y%m%d%H%M%S")}
+                for point_index, point in enumerate(points):
+                    record[point] = f"{(seed + point_index) * daylight:.3f}"
+                records.append(record)
+            result_data[ps_key] = records
+        with self._lock:
+            self.stats["minute_values_served"] += value_count
+        return {"req_serial_num": secrets.token_hex(8), "result_code": "1", "result_msg": "success", "result_data": result_data}
+
+    # --- server -----------------------------------------------------------------------------------
+
+    def _handler_class(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real gateway
+
+            def _send(self, status, body, headers):
+                content = json.dumps(body).encode("utf-8") if body is not None else b""
+                if content and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    content = gzip.compress(content, compresslevel=1)
+                    headers = dict(headers, **{"Content-Encoding": "gzip"})
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+                with gateway._lock:
+                    gateway.stats["response_bytes"] += len(content)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    self._send(400, {"result_code": "E00000", "result_msg": "Invalid JSON"}, {})
+                    return
+                status, response, headers = gateway.handle(self.path, payload)
+                self._send(status, response, headers)
+
+            def do_GET(self):
+                if self.path == "/__stats":
+                    with gateway._lock:
+                        self._send(200, json.loads(json.dumps(gateway.stats)), {})
+                else:
+                    self._send(404, None, {})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serves from a background thread and returns the base URL."""
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="mock-gateway", daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def add_gateway_arguments(parser):
+    """Adds the fleet and fault-injection options shared by the mock gateway CLI and the benchmark harness."""
+    parser.add_argument("--stations", type=int, default=20)
+    parser.add_argument("--inverters-per-station", type=int, default=10)
+    parser.add_argument("--meters-per-station", type=int, default=1)
+    parser.add_argument("--meteo-stations-per-station", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Fixed latency added to every call.")
+    parser.add_argument("--latency-per-1k-values-ms", type=float, default=1.0, help="Extra minute-data latency per 1000 values returned.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with HTTP 500.")
+    parser.add_argument("--token-ttl-seconds", type=float, default=3600.0, help="Tokens expire (result code 30001) after this long.")
+    parser.add_argument("--rate-limit-per-minute", type=int, default=0, help="Calls allowed per rolling minute (0 = unlimited).")
+    parser.add_argument("--rate-limit-result-code", type=str, default=None, help="Answer rate-limited calls with this result code instead of HTTP 429.")
+    parser.add_argument("--max-values-per-response", type=int, default=None, help="Minute-data calls returning more values fail with HTTP 504.")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def gateway_from_args(args):
+    return MockGateway(args.stations, args.inverters_per_station, args.meters_per_station, args.meteo_stations_per_station,
+                       args.latency_ms, args.latency_per_1k_values_ms, args.error_rate, args.token_ttl_seconds,
+                       args.rate_limit_per_minute, args.rate_limit_result_code, args.max_values_per_response, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_gateway_arguments(parser)
+    args = parser.parse_args()
+
+    gateway = gateway_from_args(args)
+    base_url = gateway.start(args.host, args.port)
+    print(f"Mock iSolarCloud gateway with {len(gateway.stations)} stations / {gateway.device_count} devices at {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        gateway.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,182 @@
 import logging
 import argparse
-from datetime import datetime, timezone
+import sys
 
-# Imports from the new modules (will be isolarcloud_harvester_src.module_name)
-from isolarcloud_harvester_src.config import ISOLARCLOUD_APP_KEY, ISOLARCLOUD_SECRET_KEY, ISOLARCLOUD_USERNAME, ISOLARCLOUD_PASSWORD
-from isolarcloud_harvester_src.api_client import login_isolarcloud
-from isolarcloud_harvester_src.db_operations import init_supabase_client, sync_power_stations, sync_devices
-from isolarcloud_harvester_src.data_processing import fetch_historical_data, fetch_yesterday_data_for_all_devices
+# Only the lightweight config is imported up front; the API client, supabase, numpy and the processing
+# modules are imported by the actions that need them, so --help and no-op runs start instantly.
+from isolarcloud_harvester_src.config import FETCH_CONCURRENCY, METRICS_REPORT_PATH, DEFAULT_SINK, ROLLUPS
 
 # Logging Configuration - should be configured once
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def main():
-    # Initialize Supabase client first, as other operations might depend on it or config
-    # The client is stored globally in db_operations_module upon initialization.
-    client = init_supabase_client()
-    if not client:
-        logging.error("Exiting script due to Supabase client initialization failure.")
-        return
-
-    # Attempt to log in to iSolarCloud
-    # The token is stored globally in api_client_module.
-    if not login_isolarcloud():
-        logging.error("Exiting script due to iSolarCloud login failure.")
-        return
-
+def build_parser():
     parser = argparse.ArgumentParser(description="iSolarCloud Data Harvester")
     parser.add_argument("--sync-powerstations", action="store_true", help="Synchronize all power stations.")
     parser.add_argument("--sync-devices", type=str, metavar="PS_ID", help="Synchronize devices for a specific power station ID. Use 'all' to sync devices for all known power stations.")
-    
-    parser.add_argument("--fetch-historical", nargs=2, metavar=("YYYY-MM-DD_START", "YYYY-MM-DD_END"), 
+
+    parser.add_argument("--full-sync", action="store_true", help="With --sync-powerstations/--sync-devices, upsert every row even if it is unchanged since the last sync.")
+
+    parser.add_argument("--fetch-historical", nargs=2, metavar=("YYYY-MM-DD_START", "YYYY-MM-DD_END"),
                         help="Fetch historical minute data for a date range.")
     parser.add_argument("--ps-ids", type=str, help="Comma-separated list of power station IDs to filter for --fetch-historical.")
     parser.add_argument("--device-types", type=str, help="Comma-separated list of device type names (e.g., inverter, meter) to filter for --fetch-historical.")
 
     parser.add_argument("--fetch-yesterday", action="store_true", help="Fetch all of yesterday's data for all devices.")
-    
+    parser.add_argument("--concurrency", type=int, metavar="N", default=FETCH_CONCURRENCY,
+                        help=f"Number of parallel API workers for minute-data fetches and --sync-devices all (default: {FETCH_CONCURRENCY}). Use 1 for sequential fetching.")
+    parser.add_argument("--resume", action="store_true", help="Skip work units completed by a previous --fetch-historical/--fetch-yesterday run into the same --sink and retry failed ones. "
+                             "Units still buffered by a killed run (HARVESTER_WRITER_FLUSH_ROWS/_AGE_SECONDS) are fetched again.")
+    parser.add_argument("--incremental", action="store_true", help="Only request intervals missing from the --sink for --fetch-historical/--fetch-yesterday.")
+    parser.add_argument("--sink", type=str, default=DEFAULT_SINK, metavar="SINK",
+                        help=f"Where minute data is stored: 'supabase', 'parquet:/path/to/dir', 'postgres' (direct COPY via HARVESTER_POSTGRES_DSN) "
+                             f"or a 'postgresql://...' connection string (default: {DEFAULT_SINK}).")
+    parser.add_argument("--no-solar-trim", action="store_true",
+                        help="Fetch inverters and meteo stations around the clock instead of only between sunrise and sunset (plus margin).")
+    parser.add_argument("--replay", nargs="*", metavar="YYYY-MM-DD",
+                        help="Rebuild historical data in --sink from the local response archive without API calls, optionally only for START END. Uses --concurrency worker processes.")
+    parser.add_argument("--no-archive", action="store_true", help="Do not archive raw API responses for this run.")
+    parser.add_argument("--rebuild-rollups", nargs=2, metavar=("YYYY-MM-DD_START", "YYYY-MM-DD_END"),
+                        help="Recompute the hourly/daily rollup tables from the historical data in --sink for a date range (use --ps-ids to limit stations).")
+    parser.add_argument("--rollups", action=argparse.BooleanOptionalAction, default=ROLLUPS,
+                        help="Refresh the hourly/daily rollup tables (create them first, see rollups.py) for the minute data written "
+                             "(default: HARVESTER_ROLLUPS, off).")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Run continuously: pull new minute data for every station every few minutes (staggered) and re-sync stations/devices periodically. Stops gracefully on SIGTERM.")
+    parser.add_argument("--check", action="store_true",
+                        help="Check settings, local state, Supabase, the iSolarCloud login and --sink, then exit (status 1 if a check failed).")
+    parser.add_argument("--metrics-report", type=str, metavar="PATH", default=METRICS_REPORT_PATH,
+                        help=f"Write a JSON run report with API, transform and storage metrics here at the end of the run (default: {METRICS_REPORT_PATH}).")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT", help="Serve Prometheus metrics on http://0.0.0.0:PORT/metrics while running (useful with --daemon).")
+    parser.add_argument("--dry-run", action="store_true", help="Plan --fetch-historical/--fetch-yesterday and print the API call count without fetching anything.")
+    return parser
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1.")
+    if args.replay is not None and len(args.replay) not in (0, 2):
+        parser.error("--replay takes either no dates or START END.")
 
-    if not any(vars(args).values()): # Check if any argument was passed
+    if args.check:
+        from isolarcloud_harvester_src.health import run_health_checks
+        return 0 if run_health_checks(args.sink) else 1
+
+    fetches = args.fetch_historical or args.fetch_yesterday
+    if not (args.sync_powerstations or args.sync_devices or fetches or args.daemon
+            or args.replay is not None or args.rebuild_rollups): # Check if any action was passed
         parser.print_help()
         logging.info("No action specified. Exiting.")
-        return
+        return 0
+
+    # Clients are only created for the actions that need them: replays and rollup rebuilds into a
+    # non-Supabase sink never touch Supabase, and neither they nor dry runs log in to iSolarCloud.
+    needs_login = bool(args.sync_powerstations or args.sync_devices or args.daemon or (fetches and not args.dry_run))
+    needs_supabase = bool(args.sync_powerstations or args.sync_devices or fetches or args.daemon
+                          or ((args.replay is not None or args.rebuild_rollups) and args.sink == "supabase")
+                          or (args.rebuild_rollups and not args.ps_ids))
+
+    from isolarcloud_harvester_src.metrics import write_run_report, start_metrics_server
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    client = None
+    if needs_supabase:
+        from isolarcloud_harvester_src.db_operations import init_supabase_client
+        client = init_supabase_client()
+        if not client:
+            logging.error("Exiting script due to Supabase client initialization failure.")
+            return 1
+
+    if needs_login:
+        from isolarcloud_harvester_src.api_client import login_isolarcloud, set_response_archiving
+        if args.no_archive:
+            set_response_archiving(False)
+        if not login_isolarcloud():
+            logging.error("Exiting script due to iSolarCloud login failure.")
+            return 1
 
     if args.sync_powerstations:
+        from isolarcloud_harvester_src.db_operations import sync_power_stations
         logging.info("Action: Synchronizing power stations.")
-        sync_power_stations() # Uses global supabase_client and token
+        sync_power_stations(args.full_sync) # Uses global supabase_client and token
 
     if args.sync_devices:
+        from isolarcloud_harvester_src.db_operations import sync_devices, sync_all_devices, get_power_station_ids
         if args.sync_devices.lower() == 'all':
             logging.info("Action: Synchronizing devices for all power stations.")
-            if not client: 
-                logging.error("Supabase client not available for fetching all power station IDs.")
-                return
             try:
-                response = client.table("isolarcloud_power_stations").select("ps_id").execute()
-                if response.data:
-                    for station in response.data:
-                        sync_devices(station['ps_id']) # Uses global supabase_client and token
-                else:
-                    logging.info("No power stations found in database to sync devices for.")
+                ps_ids = get_power_station_ids()
             except Exception as e:
                 logging.error(f"Error fetching power station IDs from Supabase: {e}")
+                ps_ids = []
+            if ps_ids:
+                sync_all_devices(ps_ids, args.concurrency, args.full_sync)
+            else:
+                logging.info("No power stations found in database to sync devices for.")
         else:
             logging.info(f"Action: Synchronizing devices for power station ID: {args.sync_devices}.")
-            sync_devices(args.sync_devices)
+            sync_devices(args.sync_devices, args.full_sync)
+
+    storage = None
+    if fetches or args.daemon or args.replay is not None or args.rebuild_rollups:
+        from isolarcloud_harvester_src.storage import create_storage_backend
+        try:
+            storage = create_storage_backend(args.sink, client)
+        except (ValueError, RuntimeError) as e:
+            logging.error(f"Invalid --sink: {e}")
+            return 1
+
+    # main() owns the storage backend: the actions below share it and it is closed once at the end
+    try:
+        if args.fetch_historical:
+            from isolarcloud_harvester_src.data_processing import fetch_historical_data
+            start_date, end_date = args.fetch_historical
+            logging.info(f"Action: Fetching historical data from {start_date} to {end_date}.")
+            fetch_historical_data(client, start_date, end_date, ps_ids_str=args.ps_ids, device_types_str=args.device_types, concurrency=args.concurrency,
+                                  dry_run=args.dry_run, resume=args.resume, incremental=args.incremental, storage=storage,
+                                  solar_trim=not args.no_solar_trim, rollups=args.rollups)
+
+        if args.fetch_yesterday:
+            from isolarcloud_harvester_src.data_processing import fetch_yesterday_data_for_all_devices
+            logging.info("Action: Fetching yesterday's data for all devices.")
+            fetch_yesterday_data_for_all_devices(client, concurrency=args.concurrency, dry_run=args.dry_run, resume=args.resume,
+                                                 incremental=args.incremental, storage=storage, solar_trim=not args.no_solar_trim,
+                                                 rollups=args.rollups)
+
+        if args.replay is not None:
+            from isolarcloud_harvester_src.data_processing import replay_historical_data
+            logging.info("Action: Replaying archived responses.")
+            replay_historical_data(storage, *args.replay, concurrency=args.concurrency, rollups=args.rollups)
 
-    if args.fetch_historical:
-        start_date, end_date = args.fetch_historical
-        logging.info(f"Action: Fetching historical data from {start_date} to {end_date}.")
-        fetch_historical_data(client, start_date, end_date, args.ps_ids, args.device_types)
+        if args.rebuild_rollups:
+            from isolarcloud_harvester_src.rollups import rebuild_rollups
+            start_date, end_date = args.rebuild_rollups
+            logging.info(f"Action: Rebuilding rollups from {start_date} to {end_date}.")
+            if args.ps_ids:
+                ps_ids = [pid.strip() for pid in args.ps_ids.split(',') if pid.strip()]
+            else:
+                from isolarcloud_harvester_src.db_operations import get_power_station_ids
+                ps_ids = get_power_station_ids()
+            rebuild_rollups(storage, ps_ids, start_date, end_date)
 
-    if args.fetch_yesterday:
-        logging.info("Action: Fetching yesterday's data for all devices.")
-        fetch_yesterday_data_for_all_devices(client)
+        if args.daemon:
+            from isolarcloud_harvester_src.daemon import HarvesterDaemon
+            logging.info("Action: Running as a daemon.")
+            HarvesterDaemon(client, storage, args.concurrency, solar_trim=not args.no_solar_trim, rollups=args.rollups).run()
+    finally:
+        if storage:
+            storage.close()
 
+    report = {"arguments": vars(args)}
+    if needs_login: # Dry runs never create the API client (or open the response archive) just for the report
+        from isolarcloud_harvester_src.api_client import get_remaining_api_budget, get_api_call_stats
+        logging.info(f"API budget remaining in the current hour: {get_remaining_api_budget()} calls.")
+        logging.info(f"API call stats: {get_api_call_stats()}")
+        report.update(api_call_stats=get_api_call_stats(), api_budget_remaining=get_remaining_api_budget())
+    write_run_report(args.metrics_report, report)
     logging.info("Script finished.")
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import threading
+
+from .config import (MAX_PS_KEYS_PER_REQUEST, MAX_POINTS_PER_REQUEST, MAX_VALUES_PER_MINUTE_DATA_RESPONSE,
+                     ADAPTIVE_BATCHING, ADAPTIVE_BATCH_SIZES_PATH, ADAPTIVE_TARGET_LATENCY_SECONDS,
+                     ADAPTIVE_MAX_RESPONSE_BYTES, ADAPTIVE_MAX_VALUES_CEILING, ADAPTIVE_MIN_VALUES)
+
+# API failures that suggest the batch was too large for the gateway. Connection errors (the gateway is
+# unreachable) say nothing about the batch size, so they neither split calls nor shrink the limits.
+SPLITTABLE_ERROR_KINDS = ("timeout", "http_5xx")
+
+
+class AdaptiveBatchSizer:
+    """Tunes getDevicePointMinuteDataList batch limits per device type from observed latency and errors.
+
+    Per device type it tracks the max ps_keys and points per call and the max values (ps_keys x points x
+    slots) per response, which bounds the time window. Healthy, fast calls grow the limits; timeouts,
+    gateway errors and oversized responses shrink them. Limits are persisted as JSON between runs.
+    """
+
+    def __init__(self, path=ADAPTIVE_BATCH_SIZES_PATH, enabled=ADAPTIVE_BATCHING):
+        self.path = path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._dirty = False
+        if enabled:
+            self._load()
+
+    def _default_limits(self):
+        return {"ps_keys": MAX_PS_KEYS_PER_REQUEST, "points": MAX_POINTS_PER_REQUEST, "max_values": MAX_VALUES_PER_MINUTE_DATA_RESPONSE}
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        for device_type_name, limits in stored.items():
+            merged = self._default_limits()
+            merged.update({key: int(value) for key, value in limits.items() if key in merged})
+            self._limits[device_type_name] = self._clamp(merged)
+        logging.info(f"Loaded tuned batch sizes: {self._limits}")
+
+    def _clamp(self, limits):
+        limits["ps_keys"] = max(1, min(MAX_PS_KEYS_PER_REQUEST, limits["ps_keys"]))
+        limits["points"] = max(1, min(MAX_POINTS_PER_REQUEST, limits["points"]))
+        limits["max_values"] = max(ADAPTIVE_MIN_VALUES, min(ADAPTIVE_MAX_VALUES_CEILING, limits["max_values"]))
+        return limits
+
+    def limits(self, device_type_name):
+        """Returns (max ps_keys, max points, max values per response) to plan calls for a device type."""
+        if not self.enabled:
+            defaults = self._default_limits()
+            return defaults["ps_keys"], defaults["points"], defaults["max_values"]
+        with self._lock:
+            limits = self._limits.setdefault(device_type_name, self._default_limits())
+            return limits["ps_keys"], limits["points"], limits["max_values"]
+
+    def record_success(self, device_type_name, ps_key_count, point_count, value_count, elapsed_seconds, response_bytes):
+        """Grows the limits after a healthy call that used most of them; shrinks max_values after an oversized response."""
+        if not self.enabled:
+            return
+        with self._lock:
+            limits = self._limits.setdefault(device_type_name, self._default_limits())
+            before = dict(limits)
+            if response_bytes > ADAPTIVE_MAX_RESPONSE_BYTES:
+                limits["max_values"] = int(limits["max_values"] * ADAPTIVE_MAX_RESPONSE_BYTES / response_bytes * 0.9)
+            elif elapsed_seconds < ADAPTIVE_TARGET_LATENCY_SECONDS / 2 and response_bytes < ADAPTIVE_MAX_RESPONSE_BYTES / 2:
+                if ps_key_count >= limits["ps_keys"]:
+                    limits["ps_keys"] = max(limits["ps_keys"] + 1, int(limits["ps_keys"] * 1.25))
+                if point_count >= limits["points"]:
+                    limits["points"] = max(limits["points"] + 1, int(limits["points"] * 1.25))
+                if value_count >= limits["max_values"] * 0.8:
+                    limits["max_values"] = int(limits["max_values"] * 1.25)
+            elif elapsed_seconds > ADAPTIVE_TARGET_LATENCY_SECONDS:
+                limits["max_values"] = int(limits["max_values"] * 0.8)
+            self._clamp(limits)
+            if limits != before:
+                self._dirty = True
+                logging.debug(f"Batch limits for {device_type_name}: {before} -> {limits}")
+
+    def record_failure(self, device_type_name, ps_key_count, point_count):
+        """Halves the limits after a call that timed out or failed at the gateway."""
+        if not self.enabled:
+            return
+        with self._lock:
+            limits = self._limits.setdefault(device_type_name, self._default_limits())
+            before = dict(limits)
+            limits["ps_keys"] = min(limits["ps_keys"], max(1, ps_key_count // 2))
+            if ps_key_count <= 1:
+                limits["points"] = min(limits["points"], max(1, point_count // 2))
+            limits["max_values"] = limits["max_values"] // 2
+            self._clamp(limits)
+            if limits != before:
+                self._dirty = True
+                logging.info(f"Shrinking batch limits for {device_type_name} after a failed call: {before} -> {limits}")
+
+    def save(self):
+        """Persists the tuned limits if they changed."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {name: dict(limits) for name, limits in self._limits.items()}
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save tuned batch sizes to {self.path}: {e}")
+
+
+_batch_sizer = None
+_batch_sizer_lock = threading.Lock()
+
+def get_batch_sizer():
+    """Returns the process-wide AdaptiveBatchSizer, loading persisted limits on first use."""
+    global _batch_sizer
+    with _batch_sizer_lock:
+        if _batch_sizer is None:
+            _batch_sizer = AdaptiveBatchSizer()
+        return _batch_sizer
@@ -1,88 +1,428 @@
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import random
+import reprlib
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
 
-from .config import ISOLARCLOUD_BASE_URL, ISOLARCLOUD_SECRET_KEY, SYS_CODE, ISOLARCLOUD_APP_KEY, ISOLARCLOUD_USERNAME, ISOLARCLOUD_PASSWORD, REQUEST_DELAY_SECONDS
+from .token_manager import TokenManager
+from .streaming import ResponseReader
+from .response_archive import ArchivedBody, get_response_archive
+from .metrics import metrics
+from .config import (ISOLARCLOUD_BASE_URL, ISOLARCLOUD_SECRET_KEY, SYS_CODE, ISOLARCLOUD_APP_KEY, ISOLARCLOUD_USERNAME, ISOLARCLOUD_PASSWORD,
+                     API_CALLS_PER_HOUR_LIMIT, API_BURST_SIZE, API_TOKEN_REFILL_PER_SECOND,
+                     HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS,
+                     API_MAX_RETRIES, API_RETRY_BASE_SECONDS, API_RETRY_MAX_SECONDS, API_RATE_LIMIT_BACKOFF_SECONDS,
+                     API_RATE_LIMIT_RESULT_CODES, API_BREAKER_FAILURE_THRESHOLD, API_BREAKER_COOLDOWN_SECONDS, TOKEN_CACHE_PATH,
+                     API_DEBUG_LOG_MAX_CHARS, RESPONSE_ARCHIVE)
 
-# Global token for iSolarCloud API
-ISOLARCLOUD_TOKEN = None
 
-def login_isolarcloud():
-    """Authenticates with the iSolarCloud API and stores the token."""
-    global ISOLARCLOUD_TOKEN
-    login_url = f"{ISOLARCLOUD_BASE_URL}/openapi/login"
-    headers = {
-        "Content-Type": "application/json",
-        "x-access-key": ISOLARCLOUD_SECRET_KEY,
-        "sys_code": SYS_CODE
-    }
-    payload = {
-        "appkey": ISOLARCLOUD_APP_KEY,
-        "user_account": ISOLARCLOUD_USERNAME,
-        "user_password": ISOLARCLOUD_PASSWORD
-    }
-    try:
-        response = requests.post(login_url, headers=headers, json=payload)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        data = response.json()
-        if data.get("result_code") == "1":
-            ISOLARCLOUD_TOKEN = data.get("result_data", {}).get("token")
-            if ISOLARCLOUD_TOKEN:
-                logging.info("Successfully logged into iSolarCloud.")
-                return True
+class RateLimiter:
+    """Thread-safe token bucket that also enforces a hard cap over any rolling hour.
+
+    The bucket (``burst`` capacity, ``refill_per_second`` refill) smooths bursts, while the
+    rolling window guarantees that no more than ``calls_per_hour`` calls leave in any 3600s.
+    """
+
+    def __init__(self, calls_per_hour, burst, refill_per_second):
+        if refill_per_second <= 0:
+            raise ValueError(f"The rate limiter needs a positive refill rate, got {refill_per_second} calls/s "
+                             f"(check ISOLARCLOUD_CALLS_PER_HOUR_LIMIT).")
+        self.calls_per_hour = calls_per_hour
+        self.burst = max(1, burst)
+        self.refill_per_second = refill_per_second
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._call_times = deque()
+        self._lock = threading.Lock()
+        self.total_wait_seconds = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._tokens = min(self.burst, self._tokens + elapsed * self.refill_per_second)
+        self._last_refill = now
+        while self._call_times and now - self._call_times[0] >= 3600:
+            self._call_times.popleft()
+
+    def acquire(self):
+        """Blocks until one API call may be made, then consumes it from the budget."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1 and len(self._call_times) < self.calls_per_hour:
+                    self._tokens -= 1
+                    self._call_times.append(now)
+                    return
+                wait_for_token = (1 - self._tokens) / self.refill_per_second if self._tokens < 1 else 0
+                wait_for_window = 3600 - (now - self._call_times[0]) if len(self._call_times) >= self.calls_per_hour else 0
+                wait = max(wait_for_token, wait_for_window, 0.01)
+                self.total_wait_seconds += wait
+            metrics.inc("isolarcloud_rate_limiter_wait_seconds_total", wait)
+            logging.debug(f"Rate limiter waiting {wait:.2f}s for API budget.")
+            time.sleep(wait)
+
+    def remaining(self):
+        """Returns how many calls are still available in the current rolling hour."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.calls_per_hour - len(self._call_times)
+
+
+# Shared by every caller in the process so the whole run respects one budget
+rate_limiter = RateLimiter(API_CALLS_PER_HOUR_LIMIT, API_BURST_SIZE, API_TOKEN_REFILL_PER_SECOND)
+
+def get_remaining_api_budget():
+    """Returns the number of API calls still available in the current rolling hour."""
+    return rate_limiter.remaining()
+
+class CircuitBreaker:
+    """Pauses every caller while the gateway is degraded instead of letting all workers hammer it.
+
+    After ``failure_threshold`` consecutive gateway failures the breaker opens and ``before_call``
+    blocks for ``cooldown_seconds``. Then a single probe call is let through: success closes the
+    breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._condition = threading.Condition()
+        self.open_count = 0
+
+    def before_call(self):
+        """Blocks while the breaker is open or another caller is probing the gateway."""
+        with self._condition:
+            while True:
+                if self._opened_at is None:
+                    return
+                remaining = self.cooldown_seconds - (time.monotonic() - self._opened_at)
+                if remaining <= 0 and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    logging.info("Circuit breaker half-open: sending one probe call to the gateway.")
+                    return
+                self._condition.wait(timeout=remaining if remaining > 0 else None)
+
+    def record_success(self):
+        with self._condition:
+            if self._opened_at is not None:
+                logging.info("Circuit breaker closed: the gateway is responding again.")
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+    def record_no_call(self):
+        """Releases the probe slot when no call reached the gateway, leaving the breaker's state as it was."""
+        with self._condition:
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+    def record_failure(self):
+        with self._condition:
+            self._consecutive_failures += 1
+            if self._probe_in_flight or (self._opened_at is None and self._consecutive_failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.open_count += 1
+                logging.warning(f"Circuit breaker open after {self._consecutive_failures} consecutive gateway failures; "
+                                f"pausing API calls for {self.cooldown_seconds}s.")
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+
+# Bounded repr for debug logs: large payloads and responses are summarised instead of rendered in full
+_debug_repr = reprlib.Repr()
+_debug_repr.maxlevel = 4
+_debug_repr.maxdict = 12
+_debug_repr.maxlist = 6
+_debug_repr.maxstring = 200
+_debug_repr.maxother = 200
+
+def _debug_summary(value):
+    """Returns a size-capped representation of ``value`` for debug logging."""
+    summary = _debug_repr.repr(value)
+    return summary if len(summary) <= API_DEBUG_LOG_MAX_CHARS else summary[:API_DEBUG_LOG_MAX_CHARS] + "..."
+
+
+# Outcome of one API call: ``data`` is the full response on success (else None) and ``error_kind`` names
+# the failure ("timeout", "connection", "http_5xx", "http_4xx", "rate_limited", "api_error", "auth", "not_logged_in").
+# ``result_code`` is the gateway's result code when a response was parsed.
+ApiCallResult = namedtuple("ApiCallResult", ["data", "error_kind", "elapsed_seconds", "response_bytes", "result_code"], defaults=(None,))
+
+# Failures worth retrying; the first three also count against the circuit breaker
+GATEWAY_ERROR_KINDS = ("timeout", "connection", "http_5xx")
+RETRYABLE_ERROR_KINDS = GATEWAY_ERROR_KINDS + ("rate_limited",)
+
+
+class ISolarCloudClient:
+    """iSolarCloud API client owning a pooled keep-alive HTTP session and its auth token.
+
+    One instance can be shared by many threads: the underlying connection pool is sized by
+    ``pool_size`` and the token is owned by a TokenManager that refreshes it single-flight.
+    With an ``archive`` (ResponseArchive) every successful raw response is archived for replay.
+    """
+
+    def __init__(self, base_url=ISOLARCLOUD_BASE_URL, app_key=ISOLARCLOUD_APP_KEY, secret_key=ISOLARCLOUD_SECRET_KEY,
+                 username=ISOLARCLOUD_USERNAME, password=ISOLARCLOUD_PASSWORD, pool_size=HTTP_POOL_SIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT_SECONDS, read_timeout=HTTP_READ_TIMEOUT_SECONDS, limiter=None,
+                 max_retries=API_MAX_RETRIES, breaker=None, token_cache_path=TOKEN_CACHE_PATH, archive=None):
+        self.base_url = base_url
+        self.app_key = app_key
+        self.username = username
+        self.password = password
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = limiter or rate_limiter
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker(API_BREAKER_FAILURE_THRESHOLD, API_BREAKER_COOLDOWN_SECONDS)
+        self.archive = archive
+        self.tokens = TokenManager(self._login_request, f"{base_url}|{app_key}|{username}", token_cache_path)
+        self._stats_lock = threading.Lock()
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "permanent_failures": 0, "backoff_seconds": 0.0}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Headers are identical for every call, so they are built once and sent from the session
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "x-access-key": secret_key,
+            "sys_code": SYS_CODE,
+        })
+
+    def _post(self, endpoint, payload, stream_parser=None, archive=True):
+        """POSTs a payload and returns (parsed JSON, response size in bytes).
+
+        With ``stream_parser`` the body is streamed and handed to it as a file-like object instead of
+        being loaded whole; its return value takes the place of the parsed JSON. Successful responses
+        are archived unless ``archive`` is False (login responses carry credentials and never are).
+        """
+        archived_body = ArchivedBody() if archive and self.archive else None
+        self.limiter.acquire()
+        with metrics.timer("isolarcloud_api_latency_seconds", endpoint=endpoint):
+            if stream_parser is None:
+                response = self.session.post(f"{self.base_url}{endpoint}", json=payload, timeout=self.timeout)
+                response.raise_for_status()  # Raise an exception for bad status codes
+                data, response_bytes = response.json(), len(response.content)
+                if archived_body:
+                    archived_body.write(response.content)
             else:
-                logging.error("Login successful but token not found in response.")
-                return False
-        else:
-            logging.error(f"iSolarCloud login failed: {data.get('result_msg')}")
-            return False
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error during iSolarCloud login: {e}")
-        return False
+                with self.session.post(f"{self.base_url}{endpoint}", json=payload, timeout=self.timeout, stream=True) as response:
+                    response.raise_for_status()
+                    reader = ResponseReader(response, tee=archived_body.write if archived_body else None)
+                    data = stream_parser(reader)
+                    if archived_body:
+                        reader.read() # Archive any bytes the parser did not need
+                    response_bytes = reader.bytes_read
+        metrics.inc("isolarcloud_api_response_bytes_total", response_bytes, endpoint=endpoint)
+        if archived_body and data.get("result_code") == "1":
+            self._archive_response(endpoint, payload, archived_body)
+        return data, response_bytes
 
-def _make_api_request(endpoint, payload):
-    """Helper function to make requests to the iSolarCloud API."""
-    if not ISOLARCLOUD_TOKEN:
-        logging.error("Not logged in. Please login to iSolarCloud first.")
-        return None
-
-    url = f"{ISOLARCLOUD_BASE_URL}{endpoint}"
-    headers = {
-        "Content-Type": "application/json",
-        "x-access-key": ISOLARCLOUD_SECRET_KEY,
-        "sys_code": SYS_CODE,
-    }
-    # Add token and appkey to payload for all requests except login
-    payload["token"] = ISOLARCLOUD_TOKEN
-    payload["appkey"] = ISOLARCLOUD_APP_KEY # Appkey also needed for other calls
-
-    try:
-        logging.debug(f"Making API request to {url} with payload: {payload}")
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-        logging.debug(f"API response from {url}: {data}")
-
-        if data.get("result_code") == "1":
-            return data # Return full response
-        elif data.get("result_code") == "30001": # Token expired
-            logging.warning("iSolarCloud token expired or invalid. Attempting to re-login...")
-            if login_isolarcloud(): # Try to login again
-                logging.info("Re-login successful. Retrying original request...")
-                payload["token"] = ISOLARCLOUD_TOKEN # Update token in payload
-                response = requests.post(url, headers=headers, json=payload)
-                response.raise_for_status()
-                data = response.json()
-                if data.get("result_code") == "1":
-                    return data # Return full response
+    def _archive_response(self, endpoint, payload, archived_body):
+        try:
+            self.archive.put(endpoint, payload, archived_body)
+            metrics.inc("isolarcloud_archive_bytes_total", archived_body.raw_bytes, endpoint=endpoint)
+        except (sqlite3.Error, OSError) as e: # A full disk must not stop the harvest
+            logging.warning(f"Could not archive the response from {endpoint}: {e}")
+
+    @property
+    def token(self):
+        return self.tokens.token
+
+    def _login_request(self):
+        """Calls the login endpoint and returns the new token, or None on failure."""
+        payload = {
+            "appkey": self.app_key,
+            "user_account": self.username,
+            "user_password": self.password
+        }
+        try:
+            data, _ = self._post("/openapi/login", payload, archive=False)
+            if data.get("result_code") == "1":
+                token = data.get("result_data", {}).get("token")
+                if token:
+                    logging.info("Successfully logged into iSolarCloud.")
+                    return token
                 else:
-                    logging.error(f"API request failed after re-login: {data.get('result_msg')} (Code: {data.get('result_code')})")
+                    logging.error("Login successful but token not found in response.")
                     return None
             else:
-                logging.error("Re-login failed. Cannot proceed with API request.")
+                logging.error(f"iSolarCloud login failed: {data.get('result_msg')}")
                 return None
-        else:
-            logging.error(f"API request to {endpoint} failed: {data.get('result_msg')} (Code: {data.get('result_code')})")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error during iSolarCloud login: {e}")
             return None
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error during API request to {endpoint}: {e}")
-        return None
+
+    def login(self):
+        """Makes sure this client holds a valid token, reusing a fresh cached one instead of logging in."""
+        return self.tokens.get_token() is not None
+
+    def request(self, endpoint, payload):
+        """Makes an authenticated request to the iSolarCloud API, re-logging in once if the token expired."""
+        return self.request_detailed(endpoint, payload).data
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _retry_delay(self, attempt, error_kind, retry_after):
+        """Returns the sleep before retry number ``attempt`` + 1: Retry-After if given, else exponential backoff with full jitter."""
+        if retry_after is not None:
+            return retry_after
+        if error_kind == "rate_limited":
+            return API_RATE_LIMIT_BACKOFF_SECONDS * random.uniform(1, 1.5)
+        return random.uniform(0, min(API_RETRY_MAX_SECONDS, API_RETRY_BASE_SECONDS * 2 ** attempt))
+
+    def request_detailed(self, endpoint, payload, max_retries=None, stream_parser=None):
+        """Like ``request`` but returns an ApiCallResult with the failure kind, latency and response size.
+
+        Timeouts, connection errors, 5xx and rate-limit responses are retried with backoff; other failures
+        are returned immediately. ``max_retries`` overrides the client's retry count for gateway errors only,
+        so callers that split failed calls themselves can give up early without dropping rate-limited calls.
+        ``stream_parser`` is passed to ``_post`` for endpoints whose responses are too large to load whole.
+        """
+        gateway_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            self._count("calls")
+            result, retry_after = self._request_once(endpoint, payload, stream_parser)
+            metrics.inc("isolarcloud_api_calls_total", endpoint=endpoint, result=result.result_code or result.error_kind or "1")
+            if result.error_kind in GATEWAY_ERROR_KINDS:
+                self.breaker.record_failure()
+            elif result.error_kind == "not_logged_in": # No call was made without a token
+                self.breaker.record_no_call()
+            else:
+                self.breaker.record_success() # The gateway answered, even if the answer was an error
+            if result.error_kind == "rate_limited":
+                self._count("rate_limited")
+
+            if result.error_kind is None:
+                return result
+            retry_limit = gateway_retries if result.error_kind in GATEWAY_ERROR_KINDS else self.max_retries
+            if result.error_kind not in RETRYABLE_ERROR_KINDS or attempt >= retry_limit:
+                self._count("permanent_failures")
+                return result
+
+            delay = self._retry_delay(attempt, result.error_kind, retry_after)
+            attempt += 1
+            self._count("retries")
+            self._count("backoff_seconds", delay)
+            metrics.inc("isolarcloud_api_retries_total", endpoint=endpoint, reason=result.error_kind)
+            metrics.inc("isolarcloud_api_backoff_seconds_total", delay, endpoint=endpoint)
+            logging.warning(f"Retrying {endpoint} after {result.error_kind} in {delay:.1f}s (retry {attempt} of {retry_limit}).")
+            time.sleep(delay)
+
+    def _request_once(self, endpoint, payload, stream_parser=None):
+        """Makes one authenticated call, re-logging in once if the token expired.
+
+        Returns (ApiCallResult, Retry-After seconds or None).
+        """
+        token = self.tokens.get_token() # Refreshed proactively before it expires
+        if not token:
+            logging.error("Not logged in. Please login to iSolarCloud first.")
+            return ApiCallResult(None, "not_logged_in", 0.0, 0), None
+        # Token and appkey are added to a copy so that callers' payloads are never shared between threads
+        request_payload = dict(payload, token=token, appkey=self.app_key)
+
+        started = time.monotonic()
+        response_bytes = 0
+        try:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"Making API request to {endpoint} with payload: {_debug_summary(dict(request_payload, token='***'))}")
+            data, response_bytes = self._post(endpoint, request_payload, stream_parser)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"API response from {endpoint} ({response_bytes} bytes): {_debug_summary(data)}")
+
+            if data.get("result_code") == "30001": # Token expired
+                logging.warning("iSolarCloud token expired or invalid. Attempting to re-login...")
+                token = self.tokens.refresh(token) # Concurrent expirations share one login
+                if not token:
+                    logging.error("Re-login failed. Cannot proceed with API request.")
+                    return ApiCallResult(None, "auth", time.monotonic() - started, response_bytes), None
+                logging.info("Re-login successful. Retrying original request...")
+                request_payload["token"] = token # Update token in payload
+                started = time.monotonic()
+                data, response_bytes = self._post(endpoint, request_payload, stream_parser)
+
+            result_code = data.get("result_code")
+            if result_code == "1":
+                return ApiCallResult(data, None, time.monotonic() - started, response_bytes, result_code), None # Return full response
+            if result_code in API_RATE_LIMIT_RESULT_CODES:
+                logging.warning(f"API request to {endpoint} was rate limited: {data.get('result_msg')} (Code: {result_code})")
+                return ApiCallResult(None, "rate_limited", time.monotonic() - started, response_bytes, result_code), None
+            logging.error(f"API request to {endpoint} failed: {data.get('result_msg')} (Code: {result_code})")
+            return ApiCallResult(None, "api_error", time.monotonic() - started, response_bytes, result_code), None
+        except requests.exceptions.ConnectTimeout as e: # The gateway could not be reached; unrelated to the request's size
+            logging.error(f"Connection timeout during API request to {endpoint}: {e}")
+            return ApiCallResult(None, "connection", time.monotonic() - started, response_bytes), None
+        except requests.exceptions.Timeout as e:
+            logging.error(f"Timeout during API request to {endpoint}: {e}")
+            return ApiCallResult(None, "timeout", time.monotonic() - started, response_bytes), None
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else 0
+            if status_code == 429:
+                retry_after = e.response.headers.get("Retry-After")
+                logging.warning(f"API request to {endpoint} was rate limited (HTTP 429).")
+                return (ApiCallResult(None, "rate_limited", time.monotonic() - started, response_bytes),
+                        float(retry_after) if retry_after and retry_after.isdigit() else None)
+            logging.error(f"HTTP error during API request to {endpoint}: {e}")
+            return ApiCallResult(None, "http_5xx" if status_code >= 500 else "http_4xx", time.monotonic() - started, response_bytes), None
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error during API request to {endpoint}: {e}")
+            return ApiCallResult(None, "connection", time.monotonic() - started, response_bytes), None
+
+    def close(self):
+        """Closes the pooled connections held by this client."""
+        self.session.close()
+
+
+# Process-wide client used by the module-level helpers below
+_default_client = None
+_default_client_lock = threading.Lock()
+_response_archiving = RESPONSE_ARCHIVE
+
+def get_default_client():
+    """Returns the shared ISolarCloudClient, creating it on first use."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ISolarCloudClient(archive=get_response_archive() if _response_archiving else None)
+        return _default_client
+
+def set_response_archiving(enabled):
+    """Turns archiving of raw responses by the shared client on or off (--no-archive); the archive is only opened when enabled."""
+    global _response_archiving
+    with _default_client_lock:
+        _response_archiving = enabled
+        client = _default_client
+    if client is not None:
+        client.archive = get_response_archive() if enabled else None
+
+def login_isolarcloud():
+    """Authenticates the shared client with the iSolarCloud API."""
+    return get_default_client().login()
+
+def _make_api_request(endpoint, payload):
+    """Helper function to make requests to the iSolarCloud API through the shared client."""
+    return get_default_client().request(endpoint, payload)
+
+def _make_api_request_detailed(endpoint, payload, max_retries=None, stream_parser=None):
+    """Like _make_api_request but returns an ApiCallResult (failure kind, latency, response size)."""
+    return get_default_client().request_detailed(endpoint, payload, max_retries, stream_parser)
+
+def get_api_call_stats():
+    """Returns the shared client's counters (calls, retries, rate_limited, permanent_failures, backoff_seconds, breaker_opens)."""
+    client = get_default_client()
+    with client._stats_lock:
+        stats = dict(client.stats)
+    stats["breaker_opens"] = client.breaker.open_count
+    return stats
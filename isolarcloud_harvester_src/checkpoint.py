@@ -0,0 +1,171 @@
+import bisect
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+from .config import CHECKPOINT_DB_PATH
+
+
+def _merge_windows(windows):
+    """Sorts inclusive (start, end) windows and merges overlapping or adjacent ones."""
+    merged = []
+    for window_start, window_end in sorted(windows):
+        if merged and window_start <= merged[-1][1] + timedelta(seconds=1):
+            merged[-1][1] = max(merged[-1][1], window_end)
+        else:
+            merged.append([window_start, window_end])
+    return [tuple(window) for window in merged]
+
+
+def _window_covered(merged_windows, start_dt, end_dt):
+    index = bisect.bisect_right(merged_windows, (start_dt, datetime.max)) - 1
+    return index >= 0 and merged_windows[index][1] >= end_dt
+
+
+def _is_covered(coverage, planned_call):
+    """True if completed units already cover every ps_key and point of ``planned_call`` over its whole window."""
+    wanted_points = frozenset(planned_call.points)
+    for ps_key in planned_call.ps_keys:
+        by_points = coverage.get(str(ps_key))
+        if not by_points:
+            return False
+        if any(points >= wanted_points and _window_covered(windows, planned_call.start_dt, planned_call.end_dt)
+               for points, windows in by_points.items()):
+            continue
+        # Point batches differ between the runs: check point by point
+        for point in wanted_points:
+            windows = _merge_windows([window for points, point_windows in by_points.items() if point in points for window in point_windows])
+            if not _window_covered(windows, planned_call.start_dt, planned_call.end_dt):
+                return False
+    return True
+
+
+class CheckpointJournal:
+    """Local SQLite journal of completed/failed minute-data work units for resumable backfills.
+
+    A unit is one planned getDevicePointMinuteDataList call (ps_key batch x point batch x time window)
+    for one ``sink`` (a StorageBackend.sink_id), so resuming into another sink fetches everything again.
+    Every status change is committed on its own with synchronous=FULL. A unit is only marked done once
+    the writer has flushed its rows, so a killed process loses the units still buffered or being written:
+    up to one flush (WRITER_FLUSH_ROWS rows or WRITER_FLUSH_AGE_SECONDS, POSTGRES_COPY_ROWS rows for the
+    Postgres sink) plus the one in progress. Those are fetched again on resume. Resuming matches planned
+    calls against the (ps_key, point, time range) coverage of completed units, so a run replanned with
+    different (e.g. tuned) batch limits still skips what was already stored.
+    """
+
+    def __init__(self, path=CHECKPOINT_DB_PATH, sink="supabase"):
+        self.path = path
+        self.sink = sink
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS units (
+                unit_key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                device_type TEXT,
+                ps_keys TEXT,
+                points TEXT,
+                start_time_stamp TEXT,
+                end_time_stamp TEXT,
+                rows INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_at TEXT,
+                sink TEXT
+            )
+        """)
+        if "sink" not in {column[1] for column in self._conn.execute("PRAGMA table_info(units)")}:
+            self._conn.execute("ALTER TABLE units ADD COLUMN sink TEXT") # Units journaled before this have no sink and are fetched again
+
+    def unit_key(self, planned_call):
+        """Returns a stable identifier for a planned call into this sink, independent of the order ps_keys/points were listed in."""
+        payload = planned_call.to_payload()
+        identity = "|".join([
+            self.sink,
+            ",".join(sorted(str(k) for k in planned_call.ps_keys)),
+            ",".join(sorted(planned_call.points)),
+            payload["start_time_stamp"],
+            payload["end_time_stamp"],
+            str(planned_call.minute_interval),
+        ])
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def _record(self, planned_call, status, rows=0, error=None):
+        payload = planned_call.to_payload()
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO units (unit_key, status, device_type, ps_keys, points, start_time_stamp, end_time_stamp, rows, attempts, last_error, updated_at, sink)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT(unit_key) DO UPDATE SET
+                    status = excluded.status,
+                    rows = excluded.rows,
+                    attempts = units.attempts + 1,
+                    last_error = excluded.last_error,
+                    updated_at = excluded.updated_at
+            """, (self.unit_key(planned_call), status, planned_call.device_type_name, ",".join(planned_call.ps_keys),
+                  payload["points"], payload["start_time_stamp"], payload["end_time_stamp"], rows, error,
+                  datetime.now(timezone.utc).isoformat(), self.sink))
+
+    def mark_completed(self, planned_call, rows):
+        """Records that a unit's data has been fetched and stored."""
+        self._record(planned_call, "done", rows=rows)
+
+    def mark_failed(self, planned_call, error):
+        """Records that a unit failed so that --resume retries it."""
+        self._record(planned_call, "failed", error=str(error))
+
+    def _completed_coverage(self, start_time_stamp, end_time_stamp):
+        """Returns {ps_key: {points: merged [(start, end), ...]}} of the completed units overlapping the given range."""
+        with self._lock:
+            units = self._conn.execute("""
+                SELECT ps_keys, points, start_time_stamp, end_time_stamp FROM units
+                WHERE status = 'done' AND sink = ? AND end_time_stamp >= ? AND start_time_stamp <= ?
+            """, (self.sink, start_time_stamp, end_time_stamp)).fetchall()
+        windows = {}
+        for ps_keys, points, unit_start, unit_end in units:
+            window = (datetime.strptime(unit_start, '%Y%m%d%H%M%S'), datetime.strptime(unit_end, '%Y%m%d%H%M%S'))
+            points = frozenset(points.split(","))
+            for ps_key in ps_keys.split(","):
+                windows.setdefault(ps_key, {}).setdefault(points, []).append(window)
+        return {ps_key: {points: _merge_windows(point_windows) for points, point_windows in by_points.items()}
+                for ps_key, by_points in windows.items()}
+
+    def filter_pending(self, planned_calls):
+        """Drops units already completed in a previous run and returns the ones still to do."""
+        if not planned_calls:
+            return []
+        with self._lock:
+            statuses = dict(self._conn.execute("SELECT unit_key, status FROM units WHERE sink = ?", (self.sink,)).fetchall())
+        coverage = self._completed_coverage(min(call.start_dt for call in planned_calls).strftime('%Y%m%d%H%M%S'),
+                                            max(call.end_dt for call in planned_calls).strftime('%Y%m%d%H%M%S'))
+        pending = []
+        skipped = 0
+        retried = 0
+        for planned_call in planned_calls:
+            status = statuses.get(self.unit_key(planned_call))
+            if status == "done" or _is_covered(coverage, planned_call):
+                skipped += 1
+                continue
+            if status == "failed":
+                retried += 1
+            pending.append(planned_call)
+        if skipped or retried:
+            logging.info(f"Resume: skipping {skipped} completed units, retrying {retried} failed units, {len(pending) - retried} new units.")
+        return pending
+
+    def summary(self):
+        """Returns a {status: unit_count} summary of the journal for this sink."""
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM units WHERE sink = ? GROUP BY status", (self.sink,)).fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
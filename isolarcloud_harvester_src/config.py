@@ -1,12 +1,15 @@
 import os
+import json
 import logging
+from functools import lru_cache
+from types import MappingProxyType
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
 # iSolarCloud API Configuration
-ISOLARCLOUD_BASE_URL = "https://gateway.isolarcloud.com.hk"
+ISOLARCLOUD_BASE_URL = os.getenv("ISOLARCLOUD_BASE_URL", "https://gateway.isolarcloud.com.hk") # Override to point at benchmarks/mock_gateway.py
 ISOLARCLOUD_APP_KEY = os.getenv("ISOLARCLOUD_APP_KEY")
 ISOLARCLOUD_SECRET_KEY = os.getenv("ISOLARCLOUD_SECRET_KEY")
 ISOLARCLOUD_USERNAME = os.getenv("ISOLARCLOUD_USERNAME")
@@ -16,17 +19,96 @@ SYS_CODE = "901"  # Provided in the API documentation
 # Supabase Configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
-print(f"DEBUG: SUPABASE_URL='{SUPABASE_URL}'") # Temporary debug
-print(f"DEBUG: SUPABASE_ANON_KEY='{SUPABASE_ANON_KEY}'") # Temporary debug
+
+# Local state (checkpoints, caches) written by the harvester between runs
+HARVESTER_STATE_DIR = os.getenv("HARVESTER_STATE_DIR", ".harvester_state")
+CHECKPOINT_DB_PATH = os.path.join(HARVESTER_STATE_DIR, "backfill_checkpoints.sqlite3")
+SYNC_HASH_DB_PATH = os.path.join(HARVESTER_STATE_DIR, "sync_hashes.sqlite3")
+DEVICE_CATALOG_PATH = os.path.join(HARVESTER_STATE_DIR, "device_catalog.json")
+ADAPTIVE_BATCH_SIZES_PATH = os.path.join(HARVESTER_STATE_DIR, "batch_sizes.json")
+METRICS_REPORT_PATH = os.path.join(HARVESTER_STATE_DIR, "last_run_metrics.json") # JSON run report written by every CLI run
+RESPONSE_ARCHIVE_PATH = os.path.join(HARVESTER_STATE_DIR, "response_archive.sqlite3") # Compressed raw API responses, replayable with --replay
+TOKEN_CACHE_PATH = os.path.join(HARVESTER_STATE_DIR, "token.json") # Written with owner-only permissions
+TOKEN_TTL_SECONDS = int(os.getenv("ISOLARCLOUD_TOKEN_TTL_SECONDS", 6 * 3600)) # Assumed token lifetime after login
+TOKEN_REFRESH_MARGIN_SECONDS = 600 # Log in again this long before the assumed expiry
+DEVICE_CATALOG_TTL_SECONDS = 6 * 3600 # Reload isolarcloud_devices after this long even without a --sync-devices
+# Fields that change on every API call and would otherwise make every station/device look modified
+SYNC_HASH_IGNORED_FIELDS = ("update_time_api",)
 
 # Script Constants
-REQUEST_DELAY_SECONDS = 2  # Seconds to wait between API calls
 MAX_PS_KEYS_PER_REQUEST = 50  # Max ps_key_list length for getDevicePointMinuteDataList
 MAX_POINTS_PER_REQUEST = 50     # Max points length for getDevicePointMinuteDataList
+MINUTE_DATA_MAX_WINDOW_HOURS = 24 # Longest time span a single getDevicePointMinuteDataList call may cover
+MAX_VALUES_PER_MINUTE_DATA_RESPONSE = 150000 # Max ps_keys x points x slots returned by one call; shortens the window for wide batches
+SUPABASE_PAGE_SIZE = 1000 # Rows per page when reading from PostgREST (matches its default max-rows cap)
+GAP_MERGE_MINUTES = 30 # In incremental mode, gaps closer than this are fetched as one window
+SUPABASE_COVERAGE_FUNCTION = "isolarcloud_historical_coverage" # SQL function returning stored slot ranges for incremental mode (DDL in storage.py)
+ADAPTIVE_BATCHING = True # Tune ps_key/point batch sizes and windows per device type from observed latency and errors
+ADAPTIVE_TARGET_LATENCY_SECONDS = 20 # Calls faster than half of this may grow; slower calls shrink the window
+ADAPTIVE_MAX_RESPONSE_BYTES = 8 * 1024 * 1024 # Responses above this shrink the values-per-response limit
+ADAPTIVE_MAX_VALUES_CEILING = 1000000 # Upper bound for the tuned values-per-response limit
+ADAPTIVE_MIN_VALUES = 1000 # Lower bound for the tuned values-per-response limit
+FETCH_CONCURRENCY = 4 # Default number of parallel API workers for minute-data fetches (--concurrency)
 DAYS_PER_HISTORICAL_BATCH = 7 # Number of days to fetch in a single batch for long historical requests
-API_CALLS_PER_HOUR_LIMIT = 2000 # For reference, not directly used in delay calculation logic yet
+SOLAR_TRIMMING = True # Fetch inverters/meteo stations only between sunrise and sunset (plus margin) of their station
+SOLAR_MARGIN_MINUTES = 60 # Extra time fetched before sunrise and after sunset
+SOLAR_TRIMMED_DEVICE_TYPES = ("inverter", "meteo_station") # Meters and other types are always fetched around the clock
+DAEMON_POLL_INTERVAL_MINUTES = 5 # --daemon pulls new minute data for every station this often
+DAEMON_LOOKBACK_MINUTES = 60 # Each pull fills gaps this far back, so late or missed slots are picked up
+DAEMON_COALESCE_SECONDS = 30 # Stations due within this window of each other share one pull (and its ps_key batches)
+DAEMON_SYNC_INTERVAL_HOURS = 6 # --daemon re-syncs stations and devices (and reloads the catalogue) this often
+DAEMON_ROLLUP_INTERVAL_MINUTES = 15 # --daemon refreshes the rollups of the station-days it wrote to this often
+API_CALLS_PER_HOUR_LIMIT = int(os.getenv("ISOLARCLOUD_CALLS_PER_HOUR_LIMIT", 2000)) # Hard cap on API calls in any rolling hour, enforced by api_client.rate_limiter
+API_BURST_SIZE = 10 # Calls that may be issued back-to-back before the token bucket starts pacing
+API_TOKEN_REFILL_PER_SECOND = API_CALLS_PER_HOUR_LIMIT / 3600 # Token bucket refill rate (calls per second)
+
+# Buffered writer for isolarcloud_historical_data (db_operations.HistoricalDataWriter)
+# A --resume journal only records a unit once its rows are flushed, so these also bound what a killed run re-fetches
+WRITER_FLUSH_ROWS = int(os.getenv("HARVESTER_WRITER_FLUSH_ROWS", 5000)) # Flush once this many (deduplicated) rows are buffered
+WRITER_FLUSH_BYTES = 4 * 1024 * 1024 # ...or once the buffered rows are roughly this large
+WRITER_FLUSH_AGE_SECONDS = float(os.getenv("HARVESTER_WRITER_FLUSH_AGE_SECONDS", 10)) # ...or once the oldest buffered row is this old
+WRITER_CHUNK_ROWS = 1000 # Rows per upsert request
+WRITER_MAX_PENDING_ROWS = 50000 # Enqueue blocks beyond this many unwritten rows (back-pressure)
+WRITER_MAX_RETRIES = 4
+WRITER_RETRY_BACKOFF_SECONDS = 1
+
+PARQUET_COMPRESSION = "zstd" # Codec for the local Parquet sink (--sink parquet:/path)
+POSTGRES_DSN = os.getenv("HARVESTER_POSTGRES_DSN") # e.g. postgresql://postgres:pw@db.<project>.supabase.co:5432/postgres; enables the direct COPY sink
+DEFAULT_SINK = os.getenv("HARVESTER_SINK", "postgres" if POSTGRES_DSN else "supabase") # --sink default
+POSTGRES_POOL_SIZE = 4 # Pooled connections for the Postgres sink
+POSTGRES_CONNECT_TIMEOUT_SECONDS = 15
+POSTGRES_COPY_ROWS = 20000 # Rows per COPY + merge transaction (also the writer's flush size for this sink)
+POSTGRES_FLUSH_BYTES = 32 * 1024 * 1024 # Writer flush size in bytes for the Postgres sink
+ROLLUPS = os.getenv("HARVESTER_ROLLUPS", "0") == "1" # Maintain the hourly/daily rollup tables (DDL in rollups.py) for every window ingested; opt-in, or --rollups
+ROLLUP_HOURLY_TABLE = "isolarcloud_rollups_hourly"
+ROLLUP_DAILY_TABLE = "isolarcloud_rollups_daily"
+ROLLUP_KEY_COLUMNS = ("scope", "entity_id", "point", "period_start") # Conflict target of both rollup tables
+
+# HTTP client settings for the pooled iSolarCloud session
+HTTP_POOL_SIZE = 16 # Keep-alive connections kept per host; should be >= FETCH_CONCURRENCY
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_READ_TIMEOUT_SECONDS = 120
+STREAM_CHUNK_BYTES = 64 * 1024 # Read size when streaming large minute-data responses
+RESPONSE_ARCHIVE = os.getenv("ISOLARCLOUD_RESPONSE_ARCHIVE", "1") != "0" # Archive every successful raw API response (--no-archive disables)
+RESPONSE_ARCHIVE_RETENTION_DAYS = int(os.getenv("ISOLARCLOUD_RESPONSE_ARCHIVE_RETENTION_DAYS", 90)) # Archived responses older than this are pruned (0 keeps them forever)
+RESPONSE_ARCHIVE_ZSTD_LEVEL = 6 # Used when the optional zstandard package is installed
+RESPONSE_ARCHIVE_ZLIB_LEVEL = 6 # Fallback codec otherwise
+API_DEBUG_LOG_MAX_CHARS = 2000 # Debug logs show a truncated summary of payloads and responses, never the full body
+API_MAX_RETRIES = 4 # Retries for timeouts, connection errors, 5xx responses and rate-limit responses
+API_RETRY_BASE_SECONDS = 1 # First backoff step; doubled per retry with full jitter
+API_RETRY_MAX_SECONDS = 60 # Upper bound for one backoff sleep
+API_RATE_LIMIT_BACKOFF_SECONDS = 60 # Pause after a rate-limit response that carries no Retry-After header
+# Gateway result codes meaning "too many requests" (HTTP 429 is always treated as one), comma-separated
+API_RATE_LIMIT_RESULT_CODES = tuple(code.strip() for code in os.getenv("ISOLARCLOUD_RATE_LIMIT_RESULT_CODES", "").split(",") if code.strip())
+MINUTE_DATA_RETRIES_BEFORE_SPLIT = 1 # Gateway-error retries for a minute-data call before it is split into smaller calls
+MINUTE_DATA_MAX_SPLIT_DEPTH = 3 # A failing minute-data call is halved at most this many times (into up to 2**N calls)
+API_BREAKER_FAILURE_THRESHOLD = 5 # Consecutive gateway failures that open the circuit breaker
+API_BREAKER_COOLDOWN_SECONDS = 60 # How long all workers pause before one probe call is let through
 
 # --- Configuration for Measuring Points ---
+# "type_name_keywords" are matched (in this order) against the lowercased iSolarCloud type_name;
+# "api_device_type_code" is the fallback when no keyword matches. "rollup_points" are aggregated into
+# the hourly/daily rollup tables (default: all of the type's points).
 DEVICE_TYPE_MEASURING_POINTS = {
     "inverter": {
         "points": ["p1", "p96","p97","p98","p99","p100","p101","p102",
@@ -34,18 +116,28 @@ DEVICE_TYPE_MEASURING_POINTS = {
                     "p110","p111","p112","p113","p70","p71","p72","p73",
                     "p74","p75","p76","p77","p78","p79","p80","p81","p82",
                     "p83","p84","p85","p86","p87","p88","p89","p90","p91","p92","p93"], 
-        "api_device_type_code": 1 
+        "api_device_type_code": 1,
+        "type_name_keywords": ["inverter", "逆变器"], # Chinese for inverter
+        "rollup_points": ["p1"] # Yield
     },
     "meteo_station": {
         "points": ["p2003"], 
-        "api_device_type_code": 5 
+        "api_device_type_code": 5,
+        "type_name_keywords": ["meteo_station", "meteo", "气象站"], # Chinese for weather station
+        "rollup_points": ["p2003"] # Irradiance
     },
     "meter": {
         "points": ["p8030", "p8031", "p8032", "p8033", "p8018", "p8014"],
-        "api_device_type_code": 7 
+        "api_device_type_code": 7,
+        "type_name_keywords": ["meter", "电表"], # Chinese for meter
+        "rollup_points": ["p8018", "p8014", "p8030", "p8031", "p8032", "p8033"] # Energy and power
     }
 }
 
+# Optional JSON file with extra or overriding device types (e.g. batteries, combiner boxes), same shape as above:
+# {"battery": {"points": ["p58601-p58610"], "api_device_type_code": 43, "type_name_keywords": ["battery"]}}
+DEVICE_TYPES_CONFIG_FILE = os.getenv("DEVICE_TYPES_CONFIG_FILE")
+
 def _parse_point_range(point_range_str):
     """Parses a point range string like "p96-p115" into a list of points ["p96", "p97", ..., "p115"]."""
     if "-" in point_range_str:
@@ -53,22 +145,86 @@ def _parse_point_range(point_range_str):
         start_str, end_str = point_range_str[1:].split("-")
         try:
             start = int(start_str)
-            end = int(end_str)
+            end = int(end_str[1:] if end_str.startswith(prefix) else end_str)
             return [f"{prefix}{i}" for i in range(start, end + 1)]
         except ValueError:
             logging.warning(f"Could not parse point range: {point_range_str}. Returning as is.")
             return [point_range_str] 
     return [point_range_str]
 
+def _load_device_types_config_file(path):
+    """Reads extra device type definitions from a JSON file; invalid entries are skipped with a warning."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            extra_types = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read device types config file {path}: {e}")
+        return {}
+    valid_types = {}
+    for name, type_config in extra_types.items():
+        if not isinstance(type_config, dict) or not isinstance(type_config.get("points"), list):
+            logging.warning(f"Ignoring device type '{name}' in {path}: it needs a 'points' list.")
+            continue
+        valid_types[name.lower()] = type_config
+    return valid_types
+
+def _build_device_type_index(device_types):
+    """Builds the frozen lookup tables used by classify_device and get_measuring_points_for_device_type."""
+    points_by_type = {}
+    type_by_api_code = {}
+    keyword_rules = []
+    for name, type_config in device_types.items():
+        expanded = []
+        for point_or_range in type_config.get("points", []):
+            expanded.extend(_parse_point_range(point_or_range))
+        points_by_type[name] = tuple(expanded)
+        api_code = type_config.get("api_device_type_code")
+        if api_code is not None:
+            type_by_api_code.setdefault(str(api_code), name)
+        for keyword in type_config.get("type_name_keywords", []):
+            keyword_rules.append((keyword.lower(), name))
+    return MappingProxyType(points_by_type), MappingProxyType(type_by_api_code), tuple(keyword_rules)
+
+if DEVICE_TYPES_CONFIG_FILE:
+    DEVICE_TYPE_MEASURING_POINTS.update(_load_device_types_config_file(DEVICE_TYPES_CONFIG_FILE))
+
+# Built once at import: device type -> expanded points, API type code -> device type, and keyword rules
+MEASURING_POINTS_BY_TYPE, DEVICE_TYPE_BY_API_CODE, _TYPE_NAME_KEYWORD_RULES = _build_device_type_index(DEVICE_TYPE_MEASURING_POINTS)
+
+def _build_rollup_point_index(device_types):
+    """Returns {point: device type} for the "rollup_points" of every device type (all of its points when unset)."""
+    rollup_points = {}
+    for name, type_config in device_types.items():
+        for point_or_range in type_config.get("rollup_points", type_config.get("points", [])):
+            for point in _parse_point_range(point_or_range):
+                rollup_points.setdefault(point, name)
+    return MappingProxyType(rollup_points)
+
+ROLLUP_POINT_TYPES = _build_rollup_point_index(DEVICE_TYPE_MEASURING_POINTS)
+
+@lru_cache(maxsize=1024)
+def _classify_type_name(type_name_lower):
+    for keyword, name in _TYPE_NAME_KEYWORD_RULES:
+        if keyword in type_name_lower:
+            return name
+    if type_name_lower in MEASURING_POINTS_BY_TYPE:
+        return type_name_lower
+    return None
+
+def classify_device(type_name, device_type_code=None):
+    """Maps an iSolarCloud type_name / device_type code to a configured device type name, or 'unknown'."""
+    if type_name:
+        name = _classify_type_name(type_name.lower())
+        if name:
+            return name
+    if device_type_code is not None:
+        return DEVICE_TYPE_BY_API_CODE.get(str(device_type_code), 'unknown')
+    return 'unknown'
+
 def get_measuring_points_for_device_type(device_type_name):
-    """Returns a flat list of measuring points for a given device type name (e.g., 'inverter')."""
-    config = DEVICE_TYPE_MEASURING_POINTS.get(device_type_name.lower())
-    if not config:
+    """Returns the (pre-expanded) tuple of measuring points for a given device type name (e.g., 'inverter')."""
+    points = MEASURING_POINTS_BY_TYPE.get(device_type_name.lower())
+    if points is None:
         logging.warning(f"No measuring point configuration found for device type: {device_type_name}")
-        return []
-    
-    all_points = []
-    for point_or_range in config.get("points", []):
-        all_points.extend(_parse_point_range(point_or_range))
-    return all_points
-
+        return ()
+    return points
@@ -0,0 +1,133 @@
+import heapq
+import logging
+import signal
+import threading
+import time
+import zlib
+
+from .config import (DAEMON_POLL_INTERVAL_MINUTES, DAEMON_LOOKBACK_MINUTES, DAEMON_COALESCE_SECONDS, DAEMON_SYNC_INTERVAL_HOURS,
+                     DAEMON_ROLLUP_INTERVAL_MINUTES, SOLAR_TRIMMING, ROLLUPS)
+from .api_client import get_remaining_api_budget, get_api_call_stats
+from .db_operations import sync_power_stations, sync_all_devices, get_power_station_ids, HistoricalDataWriter
+from .data_processing import poll_recent_minute_data, _map_device_type_name_for_points
+from .device_catalog import load_device_catalog
+from .solar import SolarTrimmer
+from .rollups import RollupMaintainer
+
+
+def _station_offset(ps_id, interval_seconds):
+    """Returns a stable offset within the poll interval so stations are spread evenly instead of polled at once."""
+    return zlib.crc32(str(ps_id).encode("utf-8")) % max(1, int(interval_seconds))
+
+
+class HarvesterDaemon:
+    """Keeps the API client, token, device catalogue and writer warm and polls every station on a staggered schedule.
+
+    Each station is pulled every ``poll_interval_minutes`` at its own offset within the interval; stations due
+    within DAEMON_COALESCE_SECONDS share one pull. Stations and devices are re-synced every ``sync_interval_hours``
+    and the writer refreshes the rollups of the station-hours written every DAEMON_ROLLUP_INTERVAL_MINUTES.
+    ``stop`` (also wired to SIGTERM/SIGINT by ``run``) ends the loop after the current pull and flushes the writer;
+    ``storage`` is left open for its owner to close.
+    """
+
+    def __init__(self, supabase_client, storage, concurrency=1, poll_interval_minutes=DAEMON_POLL_INTERVAL_MINUTES,
+                 lookback_minutes=DAEMON_LOOKBACK_MINUTES, sync_interval_hours=DAEMON_SYNC_INTERVAL_HOURS, solar_trim=SOLAR_TRIMMING,
+                 rollups=ROLLUPS):
+        self.supabase_client = supabase_client
+        self.storage = storage
+        self.concurrency = concurrency
+        self.poll_interval_seconds = poll_interval_minutes * 60
+        self.lookback_minutes = lookback_minutes
+        self.sync_interval_seconds = sync_interval_hours * 3600
+        self.solar = SolarTrimmer() if solar_trim else None # Inverters and meteo stations are not polled at night
+        # The writer refreshes the rollups of the station-hours it stored, at most this often
+        self.rollups = RollupMaintainer(storage, DAEMON_ROLLUP_INTERVAL_MINUTES * 60) if rollups else None
+        self._stop_event = threading.Event()
+        self._devices_by_station = {}
+        self._schedule = [] # Heap of (next_due_monotonic, ps_id)
+        self._next_sync = 0.0
+        self.writer = None
+        self.poll_count = 0
+
+    def stop(self, *_):
+        """Asks the daemon to shut down after the current pull (usable as a signal handler)."""
+        if not self._stop_event.is_set():
+            logging.info("Daemon stop requested; finishing the current pull and flushing buffered writes.")
+        self._stop_event.set()
+
+    def _load_catalogue(self, refresh=False):
+        devices_by_station = {}
+        for device in load_device_catalog(self.supabase_client, _map_device_type_name_for_points, refresh):
+            devices_by_station.setdefault(str(device.get('ps_id')), []).append(device)
+        self._devices_by_station = devices_by_station
+
+        now = time.monotonic()
+        interval_start = now - now % self.poll_interval_seconds
+        self._schedule = []
+        for ps_id in devices_by_station:
+            due = interval_start + _station_offset(ps_id, self.poll_interval_seconds)
+            heapq.heappush(self._schedule, (due if due >= now else due + self.poll_interval_seconds, ps_id))
+        logging.info(f"Daemon scheduling {len(devices_by_station)} stations every {self.poll_interval_seconds // 60} minutes.")
+
+    def _sync(self):
+        """Re-syncs stations and devices, then reloads the catalogue and the poll schedule."""
+        logging.info("Daemon: synchronizing power stations and devices.")
+        try:
+            sync_power_stations()
+            ps_ids = get_power_station_ids()
+            if ps_ids:
+                sync_all_devices(ps_ids, self.concurrency)
+        except Exception as e:
+            logging.error(f"Daemon sync failed; keeping the current device catalogue: {e}")
+        self._load_catalogue(refresh=True)
+        self._next_sync = time.monotonic() + self.sync_interval_seconds
+
+    def _pop_due_stations(self):
+        now = time.monotonic()
+        due_stations = []
+        while self._schedule and self._schedule[0][0] <= now + DAEMON_COALESCE_SECONDS:
+            due, ps_id = heapq.heappop(self._schedule)
+            due_stations.append(ps_id)
+            next_due = due + self.poll_interval_seconds
+            while next_due <= now: # Skip slots missed while a long pull was running
+                next_due += self.poll_interval_seconds
+            heapq.heappush(self._schedule, (next_due, ps_id))
+        return due_stations
+
+    def _poll(self, ps_ids):
+        devices = [device for ps_id in ps_ids for device in self._devices_by_station.get(ps_id, [])]
+        started = time.monotonic()
+        try:
+            rows_queued = poll_recent_minute_data(self.supabase_client, devices, self.lookback_minutes, self.writer, self.concurrency,
+                                                  solar=self.solar)
+        except Exception as e:
+            logging.error(f"Daemon pull for stations {ps_ids} failed: {e}")
+            return
+        self.poll_count += 1
+        logging.info(f"Daemon pulled {len(ps_ids)} stations ({len(devices)} devices) in {time.monotonic() - started:.1f}s: "
+                     f"{rows_queued} rows queued, {get_remaining_api_budget()} API calls left this hour.")
+
+    def run(self):
+        """Runs until SIGTERM/SIGINT or ``stop``; always flushes the writer before returning."""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+
+        self.writer = HistoricalDataWriter(self.storage, rollups=self.rollups).start()
+        try:
+            self._sync()
+            while not self._stop_event.is_set():
+                if time.monotonic() >= self._next_sync:
+                    self._sync()
+                    continue
+                due_stations = self._pop_due_stations()
+                if due_stations:
+                    self._poll(due_stations)
+                    continue
+                next_event = min(self._next_sync, self._schedule[0][0] if self._schedule else self._next_sync)
+                self._stop_event.wait(max(0.0, next_event - time.monotonic()))
+        finally:
+            self.writer.close()
+            if self.solar:
+                logging.info(self.solar.summary())
+            logging.info(f"Daemon stopped after {self.poll_count} pulls; {self.writer.rows_written} rows written. "
+                         f"API call stats: {get_api_call_stats()}")
@@ -1,39 +1,165 @@
+import io
 import logging
-import time
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
-
-from .config import (MAX_PS_KEYS_PER_REQUEST, MAX_POINTS_PER_REQUEST, REQUEST_DELAY_SECONDS, 
-                         DEVICE_TYPE_MEASURING_POINTS, get_measuring_points_for_device_type, DAYS_PER_HISTORICAL_BATCH)
-from .api_client import _make_api_request
+from functools import partial
+
+from .config import DAYS_PER_HISTORICAL_BATCH, MINUTE_DATA_RETRIES_BEFORE_SPLIT, MINUTE_DATA_MAX_SPLIT_DEPTH, SOLAR_TRIMMING, RESPONSE_ARCHIVE_PATH, ROLLUPS, classify_device
+from .api_client import _make_api_request_detailed, get_remaining_api_budget
+from .request_planner import plan_minute_data_calls, plan_minute_data_calls_in_windows, summarize_plan
+from .adaptive_batching import SPLITTABLE_ERROR_KINDS, get_batch_sizer
+from .checkpoint import CheckpointJournal
+from .gap_detection import plan_gap_calls
+from .db_operations import HistoricalDataWriter
+from .storage import SupabaseStorage
+from .device_catalog import load_device_catalog
+from .streaming import parse_minute_data_stream
+from .solar import SolarTrimmer, station_now
+from .response_archive import ResponseArchive
+from .rollups import RollupMaintainer
+from .metrics import metrics
+
+MINUTE_DATA_ENDPOINT = "/openapi/getDevicePointMinuteDataList"
 
 
 def _map_device_type_name_for_points(device):
     """Helper to determine the standardized device type name for point lookup."""
-    device_type_name_for_points = 'unknown'
-    if 'type_name' in device:
-        type_name_lower = device['type_name'].lower()
-        # Prioritize specific keywords for mapping
-        if "inverter" in type_name_lower or "逆变器" in type_name_lower: # Chinese for inverter
-            device_type_name_for_points = "inverter"
-        elif "meteo_station" in type_name_lower or "meteo" in type_name_lower or "气象站" in type_name_lower: # Chinese for weather station
-            device_type_name_for_points = "meteo_station"
-        elif "meter" in type_name_lower or "电表" in type_name_lower: # Chinese for meter
-            device_type_name_for_points = "meter"
-        else: # Fallback if no keywords match, try to use type_name directly if it's in DEVICE_TYPE_MEASURING_POINTS
-            if type_name_lower in DEVICE_TYPE_MEASURING_POINTS:
-                 device_type_name_for_points = type_name_lower
-            else:
-                logging.debug(f"type_name '{device['type_name']}' not directly in DEVICE_TYPE_MEASURING_POINTS, trying API type code.")
-
-    if device_type_name_for_points == 'unknown' and 'device_type' in device:
-        api_type_code = device.get('device_type')
-        for name, config_data in DEVICE_TYPE_MEASURING_POINTS.items():
-            if config_data.get('api_device_type_code') == api_type_code:
-                device_type_name_for_points = name
-                break
+    if 'mapped_type' in device: # Precomputed by the device catalogue
+        return device['mapped_type']
+    device_type_name_for_points = classify_device(device.get('type_name'), device.get('device_type'))
+    if device_type_name_for_points == 'unknown':
+        logging.debug(f"Could not map device {device.get('device_ps_key')} (type_name '{device.get('type_name')}', device_type {device.get('device_type')}) to a configured device type.")
     return device_type_name_for_points
 
-def fetch_and_store_minute_data(supabase_client, devices_to_fetch, start_time_dt, end_time_dt, minute_interval=5):
+def _split_planned_call(planned_call):
+    """Splits a planned call in two: by ps_keys, else by points, else by time window. Returns None if it cannot be split."""
+    if len(planned_call.ps_keys) > 1:
+        middle = len(planned_call.ps_keys) // 2
+        return (planned_call._replace(ps_keys=planned_call.ps_keys[:middle]),
+                planned_call._replace(ps_keys=planned_call.ps_keys[middle:]))
+    if len(planned_call.points) > 1:
+        middle = len(planned_call.points) // 2
+        return (planned_call._replace(points=planned_call.points[:middle]),
+                planned_call._replace(points=planned_call.points[middle:]))
+    step = timedelta(minutes=planned_call.minute_interval)
+    slot_count = int((planned_call.end_dt - planned_call.start_dt) / step) + 1
+    if slot_count > 1:
+        second_start = planned_call.start_dt + step * (slot_count // 2)
+        return (planned_call._replace(end_dt=second_start - timedelta(seconds=1)),
+                planned_call._replace(start_dt=second_start))
+    return None
+
+def _fetch_minute_data_rows(planned_call, store_rows, split_depth=0):
+    """Calls getDevicePointMinuteDataList for one planned call and hands the converted rows to ``store_rows``.
+
+    Rows are passed on one ps_key at a time while the response streams in, so memory does not grow with
+    the batch size. Calls that time out or fail with a 5xx are split into smaller calls and retried, at most
+    MINUTE_DATA_MAX_SPLIT_DEPTH times, and those failures and every success feed the adaptive batch sizer.
+    Returns the number of rows passed on, or None when any part failed, so callers can tell a failure apart
+    from an empty window.
+    """
+    batch_sizer = get_batch_sizer()
+    payload = planned_call.to_payload()
+    logging.info(f"Fetching minute data for {len(planned_call.ps_keys)} {planned_call.device_type_name} devices x {len(planned_call.points)} points "
+                 f"from {payload['start_time_stamp']} to {payload['end_time_stamp']}")
+    # The response is parsed while it streams in and each ps_key is transformed and stored as soon as it is complete
+    result = _make_api_request_detailed(MINUTE_DATA_ENDPOINT, payload, MINUTE_DATA_RETRIES_BEFORE_SPLIT,
+                                        partial(parse_minute_data_stream, on_rows=store_rows))
+
+    if result.data is None: # Error already logged by _make_api_request_detailed
+        if result.error_kind not in SPLITTABLE_ERROR_KINDS:
+            return None
+        batch_sizer.record_failure(planned_call.device_type_name, len(planned_call.ps_keys), len(planned_call.points))
+        halves = _split_planned_call(planned_call) if split_depth < MINUTE_DATA_MAX_SPLIT_DEPTH else None
+        if halves is None:
+            return None
+        logging.warning(f"Minute-data call failed ({result.error_kind}); retrying as two smaller calls.")
+        row_count = 0
+        for half in halves:
+            half_row_count = _fetch_minute_data_rows(half, store_rows, split_depth + 1)
+            if half_row_count is None:
+                return None
+            row_count += half_row_count
+        return row_count
+
+    step = timedelta(minutes=planned_call.minute_interval)
+    slot_count = int((planned_call.end_dt - planned_call.start_dt) / step) + 1
+    batch_sizer.record_success(planned_call.device_type_name, len(planned_call.ps_keys), len(planned_call.points),
+                               len(planned_call.ps_keys) * len(planned_call.points) * slot_count,
+                               result.elapsed_seconds, result.response_bytes)
+
+    return result.data["row_count"]
+
+def _fetch_and_store_minute_data_unit(writer, planned_call, journal=None):
+    """Fetches one planned call straight into the writer and journals the unit once all of its rows are stored.
+
+    Returns the number of rows enqueued.
+    """
+    failed_writes = []
+    def on_rows_flushed(success):
+        if not success:
+            failed_writes.append(planned_call)
+
+    row_count = _fetch_minute_data_rows(planned_call, lambda rows: writer.enqueue(rows, on_rows_flushed if journal else None))
+    if row_count is None:
+        if journal:
+            journal.mark_failed(planned_call, "API request failed")
+        return 0
+    if not row_count:
+        logging.info("No minute data returned for this unit; nothing to store.")
+        if journal:
+            journal.mark_completed(planned_call, 0)
+        return 0
+
+    def on_flushed(success):
+        # Enqueued after every row of the unit, so it runs once all of their flushes have been reported
+        if success and not failed_writes:
+            journal.mark_completed(planned_call, row_count)
+        else:
+            journal.mark_failed(planned_call, f"{writer.storage.name} write failed")
+
+    if journal:
+        writer.enqueue([], on_flushed)
+    return row_count
+
+def _run_minute_data_requests(supabase_client, planned_calls, concurrency=1, journal=None, writer=None):
+    """Executes planned minute-data calls and queues the results for storage, returning the number of rows queued.
+
+    Rows go to a HistoricalDataWriter that upserts them from a background thread, so the fetch path never
+    waits on the database. With ``concurrency`` > 1 the API calls also fan out over a bounded thread pool
+    (still throttled by the shared rate limiter). Each finished unit is recorded in ``journal`` when given.
+    If no ``writer`` is passed, one is created and flushed before returning.
+    """
+    owns_writer = writer is None
+    if owns_writer:
+        writer = HistoricalDataWriter(SupabaseStorage(supabase_client)).start()
+
+    total_rows_queued = 0
+    try:
+        if concurrency <= 1:
+            for planned_call in planned_calls:
+                total_rows_queued += _fetch_and_store_minute_data_unit(writer, planned_call, journal)
+        else:
+            logging.info(f"Running {len(planned_calls)} minute-data requests with concurrency {concurrency}.")
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="api-fetch") as fetchers:
+                fetch_futures = {fetchers.submit(_fetch_and_store_minute_data_unit, writer, planned_call, journal): planned_call
+                                 for planned_call in planned_calls}
+                for fetch_future in as_completed(fetch_futures):
+                    try:
+                        total_rows_queued += fetch_future.result()
+                    except Exception as e:
+                        logging.error(f"Unexpected error while fetching minute data: {e}")
+                        if journal:
+                            journal.mark_failed(fetch_futures[fetch_future], str(e))
+    finally:
+        get_batch_sizer().save() # Tuned sizes are kept for the next batch and the next run
+        if owns_writer:
+            writer.close()
+    return total_rows_queued
+
+def fetch_and_store_minute_data(supabase_client, devices_to_fetch, start_time_dt, end_time_dt, minute_interval=5, concurrency=1, writer=None):
     """Fetches minute-level data and stores it in Supabase."""
     if not supabase_client:
         logging.error("Supabase client not initialized in data_processing. Cannot store minute data.")
@@ -43,175 +169,88 @@ def fetch_and_store_minute_data(supabase_client, devices_to_fetch, start_time_dt
         logging.info("No devices provided to fetch_and_store_minute_data.")
         return 0
 
-    grouped_by_ps_and_type = {}
-    for device in devices_to_fetch:
-        ps_id = device.get('ps_id') 
-        device_type_name = _map_device_type_name_for_points(device)
-        
-        if ps_id not in grouped_by_ps_and_type:
-            grouped_by_ps_and_type[ps_id] = {}
-        if device_type_name not in grouped_by_ps_and_type[ps_id]:
-            grouped_by_ps_and_type[ps_id][device_type_name] = []
-        # Store the full device object temporarily if needed, or just ps_key
-        grouped_by_ps_and_type[ps_id][device_type_name].append(device.get('device_ps_key'))
-
-    total_data_points_ingested = 0
-
-    start_time_api_format = start_time_dt.strftime('%Y%m%d%H%M%S')
-    end_time_api_format = end_time_dt.strftime('%Y%m%d%H%M%S')
-
-    for ps_id, types_in_ps in grouped_by_ps_and_type.items():
-        for device_type_name, ps_key_list_for_type in types_in_ps.items():
-            if device_type_name == 'unknown':
-                logging.warning(f"Skipping devices with unknown type for ps_id {ps_id}: {ps_key_list_for_type}")
-                continue
-
-            measuring_points_for_type = get_measuring_points_for_device_type(device_type_name)
-            if not measuring_points_for_type:
-                logging.warning(f"Skipping {device_type_name} for ps_id {ps_id} as no measuring points defined.")
-                continue
-            
-            # The /openapi/getDevicePointMinuteDataList endpoint uses ps_key_list and points, 
-            # not device_type for filtering, so api_device_type_code is not used here.
-
-            # Batch ps_keys and measuring_points according to API limits
-            for i in range(0, len(ps_key_list_for_type), MAX_PS_KEYS_PER_REQUEST):
-                batched_ps_keys = ps_key_list_for_type[i:i + MAX_PS_KEYS_PER_REQUEST]
-                
-                for j in range(0, len(measuring_points_for_type), MAX_POINTS_PER_REQUEST):
-                    batched_points_str_list = measuring_points_for_type[j:j + MAX_POINTS_PER_REQUEST]
-                    
-                    payload = {
-                        "ps_key_list": batched_ps_keys,
-                        "points": ",".join(batched_points_str_list), # API expects a comma-separated string
-                        "start_time_stamp": start_time_api_format,
-                        "end_time_stamp": end_time_api_format,
-                        "minute_interval": minute_interval,
-                    }
-                    
-                    logging.info(f"Fetching minute data with payload: {payload}")
-                    api_response_parsed = _make_api_request("/openapi/getDevicePointMinuteDataList", payload)
-                    time.sleep(REQUEST_DELAY_SECONDS)
-
-                    if api_response_parsed and api_response_parsed.get("result_code") == "1":
-                        result_data = api_response_parsed.get("result_data", {})
-                        supabase_data_to_insert = []
-                        for device_api_ps_key, point_data_records in result_data.items():
-                            if not isinstance(point_data_records, list):
-                                logging.warning(f"Expected a list of records for ps_key {device_api_ps_key}, got {type(point_data_records)}. Skipping.")
-                                continue
-                            
-                            for point_data_item in point_data_records:
-                                timestamp_api_str = point_data_item.get("time_stamp")
-                                if not timestamp_api_str or not device_api_ps_key: # device_api_ps_key is from the outer loop
-                                    logging.warning(f"Missing time_stamp or ps_key in record for {device_api_ps_key}: {point_data_item}")
-                                    continue
-
-                                try:
-                                    # API timestamp is YYYYMMDDHHMMSS
-                                    naive_dt = datetime.strptime(timestamp_api_str, '%Y%m%d%H%M%S')
-                                    # TODO: Confirm timezone of API's time_stamp. Assuming it's local to powerhouse.
-                                    # For now, store as naive datetime converted to ISO string.
-                                    # Proper UTC conversion would require knowing the powerhouse's timezone.
-                                    # Example: local_tz.localize(naive_dt).astimezone(timezone.utc).isoformat()
-                                    converted_utc_timestamp = naive_dt.isoformat() 
-
-                                except ValueError as ve:
-                                    logging.error(f"Error parsing time_stamp '{timestamp_api_str}' for ps_key {device_api_ps_key}: {ve}. Skipping record.")
-                                    continue
-                                
-                                row_data = {
-                                    "device_ps_key": device_api_ps_key, # Use the key from the API response
-                                    "timestamp": converted_utc_timestamp,
-                                }
-                                for key, value in point_data_item.items():
-                                    if key.lower() != "time_stamp": # Exclude the original time_stamp
-                                        row_data[key] = value
-                                
-                                supabase_data_to_insert.append(row_data)
-                        
-                        if supabase_data_to_insert:
-                            try:
-                                logging.info(f"Attempting to upsert {len(supabase_data_to_insert)} records to isolarcloud_historical_data.")
-                                response = supabase_client.table("isolarcloud_historical_data") \
-                                                          .upsert(supabase_data_to_insert, on_conflict='device_ps_key,timestamp') \
-                                                          .execute()
-                                
-                                upserted_count = 0
-                                if hasattr(response, 'data') and response.data is not None:
-                                    upserted_count = len(response.data)
-                                elif hasattr(response, 'count') and response.count is not None and (not hasattr(response, 'data') or response.data is None):
-                                    upserted_count = response.count
-                                
-                                if upserted_count > 0:
-                                    logging.info(f"Successfully upserted {upserted_count} data points.")
-                                    total_data_points_ingested += upserted_count
-                                else:
-                                    # This case can occur if all records in the batch resulted in updates due to on_conflict, 
-                                    # and the client version/response doesn't detail updated rows in 'data' or 'count'.
-                                    # Or, if no new records were inserted and no existing records were updated.
-                                    logging.info(f"Upsert call made. Response indicates {upserted_count} records were directly counted as upserted (inserted/updated). Review response if details are needed: {response}")
-
-
-                                if hasattr(response, 'error') and response.error:
-                                    logging.error(f"Supabase upsert error: {response.error}")
-
-                            except Exception as db_e:
-                                logging.error(f"Exception during Supabase upsert: {db_e}")
-                                import traceback
-                                logging.error(traceback.format_exc())
-                        else:
-                            logging.info("No data to insert into Supabase for this API data batch.")
-                            
-                    elif api_response_parsed is None: # Error already logged by _make_api_request
-                        pass 
-                    else: # This covers api_response_parsed.get("result_code") != "1"
-                        logging.warning(f"API request failed or returned unexpected data: {api_response_parsed}")
-
-    return total_data_points_ingested
-
-
-
-
-
-def fetch_historical_data_for_batch(devices_batch, day_dt_start, day_dt_end, minute_interval, supabase_client):
-    """Processes a batch of devices for a given day, fetching data in 1-hour intervals."""
+    planned_calls = plan_minute_data_calls(devices_to_fetch, start_time_dt, end_time_dt, minute_interval, _map_device_type_name_for_points,
+                                           get_batch_sizer().limits)
+    return _run_minute_data_requests(supabase_client, planned_calls, concurrency, None, writer)
+
+
+def poll_recent_minute_data(supabase_client, devices, lookback_minutes, writer, concurrency=1, minute_interval=5, solar=None):
+    """Fetches the slots missing from ``writer.storage`` over the last ``lookback_minutes`` for ``devices``.
+
+    Used by the daemon for near-real-time pulls; returns the number of rows queued on ``writer``.
+    The window ends at each station's local now (API timestamps are station-local), so devices are planned
+    per time zone. With a SolarTrimmer ``solar``, inverters and meteo stations are not polled at night.
+    """
+    utc_now = datetime.now(timezone.utc)
+    devices_by_now = {}
+    for device in devices:
+        devices_by_now.setdefault(station_now(device.get('station_location'), utc_now), []).append(device)
+    planned_calls = []
+    for end_time_dt, zone_devices in devices_by_now.items():
+        start_time_dt = (end_time_dt - timedelta(minutes=lookback_minutes)).replace(second=0, microsecond=0)
+        planned_calls.extend(plan_historical_data_batch(zone_devices, start_time_dt, end_time_dt, minute_interval, writer.storage,
+                                                        incremental=True, solar=solar))
+    if not planned_calls:
+        return 0
+    return _run_minute_data_requests(supabase_client, planned_calls, concurrency, None, writer)
+
+
+def plan_historical_data_batch(devices_batch, day_dt_start, day_dt_end, minute_interval, storage=None, incremental=False, solar=None):
+    """Returns the planned minute-data calls for a batch of devices over [day_dt_start, day_dt_end].
+
+    With ``incremental`` only the slots missing from ``storage`` are planned. With a SolarTrimmer ``solar``,
+    inverters and meteo stations are only planned for daylight (plus margin) and the saving is recorded on it.
+    """
+    windows_by_ps_key = {}
+    def _device_windows(device):
+        ps_key = device.get('device_ps_key')
+        if ps_key not in windows_by_ps_key:
+            windows_by_ps_key[ps_key] = solar.windows_for(device, day_dt_start, day_dt_end)
+        return windows_by_ps_key[ps_key]
+    windows_fn = _device_windows if solar else None
+
+    if incremental:
+        planned_calls, _ = plan_gap_calls(storage, devices_batch, day_dt_start, day_dt_end, minute_interval, _map_device_type_name_for_points,
+                                          get_batch_sizer().limits, windows_fn)
+        if solar:
+            solar.record(devices_batch, day_dt_start, day_dt_end, minute_interval, windows_fn)
+        return planned_calls
+
+    planned_calls = plan_minute_data_calls_in_windows(devices_batch, day_dt_start, day_dt_end, minute_interval, _map_device_type_name_for_points,
+                                                      get_batch_sizer().limits, windows_fn)
+    if solar:
+        untrimmed_calls = plan_minute_data_calls(devices_batch, day_dt_start, day_dt_end, minute_interval, _map_device_type_name_for_points,
+                                                 get_batch_sizer().limits)
+        solar.record(devices_batch, day_dt_start, day_dt_end, minute_interval, windows_fn, len(untrimmed_calls) - len(planned_calls))
+    return planned_calls
+
+def fetch_historical_data_for_batch(devices_batch, day_dt_start, day_dt_end, minute_interval, supabase_client, concurrency=1, journal=None, resume=False, incremental=False, writer=None, solar=None):
+    """Processes a batch of devices over a date range using the widest time windows the API permits."""
     logging.info(f"Processing day-batch: {day_dt_start.strftime('%Y-%m-%d')} for {len(devices_batch)} devices.")
-    
-    current_interval_start = day_dt_start
-    total_points_ingested_for_day_batch = 0
 
-    # day_dt_end is the end of the day (e.g., 23:59:59)
-    while current_interval_start < day_dt_end:
-        # Calculate end of the current 1-hour interval (e.g., start 00:00:00 -> end 00:59:59)
-        current_interval_end = min(current_interval_start + timedelta(hours=1) - timedelta(seconds=1), day_dt_end)
-        
-        # Ensure the interval is valid, especially for the last partial hour
-        if current_interval_end < current_interval_start:
-            # This might happen if day_dt_end was exactly on an hour boundary before subtraction, adjust to process the last second.
-             current_interval_end = current_interval_start 
-
-        logging.info(f"Fetching data for 1-hour interval: {current_interval_start.strftime('%Y-%m-%d %H:%M:%S')} to {current_interval_end.strftime('%Y-%m-%d %H:%M:%S')}")
-
-        points_ingested_for_interval = fetch_and_store_minute_data(
-            supabase_client,      # First arg for fetch_and_store_minute_data
-            devices_batch,        # Second arg
-            current_interval_start, # Third arg
-            current_interval_end,   # Fourth arg
-            minute_interval         # Fifth arg
-        )
-        if points_ingested_for_interval: # fetch_and_store_minute_data returns an int or 0
-             total_points_ingested_for_day_batch += points_ingested_for_interval
-        
-        # Move to the start of the next 1-hour interval
-        current_interval_start += timedelta(hours=1)
+    storage = writer.storage if writer else SupabaseStorage(supabase_client)
+    planned_calls = plan_historical_data_batch(devices_batch, day_dt_start, day_dt_end, minute_interval, storage, incremental, solar)
+    logging.info(f"Planned {len(planned_calls)} API calls for day-batch ({day_dt_start.strftime('%Y-%m-%d')}): {summarize_plan(planned_calls)}")
+    if journal and resume:
+        planned_calls = journal.filter_pending(planned_calls)
+
+    total_points_ingested_for_day_batch = _run_minute_data_requests(supabase_client, planned_calls, concurrency, journal, writer)
         
-    logging.info(f"Total data points ingested for day-batch ({day_dt_start.strftime('%Y-%m-%d')}): {total_points_ingested_for_day_batch}")
+    logging.info(f"Total data points queued for day-batch ({day_dt_start.strftime('%Y-%m-%d')}): {total_points_ingested_for_day_batch}")
     return total_points_ingested_for_day_batch
 
 
-def fetch_historical_data(supabase_client, start_date_str, end_date_str, ps_ids_str=None, device_types_str=None):
-    """Fetches historical data for a given date range, optionally filtered by power station IDs and device types."""
+def fetch_historical_data(supabase_client, start_date_str, end_date_str, ps_ids_str=None, device_types_str=None, concurrency=1, dry_run=False, resume=False, incremental=False, storage=None, solar_trim=SOLAR_TRIMMING, rollups=ROLLUPS):
+    """Fetches historical data for a given date range, optionally filtered by power station IDs and device types.
+
+    Every completed unit is journaled locally per sink; with ``resume`` units completed by an earlier run into
+    the same sink are skipped. Units are journaled once the writer has flushed them (see CheckpointJournal).
+    With ``incremental`` only intervals missing from the storage backend are requested. ``storage`` defaults
+    to upserting into Supabase's isolarcloud_historical_data; the device list always comes from Supabase.
+    With ``solar_trim`` inverters and meteo stations are only fetched between sunrise and sunset (plus margin).
+    With ``rollups`` the hourly/daily rollups of every station-hour written are refreshed by the writer as it flushes.
+    A ``storage`` passed in stays open (its owner closes it); a default one is closed at the end.
+    """
     if not supabase_client:
         logging.error("Supabase client not initialized. Cannot fetch historical data.")
         return
@@ -229,19 +268,22 @@ def fetch_historical_data(supabase_client, start_date_str, end_date_str, ps_ids_
     
     logging.info(f"Preparing to fetch historical data from {start_time_dt.strftime('%Y-%m-%d')} to {end_time_dt.strftime('%Y-%m-%d')}")
 
-    device_query = supabase_client.table("isolarcloud_devices").select("ps_id, device_ps_key, device_type, type_name")
-    if ps_ids_str:
-        ps_id_list = [pid.strip() for pid in ps_ids_str.split(',')]
-        if ps_id_list:
-            device_query = device_query.in_("ps_id", ps_id_list)
-    
+    owns_storage = storage is None
+    if owns_storage:
+        storage = SupabaseStorage(supabase_client)
+    solar = SolarTrimmer() if solar_trim else None
+    rollup_maintainer = None
+    journal = None
+    writer = None
     try:
-        device_response = device_query.execute()
-        if not device_response.data:
+        devices_to_process = load_device_catalog(supabase_client, _map_device_type_name_for_points)
+        if ps_ids_str:
+            ps_id_list = {pid.strip() for pid in ps_ids_str.split(',') if pid.strip()}
+            if ps_id_list:
+                devices_to_process = [dev for dev in devices_to_process if str(dev.get('ps_id')) in ps_id_list]
+        if not devices_to_process:
             logging.warning("No devices found in Supabase matching ps_id criteria (or no ps_ids specified and no devices exist).")
             return
-        
-        devices_to_process = device_response.data
 
         if device_types_str:
             logging.info(f"Filtering for device types: {device_types_str}")
@@ -249,8 +291,7 @@ def fetch_historical_data(supabase_client, start_date_str, end_date_str, ps_ids_
             
             filtered_devices_for_type = []
             for dev in devices_to_process:
-                # Use the same mapping logic as in fetch_and_store_minute_data
-                mapped_type = _map_device_type_name_for_points(dev)
+                mapped_type = dev['mapped_type']
                 if mapped_type in filter_types_input or dev.get('type_name', '').lower() in filter_types_input:
                     filtered_devices_for_type.append(dev)
             devices_to_process = filtered_devices_for_type
@@ -262,6 +303,10 @@ def fetch_historical_data(supabase_client, start_date_str, end_date_str, ps_ids_
 
         current_batch_start_dt = start_time_dt
         total_ingested_all_batches = 0
+        total_planned_calls = 0
+        journal = None if dry_run else CheckpointJournal(sink=storage.sink_id)
+        rollup_maintainer = RollupMaintainer(storage) if rollups and not dry_run else None
+        writer = None if dry_run else HistoricalDataWriter(storage, rollups=rollup_maintainer).start()
 
         while current_batch_start_dt <= end_time_dt:
             current_batch_end_dt = current_batch_start_dt + timedelta(days=DAYS_PER_HISTORICAL_BATCH - 1)
@@ -270,24 +315,52 @@ def fetch_historical_data(supabase_client, start_date_str, end_date_str, ps_ids_
             if current_batch_end_dt > end_time_dt:
                 current_batch_end_dt = end_time_dt
             
+            if dry_run:
+                planned_calls = plan_historical_data_batch(devices_to_process, current_batch_start_dt, current_batch_end_dt, 5, storage, incremental, solar)
+                logging.info(f"[dry-run] Batch {current_batch_start_dt.strftime('%Y-%m-%d')} to {current_batch_end_dt.strftime('%Y-%m-%d')}: {len(planned_calls)} API calls {summarize_plan(planned_calls)}")
+                total_planned_calls += len(planned_calls)
+                current_batch_start_dt += timedelta(days=DAYS_PER_HISTORICAL_BATCH)
+                continue
+
             logging.info(f"Fetching batch: {current_batch_start_dt.strftime('%Y-%m-%d')} to {current_batch_end_dt.strftime('%Y-%m-%d')} for {len(devices_to_process)} devices.")
             
-            batch_ingested = fetch_historical_data_for_batch(devices_to_process, current_batch_start_dt, current_batch_end_dt, 5, supabase_client)
-            logging.info(f"Batch from {current_batch_start_dt.strftime('%Y-%m-%d')} to {current_batch_end_dt.strftime('%Y-%m-%d')} complete. Ingested {batch_ingested} data points.")
+            batch_ingested = fetch_historical_data_for_batch(devices_to_process, current_batch_start_dt, current_batch_end_dt, 5, supabase_client,
+                                                             concurrency=concurrency, journal=journal, resume=resume, incremental=incremental,
+                                                             writer=writer, solar=solar)
+            logging.info(f"Batch from {current_batch_start_dt.strftime('%Y-%m-%d')} to {current_batch_end_dt.strftime('%Y-%m-%d')} complete. Queued {batch_ingested} data points.")
             total_ingested_all_batches += batch_ingested
             
             current_batch_start_dt += timedelta(days=DAYS_PER_HISTORICAL_BATCH)
             if current_batch_start_dt > end_time_dt: # More precise check for loop termination
                 break
         
-        logging.info(f"Historical data fetch fully complete. Total ingested over all batches: {total_ingested_all_batches} data points.")
+        if dry_run:
+            logging.info(f"[dry-run] {total_planned_calls} API calls planned for {len(devices_to_process)} devices; "
+                         f"{get_remaining_api_budget()} calls remain in the current hourly budget. Nothing was fetched.")
+            if solar:
+                logging.info(f"[dry-run] {solar.summary()}")
+            return
+
+        writer.close()
+        logging.info(f"Historical data fetch fully complete. Total ingested over all batches: {writer.rows_written} of {total_ingested_all_batches} queued data points.")
+        logging.info(f"Checkpoint journal {journal.path}: {journal.summary()}")
+        if solar:
+            logging.info(solar.summary())
 
     except Exception as e:
         logging.error(f"Error during historical data fetching process: {e}")
         import traceback
         logging.error(traceback.format_exc())
-
-def fetch_yesterday_data_for_all_devices(supabase_client):
+    finally:
+        # Rows already fetched are still written so that a resumed run does not need to fetch them again
+        if writer:
+            writer.close() # Also brings the rollups up to date
+        if owns_storage:
+            storage.close()
+        if journal:
+            journal.close()
+
+def fetch_yesterday_data_for_all_devices(supabase_client, concurrency=1, dry_run=False, resume=False, incremental=False, storage=None, solar_trim=SOLAR_TRIMMING, rollups=ROLLUPS):
     """Fetches all of yesterday's data for all devices stored in Supabase."""
     if not supabase_client:
         logging.error("Supabase client not initialized. Cannot fetch yesterday data.")
@@ -299,6 +372,89 @@ def fetch_yesterday_data_for_all_devices(supabase_client):
     end_date_str = start_date_str # Fetch for a single day
 
     # No ps_id or device_type filters, so they will be None (fetch all)
-    fetch_historical_data(supabase_client, start_date_str, end_date_str, None, None)
+    fetch_historical_data(supabase_client, start_date_str, end_date_str, concurrency=concurrency, dry_run=dry_run, resume=resume,
+                          incremental=incremental, storage=storage, solar_trim=solar_trim, rollups=rollups)
     logging.info("Finished fetching yesterday's data for all devices.")
 
+
+
+# Archive opened (read-only) by each --replay worker process, keyed by pid so processes never share a connection
+_replay_archive = None
+
+def _replay_rows(archive_path, request_key):
+    """Decompresses and parses one archived minute-data response; returns its rows, or None if it is unusable."""
+    global _replay_archive
+    if _replay_archive is None or _replay_archive[0] != os.getpid():
+        _replay_archive = (os.getpid(), ResponseArchive(archive_path, read_only=True))
+    body = _replay_archive[1].read_body(request_key)
+    if body is None:
+        return None
+    data = parse_minute_data_stream(io.BytesIO(body))
+    if data.get("result_code") != "1":
+        return None
+    return data["result_rows"]
+
+def replay_historical_data(storage, start_date_str=None, end_date_str=None, concurrency=1, archive_path=RESPONSE_ARCHIVE_PATH, rollups=ROLLUPS):
+    """Rebuilds historical data in ``storage`` from the local response archive without any API calls.
+
+    Archived minute-data responses (optionally only those overlapping the date range) are decompressed,
+    parsed and transformed by ``concurrency`` worker processes with the current row mapping, then written
+    in fetch order so that newer responses win. With ``rollups`` the rollups of the replayed station-hours are
+    refreshed by the writer. The archive is only read. Workers are spawned rather than forked, because the
+    writer thread may hold locks at fork time. ``storage`` is left open for its owner to close. Returns the
+    number of rows queued.
+    """
+    global _replay_archive
+    start_time_dt = end_time_dt = None
+    try:
+        if start_date_str:
+            start_time_dt = datetime.strptime(start_date_str, '%Y-%m-%d').replace(hour=0, minute=0, second=0)
+        if end_date_str:
+            end_time_dt = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+    except ValueError:
+        logging.error("Invalid date format. Please use YYYY-MM-DD.")
+        return 0
+
+    if not os.path.exists(archive_path):
+        logging.warning(f"No response archive at {archive_path}; nothing to replay.")
+        return 0
+    archive = ResponseArchive(archive_path, read_only=True)
+    try:
+        request_keys = archive.request_keys(MINUTE_DATA_ENDPOINT, start_time_dt, end_time_dt)
+        logging.info(f"Replaying {len(request_keys)} archived minute-data responses from {archive_path} ({archive.summary()}).")
+    finally:
+        archive.close()
+    if not request_keys:
+        logging.warning("No archived minute-data responses to replay.")
+        return 0
+
+    start_iso = start_time_dt.isoformat() if start_time_dt else None
+    end_iso = end_time_dt.isoformat() if end_time_dt else None
+    total_rows_queued = 0
+    unusable = 0
+    rollup_maintainer = RollupMaintainer(storage) if rollups else None
+    writer = HistoricalDataWriter(storage, rollups=rollup_maintainer).start()
+    executor = ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("spawn")) if concurrency > 1 else None
+    try:
+        replay = partial(_replay_rows, archive_path)
+        results = executor.map(replay, request_keys, chunksize=16) if executor else map(replay, request_keys)
+        for rows in results:
+            metrics.inc("isolarcloud_replay_responses_total")
+            if rows is None:
+                unusable += 1
+                continue
+            if start_iso or end_iso: # Archived windows may reach past the requested range
+                rows = [row for row in rows if (not start_iso or row["timestamp"] >= start_iso) and (not end_iso or row["timestamp"] <= end_iso)]
+            if rows:
+                writer.enqueue(rows)
+                total_rows_queued += len(rows)
+    finally:
+        if executor:
+            executor.shutdown()
+        if _replay_archive is not None and _replay_archive[0] == os.getpid(): # Opened by this process when concurrency is 1
+            _replay_archive[1].close()
+            _replay_archive = None
+        writer.close()
+    logging.info(f"Replay complete: {writer.rows_written} of {total_rows_queued} rows written from {len(request_keys)} archived responses "
+                 f"({unusable} unusable).")
+    return total_rows_queued
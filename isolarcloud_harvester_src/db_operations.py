@@ -1,18 +1,28 @@
 import logging
+import random
+import threading
 import time
-from supabase import create_client, Client
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from .config import SUPABASE_URL, SUPABASE_ANON_KEY, REQUEST_DELAY_SECONDS
+from .config import (SUPABASE_URL, SUPABASE_ANON_KEY, SUPABASE_PAGE_SIZE, WRITER_FLUSH_ROWS, WRITER_FLUSH_BYTES, WRITER_FLUSH_AGE_SECONDS,
+                     WRITER_CHUNK_ROWS, WRITER_MAX_PENDING_ROWS, WRITER_MAX_RETRIES, WRITER_RETRY_BACKOFF_SECONDS)
 from .api_client import _make_api_request
+from .sync_state import SyncHashStore
+from .device_catalog import invalidate_device_catalog
+from .metrics import metrics
 
 # Global Supabase client, to be initialized by the main script
-supabase_client: Client = None
+supabase_client = None
 
 def init_supabase_client():
-    """Initializes the Supabase client and assigns it to the global variable."""
+    """Initializes the Supabase client and assigns it to the global variable.
+
+    supabase is imported here rather than at module level: it is slow to import and not every command needs it.
+    """
     global supabase_client
     if SUPABASE_URL and SUPABASE_ANON_KEY:
         try:
+            from supabase import create_client
             supabase_client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
             logging.info("Supabase client initialized successfully.")
             return supabase_client
@@ -25,14 +35,27 @@ def init_supabase_client():
         supabase_client = None
         return None
 
-def sync_power_stations():
-    """Fetches all power stations and stores/updates them in Supabase."""
+def _log_sync_summary(label, changes, removed, force=False):
+    """Logs the inserted/updated/unchanged/removed counts of a station or device sync."""
+    logging.info(f"{label} sync summary: {len(changes['inserted'])} inserted, {len(changes['updated'])} updated, "
+                 f"{len(changes['unchanged'])} unchanged{' (re-written, --full-sync)' if force else ''}, {len(removed)} removed upstream.")
+    if removed:
+        logging.warning(f"{label} no longer returned by iSolarCloud (not deleted from Supabase): {removed}")
+
+def _rows_to_write(changes, force=False):
+    if force:
+        return changes["inserted"] + changes["updated"] + changes["unchanged"]
+    return changes["inserted"] + changes["updated"]
+
+def sync_power_stations(force=False):
+    """Fetches all power stations and stores new or changed ones in Supabase (all of them with ``force``)."""
     if not supabase_client:
         logging.error("Supabase client not initialized. Cannot sync power stations.")
         return
 
     logging.info("Starting power station synchronization...")
     all_stations = []
+    fetch_complete = True
     current_page = 1
     page_size = 20 
 
@@ -43,13 +66,14 @@ def sync_power_stations():
         }
         # Use _make_api_request from api_client module
         data = _make_api_request("/openapi/getPowerStationList", payload)
-        time.sleep(REQUEST_DELAY_SECONDS) # Ensure delay after every API call
 
         if not data:
             logging.warning(f"No data received from getPowerStationList page {current_page}. Ending sync.")
+            fetch_complete = False
             break
 
-        stations_on_page = data.get("pageList", [])
+        page_data = data.get("result_data") or {} # The page is nested in result_data like every other response
+        stations_on_page = page_data.get("pageList", [])
         if not stations_on_page:
             logging.info("No more power stations found on current page.")
             break
@@ -57,11 +81,10 @@ def sync_power_stations():
         all_stations.extend(stations_on_page)
         logging.info(f"Fetched page {current_page} with {len(stations_on_page)} power stations.")
 
-        if len(stations_on_page) < page_size or data.get("rowCount", 0) == len(all_stations):
+        if len(stations_on_page) < page_size or page_data.get("rowCount", 0) == len(all_stations):
             logging.info("All power station pages fetched.")
             break
         current_page += 1
-        # Delay is now after _make_api_request
 
     if not all_stations:
         logging.info("No power stations to sync.")
@@ -88,12 +111,27 @@ def sync_power_stations():
             "build_status": station.get("build_status"),
             "ps_type": station.get("ps_type"),
         })
+
+    hash_store = SyncHashStore()
+    changes = hash_store.diff("station", supabase_stations_data, "ps_id")
+    # Stations can only be reported as removed when the full list was fetched
+    removed = hash_store.pop_removed("station", [row["ps_id"] for row in supabase_stations_data]) if fetch_complete else []
+    _log_sync_summary("Power station", changes, removed, force)
+    supabase_stations_data = _rows_to_write(changes, force)
+    if not supabase_stations_data:
+        logging.info("All power stations are unchanged. Nothing to upsert.")
+        return
     
     try:
-        response = supabase_client.table("isolarcloud_power_stations").upsert(supabase_stations_data, on_conflict="ps_id").execute()
+        with metrics.timer("isolarcloud_storage_write_seconds", backend="supabase", table="isolarcloud_power_stations"):
+            response = supabase_client.table("isolarcloud_power_stations").upsert(supabase_stations_data, on_conflict="ps_id").execute()
         logging.info(f"Successfully synced {len(supabase_stations_data)} power stations to Supabase.")
         if hasattr(response, 'error') and response.error:
             logging.error(f"Error syncing power stations to Supabase: {response.error}")
+        else:
+            hash_store.record("station", supabase_stations_data, "ps_id")
+            invalidate_device_catalog() # The catalogue caches each station's location and time zone
+            metrics.inc("isolarcloud_rows_written_total", len(supabase_stations_data), backend="supabase", table="isolarcloud_power_stations")
     except Exception as e:
         logging.error(f"Exception during Supabase upsert for power stations. Type: {type(e)}, Exception: {e}")
         
@@ -152,13 +190,8 @@ def sync_power_stations():
         
         logging.error(f"Full exception args: {e.args}")
 
-def sync_devices(power_station_id):
-    """Fetches all devices for a given power station and stores/updates them in Supabase."""
-    if not supabase_client:
-        logging.error("Supabase client not initialized. Cannot sync devices.")
-        return
-
-    logging.info(f"Starting device synchronization for power station ID: {power_station_id}...")
+def _fetch_station_devices(power_station_id):
+    """Pages /openapi/getDeviceList for one power station. Returns (devices, complete) where complete is False if a page failed."""
     all_devices = []
     current_page = 1
     page_size = 50  
@@ -170,13 +203,13 @@ def sync_devices(power_station_id):
             "size": page_size,
         }
         data = _make_api_request("/openapi/getDeviceList", payload)
-        time.sleep(REQUEST_DELAY_SECONDS) # Ensure delay after every API call
 
         if not data:
             logging.warning(f"No data received from getDeviceList page {current_page} for ps_id {power_station_id}. Ending sync for this PS.")
-            break
+            return all_devices, False
         
-        devices_on_page = data.get("pageList", [])
+        page_data = data.get("result_data") or {}
+        devices_on_page = page_data.get("pageList", [])
         if not devices_on_page:
             logging.info(f"No more devices found for power station {power_station_id} on page {current_page}.")
             break
@@ -184,42 +217,351 @@ def sync_devices(power_station_id):
         all_devices.extend(devices_on_page)
         logging.info(f"Fetched page {current_page} with {len(devices_on_page)} devices for power station {power_station_id}.")
 
-        if len(devices_on_page) < page_size or data.get("rowCount", 0) == len(all_devices):
+        if len(devices_on_page) < page_size or page_data.get("rowCount", 0) == len(all_devices):
             logging.info(f"All device pages fetched for power station {power_station_id}.")
             break
         current_page += 1
-        # Delay is now after _make_api_request
+    return all_devices, True
+
+def _device_row(device):
+    """Maps a getDeviceList entry to an isolarcloud_devices row."""
+    return {
+        "device_ps_key": device.get("ps_key"), 
+        "ps_id": device.get("ps_id"), 
+        "device_type": device.get("device_type"),
+        "type_name": device.get("type_name"),
+        "device_sn": device.get("device_sn"),
+        "dev_status": device.get("dev_status"),
+        "factory_name": device.get("factory_name"),
+        "uuid": device.get("uuid"), 
+        "grid_connection_date": device.get("grid_connection_date"),
+        "device_name": device.get("device_name"),
+        "dev_fault_status": device.get("dev_fault_status"),
+        "rel_state": device.get("rel_state"),
+        "device_code": device.get("device_code"),
+        "device_model_id": device.get("device_model_id"),
+        "communication_dev_sn": device.get("communication_dev_sn"),
+        "device_model_code": device.get("device_model_code"),
+        "chnnl_id": device.get("chnnl_id")
+    }
 
-    if not all_devices:
-        logging.info(f"No devices to sync for power station {power_station_id}.")
+def sync_devices(power_station_id, force=False):
+    """Fetches all devices for a given power station and stores new or changed ones in Supabase (all of them with ``force``)."""
+    if not supabase_client:
+        logging.error("Supabase client not initialized. Cannot sync devices.")
         return
 
-    supabase_devices_data = []
-    for device in all_devices:
-        supabase_devices_data.append({
-            "device_ps_key": device.get("ps_key"), 
-            "ps_id": device.get("ps_id"), 
-            "device_type": device.get("device_type"),
-            "type_name": device.get("type_name"),
-            "device_sn": device.get("device_sn"),
-            "dev_status": device.get("dev_status"),
-            "factory_name": device.get("factory_name"),
-            "uuid": device.get("uuid"), 
-            "grid_connection_date": device.get("grid_connection_date"),
-            "device_name": device.get("device_name"),
-            "dev_fault_status": device.get("dev_fault_status"),
-            "rel_state": device.get("rel_state"),
-            "device_code": device.get("device_code"),
-            "device_model_id": device.get("device_model_id"),
-            "communication_dev_sn": device.get("communication_dev_sn"),
-            "device_model_code": device.get("device_model_code"),
-            "chnnl_id": device.get("chnnl_id")
-        })
+    logging.info(f"Starting device synchronization for power station ID: {power_station_id}...")
+    all_devices, fetch_complete = _fetch_station_devices(power_station_id)
+    invalidate_device_catalog()
+
+    hash_store = SyncHashStore()
+    supabase_devices_data = [_device_row(device) for device in all_devices]
+    changes = hash_store.diff("device", supabase_devices_data, "device_ps_key")
+    removed = hash_store.pop_removed("device", [row["device_ps_key"] for row in supabase_devices_data], [power_station_id]) if fetch_complete else []
+    _log_sync_summary(f"Device (ps_id {power_station_id})", changes, removed, force)
+
+    supabase_devices_data = _rows_to_write(changes, force)
+    if not supabase_devices_data:
+        logging.info(f"No new or changed devices to sync for power station {power_station_id}.")
+        return
 
     try:
-        response = supabase_client.table("isolarcloud_devices").upsert(supabase_devices_data, on_conflict="device_ps_key").execute()
+        with metrics.timer("isolarcloud_storage_write_seconds", backend="supabase", table="isolarcloud_devices"):
+            response = supabase_client.table("isolarcloud_devices").upsert(supabase_devices_data, on_conflict="device_ps_key").execute()
         logging.info(f"Successfully synced {len(supabase_devices_data)} devices for ps_id {power_station_id} to Supabase.")
         if hasattr(response, 'error') and response.error:
             logging.error(f"Error syncing devices to Supabase for ps_id {power_station_id}: {response.error}")
+        else:
+            hash_store.record("device", supabase_devices_data, "device_ps_key", "ps_id")
+            metrics.inc("isolarcloud_rows_written_total", len(supabase_devices_data), backend="supabase", table="isolarcloud_devices")
     except Exception as e:
         logging.error(f"Exception during Supabase upsert for devices (ps_id {power_station_id}): {e}")
+
+def get_power_station_ids():
+    """Returns every ps_id in isolarcloud_power_stations, paging past the PostgREST row cap."""
+    ps_ids = []
+    offset = 0
+    while True:
+        response = supabase_client.table("isolarcloud_power_stations").select("ps_id").order("ps_id") \
+                                  .range(offset, offset + SUPABASE_PAGE_SIZE - 1).execute()
+        rows = response.data or []
+        ps_ids.extend(row["ps_id"] for row in rows)
+        if len(rows) < SUPABASE_PAGE_SIZE:
+            return ps_ids
+        offset += SUPABASE_PAGE_SIZE
+
+def sync_all_devices(power_station_ids, concurrency=1, force=False):
+    """Fetches devices for many power stations concurrently and stores them with a few bulk upserts.
+
+    Station pages are fetched by a bounded thread pool under the shared API rate limit; device rows are
+    deduplicated on device_ps_key and only new or changed ones (all with ``force``) are upserted in
+    WRITER_CHUNK_ROWS-sized chunks.
+    """
+    if not supabase_client:
+        logging.error("Supabase client not initialized. Cannot sync devices.")
+        return
+
+    logging.info(f"Starting device synchronization for {len(power_station_ids)} power stations with concurrency {concurrency}...")
+    started = time.monotonic()
+
+    def fetch_timed(power_station_id):
+        station_started = time.monotonic()
+        devices, complete = _fetch_station_devices(power_station_id)
+        return devices, complete, time.monotonic() - station_started
+
+    rows_by_ps_key = {}
+    station_timings = {}
+    incomplete_stations = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="device-sync") as pool:
+        futures = {pool.submit(fetch_timed, power_station_id): power_station_id for power_station_id in power_station_ids}
+        for future in as_completed(futures):
+            power_station_id = futures[future]
+            try:
+                devices, complete, elapsed = future.result()
+            except Exception as e:
+                logging.error(f"Unexpected error fetching devices for ps_id {power_station_id}: {e}")
+                incomplete_stations.append(power_station_id)
+                continue
+            station_timings[power_station_id] = (len(devices), elapsed)
+            if not complete:
+                incomplete_stations.append(power_station_id)
+            for device in devices:
+                row = _device_row(device)
+                rows_by_ps_key[row["device_ps_key"]] = row
+
+    fetch_seconds = time.monotonic() - started
+    invalidate_device_catalog()
+    for power_station_id, (device_count, elapsed) in sorted(station_timings.items(), key=lambda item: -item[1][1]):
+        logging.info(f"ps_id {power_station_id}: {device_count} devices fetched in {elapsed:.2f}s.")
+
+    hash_store = SyncHashStore()
+    changes = hash_store.diff("device", list(rows_by_ps_key.values()), "device_ps_key")
+    complete_stations = [ps_id for ps_id in station_timings if ps_id not in incomplete_stations]
+    removed = hash_store.pop_removed("device", rows_by_ps_key.keys(), complete_stations)
+    _log_sync_summary("Device", changes, removed, force)
+
+    supabase_devices_data = _rows_to_write(changes, force)
+    upserted = 0
+    for i in range(0, len(supabase_devices_data), WRITER_CHUNK_ROWS):
+        chunk = supabase_devices_data[i:i + WRITER_CHUNK_ROWS]
+        try:
+            with metrics.timer("isolarcloud_storage_write_seconds", backend="supabase", table="isolarcloud_devices"):
+                response = supabase_client.table("isolarcloud_devices").upsert(chunk, on_conflict="device_ps_key").execute()
+            if hasattr(response, 'error') and response.error:
+                logging.error(f"Error syncing devices to Supabase: {response.error}")
+                continue
+            hash_store.record("device", chunk, "device_ps_key", "ps_id")
+            metrics.inc("isolarcloud_rows_written_total", len(chunk), backend="supabase", table="isolarcloud_devices")
+            upserted += len(chunk)
+        except Exception as e:
+            logging.error(f"Exception during Supabase bulk upsert for devices: {e}")
+
+    logging.info(f"Device sync complete: {upserted} of {len(supabase_devices_data)} devices from {len(station_timings)} stations upserted "
+                 f"(fetch {fetch_seconds:.1f}s, total {time.monotonic() - started:.1f}s).")
+    if incomplete_stations:
+        logging.warning(f"Device lists may be incomplete for {len(incomplete_stations)} stations: {incomplete_stations}")
+
+
+def _estimate_row_bytes(row):
+    """Cheap estimate of a row's JSON size, used for the writer's byte-size flush threshold."""
+    return sum(len(key) + len(str(value)) + 6 for key, value in row.items()) + 2
+
+
+class HistoricalDataWriter:
+    """Buffers isolarcloud_historical_data rows and writes them to a StorageBackend from a background thread.
+
+    Rows are deduplicated on (device_ps_key, timestamp) -- later rows for the same slot are merged
+    into the earlier one -- and flushed when the buffer reaches ``flush_rows`` rows, ``flush_bytes``
+    bytes or ``flush_age_seconds`` age. Failed chunks are retried with exponential backoff. Callers
+    only block in ``enqueue`` when more than ``max_pending_rows`` rows are waiting for the database.
+    Every stored chunk is reported to ``rollups`` (a RollupMaintainer) when given; its rollups are refreshed
+    from the writer thread after each flush (as often as the maintainer allows) and once more on ``close``.
+    """
+
+    def __init__(self, storage, flush_rows=WRITER_FLUSH_ROWS, flush_bytes=WRITER_FLUSH_BYTES, flush_age_seconds=WRITER_FLUSH_AGE_SECONDS,
+                 chunk_rows=WRITER_CHUNK_ROWS, max_pending_rows=WRITER_MAX_PENDING_ROWS,
+                 max_retries=WRITER_MAX_RETRIES, retry_backoff_seconds=WRITER_RETRY_BACKOFF_SECONDS, rollups=None):
+        self.storage = storage
+        self.rollups = rollups
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_age_seconds = flush_age_seconds
+        self.chunk_rows = chunk_rows
+        self.max_pending_rows = max_pending_rows
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        for name, value in getattr(storage, "writer_overrides", {}).items(): # e.g. larger COPY transactions for Postgres
+            setattr(self, name, value)
+
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._buffer_started = None
+        self._callbacks = []
+        self._in_flight_rows = 0
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="historical-data-writer", daemon=True)
+
+        self.rows_enqueued = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.duplicates_merged = 0
+        self.flush_count = 0
+        self.write_seconds = 0.0
+        self._started_at = None
+
+    def start(self):
+        """Starts the background flush thread."""
+        self._started_at = time.monotonic()
+        self._thread.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def enqueue(self, rows, on_flushed=None):
+        """Adds rows to the buffer. ``on_flushed(success)`` is called once the rows have been written or given up on."""
+        with self._condition:
+            while self._in_flight_rows + len(self._buffer) >= self.max_pending_rows and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise RuntimeError("HistoricalDataWriter is closed.")
+            if self._buffer_started is None:
+                self._buffer_started = time.monotonic()
+            for row in rows:
+                key = (row.get("device_ps_key"), row.get("timestamp"))
+                existing = self._buffer.get(key)
+                if existing is not None:
+                    existing.update(row)
+                    self.duplicates_merged += 1
+                else:
+                    self._buffer[key] = dict(row)
+                    self._buffer_bytes += _estimate_row_bytes(row)
+            self.rows_enqueued += len(rows)
+            if on_flushed:
+                self._callbacks.append(on_flushed)
+            if len(self._buffer) >= self.flush_rows or self._buffer_bytes >= self.flush_bytes:
+                self._condition.notify_all()
+
+    def flush(self):
+        """Blocks until everything enqueued so far has been written."""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while (self._buffer or self._callbacks or self._in_flight_rows) and self._thread.is_alive():
+                self._condition.wait()
+
+    def close(self):
+        """Flushes remaining rows and stops the background thread."""
+        if not self._thread.is_alive():
+            return
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self.rollups:
+            self._refresh_rollups(self.rollups.refresh) # Also retries station-hours whose refresh failed earlier
+        logging.info(f"Historical data writer finished: {self.rows_written} rows written, {self.rows_failed} failed, "
+                     f"{self.duplicates_merged} duplicates merged in {self.flush_count} flushes "
+                     f"({self.rows_per_second():.1f} rows/s, {self.write_seconds:.1f}s in database writes).")
+
+    def rows_per_second(self):
+        """Returns the average write throughput since the writer started."""
+        if not self._started_at:
+            return 0.0
+        elapsed = time.monotonic() - self._started_at
+        return self.rows_written / elapsed if elapsed > 0 else 0.0
+
+    def _should_flush(self):
+        if not self._buffer and not self._callbacks:
+            return False
+        if self._flush_requested or self._closed:
+            return True
+        if len(self._buffer) >= self.flush_rows or self._buffer_bytes >= self.flush_bytes:
+            return True
+        return self._buffer_started is not None and time.monotonic() - self._buffer_started >= self.flush_age_seconds
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._should_flush():
+                    if self._closed:
+                        return
+                    if self._flush_requested:
+                        # Nothing left to write for the pending flush() call
+                        self._flush_requested = False
+                        self._condition.notify_all()
+                    self._condition.wait(timeout=self.flush_age_seconds)
+                rows = list(self._buffer.values())
+                callbacks = self._callbacks
+                metrics.inc("isolarcloud_storage_write_bytes_total", self._buffer_bytes, backend=self.storage.name)
+                self._buffer = {}
+                self._buffer_bytes = 0
+                self._buffer_started = None
+                self._callbacks = []
+                self._in_flight_rows = len(rows)
+
+            success = self._write_rows(rows)
+
+            for callback in callbacks:
+                try:
+                    callback(success)
+                except Exception as e:
+                    logging.error(f"Error in historical data writer callback: {e}")
+            with self._condition:
+                self._in_flight_rows = 0
+                self._condition.notify_all()
+            if self.rollups:
+                self._refresh_rollups(self.rollups.refresh_if_due)
+
+    def _refresh_rollups(self, refresh):
+        try:
+            refresh()
+        except Exception as e:
+            logging.error(f"Error refreshing rollups: {e}")
+
+    def _write_rows(self, rows):
+        """Writes rows in chunks with homogeneous columns, so PostgREST never fills missing columns with NULL."""
+        if not rows:
+            return True
+        chunks_by_columns = {}
+        for row in rows:
+            chunks_by_columns.setdefault(frozenset(row), []).append(row)
+
+        all_ok = True
+        for column_rows in chunks_by_columns.values():
+            for i in range(0, len(column_rows), self.chunk_rows):
+                if not self._write_chunk(column_rows[i:i + self.chunk_rows]):
+                    all_ok = False
+        self.flush_count += 1
+        return all_ok
+
+    def _write_chunk(self, chunk):
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                with metrics.timer("isolarcloud_storage_write_seconds", backend=self.storage.name):
+                    self.storage.write_rows(chunk)
+                self.write_seconds += time.monotonic() - started
+                self.rows_written += len(chunk)
+                metrics.inc("isolarcloud_rows_written_total", len(chunk), backend=self.storage.name)
+                if self.rollups:
+                    self.rollups.touch(chunk)
+                logging.info(f"Successfully wrote {len(chunk)} rows to {self.storage.name} ({self.rows_per_second():.1f} rows/s overall).")
+                return True
+            except Exception as e:
+                self.write_seconds += time.monotonic() - started
+                if attempt >= self.max_retries:
+                    logging.error(f"Giving up on write of {len(chunk)} rows to {self.storage.name} after {attempt + 1} attempts: {e}")
+                    self.rows_failed += len(chunk)
+                    metrics.inc("isolarcloud_rows_failed_total", len(chunk), backend=self.storage.name)
+                    return False
+                delay = self.retry_backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logging.warning(f"Write of {len(chunk)} rows to {self.storage.name} failed ({e}); retrying in {delay:.1f}s.")
+                time.sleep(delay)
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import time
+
+from .config import DEVICE_CATALOG_PATH, DEVICE_CATALOG_TTL_SECONDS, SUPABASE_PAGE_SIZE, get_measuring_points_for_device_type
+
+_DEVICE_COLUMNS = "ps_id, device_ps_key, device_type, type_name"
+_STATION_COLUMNS = "ps_id, latitude, longitude, ps_current_time_zone"
+
+
+def _fetch_all_rows(supabase_client, table_name, columns, order_column):
+    """Reads every row of a table, paging past the PostgREST row cap."""
+    rows = []
+    offset = 0
+    while True:
+        response = supabase_client.table(table_name).select(columns).order(order_column) \
+                                  .range(offset, offset + SUPABASE_PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < SUPABASE_PAGE_SIZE:
+            return rows
+        offset += SUPABASE_PAGE_SIZE
+
+
+def _fetch_all_devices(supabase_client):
+    """Reads every isolarcloud_devices row."""
+    return _fetch_all_rows(supabase_client, "isolarcloud_devices", _DEVICE_COLUMNS, "device_ps_key")
+
+
+def _fetch_station_locations(supabase_client):
+    """Returns {ps_id: {"latitude", "longitude", "time_zone"}} from isolarcloud_power_stations."""
+    return {str(station.get("ps_id")): {"latitude": station.get("latitude"), "longitude": station.get("longitude"),
+                                        "time_zone": station.get("ps_current_time_zone")}
+            for station in _fetch_all_rows(supabase_client, "isolarcloud_power_stations", _STATION_COLUMNS, "ps_id")}
+
+
+def _read_cache(path, ttl_seconds):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    age = time.time() - cached.get("fetched_at", 0)
+    if age > ttl_seconds:
+        logging.info(f"Device catalogue cache is {age / 60:.0f} minutes old (TTL {ttl_seconds / 60:.0f}); refreshing.")
+        return None
+    return cached.get("devices")
+
+
+def _write_cache(path, devices):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"fetched_at": time.time(), "devices": devices}, f)
+    os.replace(temp_path, path)
+
+
+def load_device_catalog(supabase_client, classify, refresh=False, path=DEVICE_CATALOG_PATH, ttl_seconds=DEVICE_CATALOG_TTL_SECONDS):
+    """Returns all known devices, each annotated with ``mapped_type``, ``measuring_points`` and its station's location.
+
+    The catalogue is served from a local JSON cache while it is younger than ``ttl_seconds``;
+    otherwise (or with ``refresh``) it is reloaded from isolarcloud_devices and re-cached.
+    ``classify`` maps a device row to its measuring-point device type name.
+    """
+    if not refresh:
+        devices = _read_cache(path, ttl_seconds)
+        if devices is not None:
+            logging.info(f"Loaded {len(devices)} devices from the local device catalogue cache.")
+            return devices
+
+    devices = _fetch_all_devices(supabase_client)
+    try:
+        station_locations = _fetch_station_locations(supabase_client)
+    except Exception as e:
+        logging.warning(f"Could not load station locations; solar trimming is disabled for this run: {e}")
+        station_locations = None
+    points_by_type = {}
+    for device in devices:
+        mapped_type = classify(device)
+        if mapped_type not in points_by_type:
+            points_by_type[mapped_type] = get_measuring_points_for_device_type(mapped_type) if mapped_type != 'unknown' else []
+        device["mapped_type"] = mapped_type
+        device["measuring_points"] = points_by_type[mapped_type]
+        device["station_location"] = station_locations.get(str(device.get("ps_id"))) if station_locations is not None else None
+    if station_locations is not None: # A catalogue without locations is not cached, so the next run tries again
+        try:
+            _write_cache(path, devices)
+        except OSError as e:
+            logging.warning(f"Could not write device catalogue cache {path}: {e}")
+    logging.info(f"Loaded {len(devices)} devices from Supabase into the device catalogue.")
+    return devices
+
+
+def invalidate_device_catalog(path=DEVICE_CATALOG_PATH):
+    """Drops the cached catalogue so the next job reloads devices from Supabase."""
+    try:
+        os.remove(path)
+        logging.info("Device catalogue cache invalidated.")
+    except FileNotFoundError:
+        pass
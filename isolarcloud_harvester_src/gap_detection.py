@@ -0,0 +1,86 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+from .config import GAP_MERGE_MINUTES
+from .request_planner import plan_minute_data_calls
+from .solar import station_now
+
+
+def find_missing_windows(existing_slots, start_dt, end_dt, minute_interval):
+    """Returns inclusive (start, end) windows covering the slots in [start_dt, end_dt] that are not in ``existing_slots``.
+
+    Gaps separated by fewer than GAP_MERGE_MINUTES of stored data are merged, trading a few re-fetched
+    slots for fewer API calls.
+    """
+    step = timedelta(minutes=minute_interval)
+    merge_distance = timedelta(minutes=GAP_MERGE_MINUTES)
+    # Align to the slot grid the API reports on (e.g. :00, :05, ...)
+    slot = start_dt.replace(second=0, microsecond=0)
+    slot -= timedelta(minutes=slot.minute % minute_interval)
+    if slot < start_dt:
+        slot += step
+
+    windows = []
+    while slot <= end_dt:
+        if slot not in existing_slots:
+            if windows and slot - windows[-1][1] <= merge_distance:
+                windows[-1][1] = slot
+            else:
+                windows.append([slot, slot])
+        slot += step
+    # Each window ends just before the next slot so the API returns the final missing slot
+    return [(window_start, min(window_end + step - timedelta(seconds=1), end_dt)) for window_start, window_end in windows]
+
+
+def _intersect_windows(windows, allowed_windows):
+    """Returns the parts of the inclusive ``windows`` that fall inside the inclusive ``allowed_windows``."""
+    intersected = []
+    for window_start, window_end in windows:
+        for allowed_start, allowed_end in allowed_windows:
+            start, end = max(window_start, allowed_start), min(window_end, allowed_end)
+            if start <= end:
+                intersected.append((start, end))
+    return intersected
+
+
+def plan_gap_calls(storage, devices, start_dt, end_dt, minute_interval, classify, batch_limits=None, device_windows=None):
+    """Plans minute-data calls only for the slots missing from the storage backend.
+
+    Devices with identical gaps are planned together so they can still share ps_key batches.
+    ``device_windows(device)`` may restrict a device to some windows (e.g. daylight); None means no restriction.
+    Returns (planned_calls, missing_slot_count).
+    """
+    # Never ask for slots that cannot exist yet; API timestamps are station-local, so "now" is too
+    utc_now = datetime.now(timezone.utc)
+    device_end_dts = {device.get('device_ps_key'): min(end_dt, station_now(device.get('station_location'), utc_now)) for device in devices}
+    if not device_end_dts or max(device_end_dts.values()) < start_dt:
+        return [], 0
+
+    device_ps_keys = [device.get('device_ps_key') for device in devices]
+    coverage = storage.fetch_coverage(device_ps_keys, start_dt, max(device_end_dts.values()), minute_interval)
+
+    devices_by_gaps = {}
+    missing_slot_count = 0
+    step = timedelta(minutes=minute_interval)
+    for device in devices:
+        device_end_dt = device_end_dts[device.get('device_ps_key')]
+        if device_end_dt < start_dt:
+            continue
+        windows = find_missing_windows(coverage.get(device.get('device_ps_key'), set()), start_dt, device_end_dt, minute_interval)
+        allowed_windows = device_windows(device) if device_windows else None
+        if allowed_windows is not None:
+            windows = _intersect_windows(windows, allowed_windows)
+        windows = tuple(windows)
+        if not windows:
+            continue
+        missing_slot_count += sum(int((window_end - window_start) / step) + 1 for window_start, window_end in windows)
+        devices_by_gaps.setdefault(windows, []).append(device)
+
+    planned_calls = []
+    for windows, gap_devices in devices_by_gaps.items():
+        for window_start, window_end in windows:
+            planned_calls.extend(plan_minute_data_calls(gap_devices, window_start, window_end, minute_interval, classify, batch_limits))
+
+    logging.info(f"Gap detection: {len(devices) - sum(len(d) for d in devices_by_gaps.values())} of {len(devices)} devices fully covered, "
+                 f"~{missing_slot_count} missing slots, {len(planned_calls)} API calls planned.")
+    return planned_calls, missing_slot_count
@@ -0,0 +1,97 @@
+import logging
+import os
+import time
+
+from .config import (ISOLARCLOUD_APP_KEY, ISOLARCLOUD_SECRET_KEY, ISOLARCLOUD_USERNAME, ISOLARCLOUD_PASSWORD, SUPABASE_URL,
+                     SUPABASE_ANON_KEY, HARVESTER_STATE_DIR, RESPONSE_ARCHIVE_PATH)
+
+
+def _check_settings():
+    required = {
+        "ISOLARCLOUD_APP_KEY": ISOLARCLOUD_APP_KEY, "ISOLARCLOUD_SECRET_KEY": ISOLARCLOUD_SECRET_KEY,
+        "ISOLARCLOUD_USERNAME": ISOLARCLOUD_USERNAME, "ISOLARCLOUD_PASSWORD": ISOLARCLOUD_PASSWORD,
+        "SUPABASE_URL": SUPABASE_URL, "SUPABASE_ANON_KEY": SUPABASE_ANON_KEY,
+    }
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        raise RuntimeError(f"missing {', '.join(missing)}")
+    return "all required settings present"
+
+
+def _check_state_dir():
+    if os.path.isdir(HARVESTER_STATE_DIR):
+        if not os.access(HARVESTER_STATE_DIR, os.W_OK | os.X_OK):
+            raise RuntimeError(f"{HARVESTER_STATE_DIR} is not writable")
+        return f"{HARVESTER_STATE_DIR} is writable"
+    parent = os.path.dirname(os.path.abspath(HARVESTER_STATE_DIR))
+    while not os.path.isdir(parent): # The state directory is created on first use; check where that would happen
+        parent = os.path.dirname(parent)
+    if not os.access(parent, os.W_OK | os.X_OK):
+        raise RuntimeError(f"{HARVESTER_STATE_DIR} does not exist and {parent} is not writable")
+    return f"{HARVESTER_STATE_DIR} does not exist yet and can be created"
+
+
+def _check_supabase():
+    from .db_operations import init_supabase_client
+    client = init_supabase_client()
+    if not client:
+        raise RuntimeError("client could not be initialized")
+    client.table("isolarcloud_power_stations").select("ps_id").limit(1).execute()
+    return "isolarcloud_power_stations is readable"
+
+
+def _check_isolarcloud():
+    from .api_client import get_default_client, set_response_archiving
+    set_response_archiving(False) # Logins are never archived; this keeps the check from creating the archive file
+    client = get_default_client()
+    if not client.login():
+        raise RuntimeError("login failed")
+    return "logged in" if client.tokens.login_count else "cached token is still valid (no login needed)"
+
+
+def _check_sink(sink_spec):
+    from .db_operations import supabase_client
+    from .storage import create_storage_backend
+    storage = create_storage_backend(sink_spec, supabase_client)
+    storage.close()
+    if storage.name == "supabase" and supabase_client is None:
+        raise RuntimeError("the supabase sink needs a working Supabase client")
+    return f"{storage.name} sink opened"
+
+
+def _check_archive():
+    if not os.path.exists(RESPONSE_ARCHIVE_PATH):
+        return "no response archive yet"
+    from .response_archive import ResponseArchive
+    archive = ResponseArchive(RESPONSE_ARCHIVE_PATH, read_only=True)
+    try:
+        summary = archive.summary()
+    finally:
+        archive.close()
+    return f"{summary['responses']} archived responses, {summary['stored_bytes'] / 1e6:.1f} MB"
+
+
+def run_health_checks(sink_spec):
+    """Checks settings, local state, Supabase, the iSolarCloud login, the storage sink and the response archive.
+
+    Logs one line per check and returns True if all of them passed. The only API call made is a login,
+    and only when no cached token is valid.
+    """
+    checks = [
+        ("settings", _check_settings),
+        ("state directory", _check_state_dir),
+        ("supabase", _check_supabase),
+        ("isolarcloud", _check_isolarcloud),
+        ("sink", lambda: _check_sink(sink_spec)),
+        ("response archive", _check_archive),
+    ]
+    all_ok = True
+    for name, check in checks:
+        started = time.monotonic()
+        try:
+            detail = check()
+            logging.info(f"Check OK   {name}: {detail} ({(time.monotonic() - started) * 1000:.0f} ms)")
+        except Exception as e:
+            all_ok = False
+            logging.error(f"Check FAIL {name}: {e} ({(time.monotonic() - started) * 1000:.0f} ms)")
+    return all_ok
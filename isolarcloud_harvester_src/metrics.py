@@ -0,0 +1,172 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implicit
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_HELP = {
+    "isolarcloud_api_calls_total": "API calls by endpoint and result (result_code or failure kind).",
+    "isolarcloud_api_latency_seconds": "Latency of single API calls (one HTTP attempt).",
+    "isolarcloud_api_response_bytes_total": "Decompressed API response bytes.",
+    "isolarcloud_api_retries_total": "API call retries by endpoint and failure kind.",
+    "isolarcloud_api_backoff_seconds_total": "Time spent sleeping before API retries.",
+    "isolarcloud_rate_limiter_wait_seconds_total": "Time spent waiting for the local API rate limiter.",
+    "isolarcloud_response_parse_seconds_total": "Time spent reading and parsing minute-data responses (excluding the transform).",
+    "isolarcloud_transform_seconds_total": "Time spent converting minute-data records into rows.",
+    "isolarcloud_rows_transformed_total": "Rows produced from minute-data responses.",
+    "isolarcloud_storage_write_seconds": "Latency of one storage write (one chunk attempt).",
+    "isolarcloud_rows_written_total": "Rows written by table or storage backend.",
+    "isolarcloud_rows_failed_total": "Rows given up on after all write retries.",
+    "isolarcloud_storage_write_bytes_total": "Estimated bytes of rows sent to storage.",
+    "isolarcloud_archive_bytes_total": "Raw API response bytes written to the local response archive.",
+    "isolarcloud_replay_responses_total": "Archived responses reprocessed by --replay.",
+    "isolarcloud_rollup_refresh_seconds": "Latency of writing the rollups of one station-day.",
+    "isolarcloud_rollup_rows_upserted_total": "Hourly and daily rollup rows upserted.",
+    "isolarcloud_solar_slots_skipped_total": "Inverter/meteo device-slots skipped because they fall outside daylight.",
+    "isolarcloud_solar_calls_saved_total": "Minute-data calls saved by trimming fetch windows to daylight.",
+}
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe counters and latency histograms keyed by metric name and label set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started_at = datetime.now(timezone.utc)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the ``with`` block in histogram ``name``."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def snapshot(self):
+        """Returns all metrics as plain data (for the JSON run report)."""
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.total,
+                           "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], h.counts))}
+                          for (name, labels), h in sorted(self._histograms.items())]
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.total, h.count)) for key, h in self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(list(LATENCY_BUCKETS) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by all instrumented modules
+metrics = MetricsRegistry()
+
+
+def write_run_report(path, extra=None):
+    """Writes the current metrics plus ``extra`` (e.g. the CLI action) as a JSON run report."""
+    report = {
+        "started_at": metrics.started_at.isoformat(),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        **(extra or {}),
+        **metrics.snapshot(),
+    }
+    directory = os.path.dirname(path)
+    try:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        logging.info(f"Wrote metrics run report to {path}.")
+    except OSError as e:
+        logging.warning(f"Could not write metrics run report to {path}: {e}")
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves the metrics at http://host:port/metrics from a background thread (for Prometheus scraping)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            content = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving Prometheus metrics on http://{host}:{server.server_port}/metrics")
+    return server
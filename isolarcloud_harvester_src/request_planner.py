@@ -0,0 +1,114 @@
+import logging
+from collections import namedtuple
+from datetime import timedelta
+
+from .config import (MAX_PS_KEYS_PER_REQUEST, MAX_POINTS_PER_REQUEST, MINUTE_DATA_MAX_WINDOW_HOURS,
+                     MAX_VALUES_PER_MINUTE_DATA_RESPONSE, get_measuring_points_for_device_type)
+
+
+class PlannedCall(namedtuple("PlannedCall", ["device_type_name", "ps_keys", "points", "start_dt", "end_dt", "minute_interval"])):
+    """One planned getDevicePointMinuteDataList call. ``end_dt`` is inclusive, as the API expects."""
+    __slots__ = ()
+
+    def to_payload(self):
+        """Returns the API payload for this call (token/appkey are added by the api_client)."""
+        return {
+            "ps_key_list": list(self.ps_keys),
+            "points": ",".join(self.points), # API expects a comma-separated string
+            "start_time_stamp": self.start_dt.strftime('%Y%m%d%H%M%S'),
+            "end_time_stamp": self.end_dt.strftime('%Y%m%d%H%M%S'),
+            "minute_interval": self.minute_interval,
+        }
+
+
+def max_window_for(ps_key_count, point_count, minute_interval, max_values=MAX_VALUES_PER_MINUTE_DATA_RESPONSE):
+    """Returns the longest time span one call may cover for the given batch shape.
+
+    The span is bounded by MINUTE_DATA_MAX_WINDOW_HOURS and by the number of values
+    (ps_keys x points x slots) the gateway returns in a single response.
+    """
+    values_per_slot = max(1, ps_key_count * point_count)
+    slots_by_size = max(1, max_values // values_per_slot)
+    span_by_size = timedelta(minutes=slots_by_size * minute_interval)
+    return min(timedelta(hours=MINUTE_DATA_MAX_WINDOW_HOURS), span_by_size)
+
+
+def _split_window(start_dt, end_dt, span):
+    """Splits the inclusive [start_dt, end_dt] range into consecutive inclusive windows of at most ``span``."""
+    windows = []
+    window_start = start_dt
+    while window_start <= end_dt:
+        window_end = min(window_start + span - timedelta(seconds=1), end_dt)
+        windows.append((window_start, window_end))
+        window_start += span
+    return windows
+
+
+def group_ps_keys_by_device_type(devices, classify):
+    """Groups device_ps_keys by mapped device type across all stations, keeping stations contiguous."""
+    grouped = {}
+    for device in sorted(devices, key=lambda d: str(d.get('ps_id'))):
+        device_type_name = classify(device)
+        if device_type_name == 'unknown':
+            logging.warning(f"Skipping device with unknown type: {device.get('device_ps_key')} (ps_id {device.get('ps_id')})")
+            continue
+        grouped.setdefault(device_type_name, []).append(device.get('device_ps_key'))
+    return grouped
+
+
+def _default_batch_limits(device_type_name):
+    return MAX_PS_KEYS_PER_REQUEST, MAX_POINTS_PER_REQUEST, MAX_VALUES_PER_MINUTE_DATA_RESPONSE
+
+
+def plan_minute_data_calls(devices, start_dt, end_dt, minute_interval, classify, batch_limits=None):
+    """Plans the minimal list of getDevicePointMinuteDataList calls covering ``devices`` over [start_dt, end_dt].
+
+    ps_keys of the same device type are packed across stations up to MAX_PS_KEYS_PER_REQUEST, and each
+    (ps_key batch, point batch) is given the largest time window the endpoint permits for its shape.
+    ``classify`` maps a device row to its measuring-point device type name. ``batch_limits`` optionally
+    maps a device type name to (max ps_keys, max points, max values per response), e.g. tuned limits.
+    """
+    batch_limits = batch_limits or _default_batch_limits
+    planned_calls = []
+    for device_type_name, ps_keys in group_ps_keys_by_device_type(devices, classify).items():
+        points = get_measuring_points_for_device_type(device_type_name)
+        if not points:
+            logging.warning(f"Skipping {len(ps_keys)} {device_type_name} devices as no measuring points are defined.")
+            continue
+
+        max_ps_keys, max_points, max_values = batch_limits(device_type_name)
+        for i in range(0, len(ps_keys), max_ps_keys):
+            batched_ps_keys = tuple(ps_keys[i:i + max_ps_keys])
+            for j in range(0, len(points), max_points):
+                batched_points = tuple(points[j:j + max_points])
+                span = max_window_for(len(batched_ps_keys), len(batched_points), minute_interval, max_values)
+                for window_start, window_end in _split_window(start_dt, end_dt, span):
+                    planned_calls.append(PlannedCall(device_type_name, batched_ps_keys, batched_points,
+                                                     window_start, window_end, minute_interval))
+    return planned_calls
+
+
+def plan_minute_data_calls_in_windows(devices, start_dt, end_dt, minute_interval, classify, batch_limits=None, device_windows=None):
+    """Like plan_minute_data_calls, but each device is only covered within the windows ``device_windows(device)`` returns.
+
+    Devices for which it returns None are covered over the whole range; devices with identical windows
+    are planned together so they still share ps_key batches.
+    """
+    devices_by_windows = {}
+    for device in devices:
+        windows = device_windows(device) if device_windows else None
+        devices_by_windows.setdefault(tuple(windows) if windows is not None else None, []).append(device)
+
+    planned_calls = []
+    for windows, window_devices in devices_by_windows.items():
+        for window_start, window_end in windows if windows is not None else ((start_dt, end_dt),):
+            planned_calls.extend(plan_minute_data_calls(window_devices, window_start, window_end, minute_interval, classify, batch_limits))
+    return planned_calls
+
+
+def summarize_plan(planned_calls):
+    """Returns a {device_type_name: call_count} summary of a plan."""
+    summary = {}
+    for call in planned_calls:
+        summary[call.device_type_name] = summary.get(call.device_type_name, 0) + 1
+    return summary
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+try:
+    import zstandard # Optional: better ratio and faster than zlib
+except ImportError:
+    zstandard = None
+
+from .config import RESPONSE_ARCHIVE_PATH, RESPONSE_ARCHIVE_RETENTION_DAYS, RESPONSE_ARCHIVE_ZLIB_LEVEL, RESPONSE_ARCHIVE_ZSTD_LEVEL
+
+PRUNE_INTERVAL_SECONDS = 3600 # How often a writing archive drops entries past their retention
+
+# Never part of the archive key: they change per login/deployment, not with the data requested
+_VOLATILE_PAYLOAD_FIELDS = ("token", "appkey")
+
+
+def normalize_payload(payload):
+    """Returns ``payload`` without token/appkey and with ps_key/point lists in a canonical order."""
+    normalized = {key: value for key, value in payload.items() if key not in _VOLATILE_PAYLOAD_FIELDS}
+    if isinstance(normalized.get("ps_key_list"), list):
+        normalized["ps_key_list"] = sorted(str(ps_key) for ps_key in normalized["ps_key_list"])
+    if isinstance(normalized.get("points"), str):
+        normalized["points"] = ",".join(sorted(normalized["points"].split(",")))
+    return normalized
+
+
+def request_key(endpoint, payload):
+    """Returns (archive key, normalized payload JSON) for a request: sha256 of the endpoint and normalized payload."""
+    payload_json = json.dumps(normalize_payload(payload), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{endpoint}\n{payload_json}".encode("utf-8")).hexdigest(), payload_json
+
+
+class ArchivedBody:
+    """Compresses a response body chunk by chunk while hashing it, so streamed responses are never held whole."""
+
+    def __init__(self):
+        if zstandard:
+            self.codec = "zstd"
+            self._compressor = zstandard.ZstdCompressor(level=RESPONSE_ARCHIVE_ZSTD_LEVEL).compressobj()
+        else:
+            self.codec = "zlib"
+            self._compressor = zlib.compressobj(RESPONSE_ARCHIVE_ZLIB_LEVEL)
+        self._hash = hashlib.sha256()
+        self._parts = []
+        self.raw_bytes = 0
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self.raw_bytes += len(chunk)
+        compressed = self._compressor.compress(chunk)
+        if compressed:
+            self._parts.append(compressed)
+
+    def finish(self):
+        """Returns (sha256 of the raw body, compressed body)."""
+        self._parts.append(self._compressor.flush())
+        return self._hash.hexdigest(), b"".join(self._parts)
+
+
+def _decompress(codec, data):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This archive entry is zstd-compressed; install the 'zstandard' package to read it.")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError(f"Unknown archive codec {codec!r}")
+
+
+class ResponseArchive:
+    """Local SQLite archive of raw API response bodies, compressed and content-addressed.
+
+    ``responses`` maps a request key (endpoint + normalized payload, see ``request_key``) to the sha256
+    of its latest raw body; ``bodies`` stores each distinct body once. Re-fetching the same request
+    replaces its entry, so the archive always holds the newest answer per request. While responses are
+    being archived, entries fetched more than ``retention_days`` ago are pruned about once an hour.
+    With ``read_only`` an existing archive is opened without creating or changing anything.
+    """
+
+    def __init__(self, path=RESPONSE_ARCHIVE_PATH, retention_days=RESPONSE_ARCHIVE_RETENTION_DAYS, read_only=False):
+        self.path = path
+        self.retention_days = retention_days
+        self._next_prune = 0.0
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL") # Only takes effect for a new archive file
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS bodies (
+                body_hash TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                raw_bytes INTEGER NOT NULL,
+                body BLOB NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                request_key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                start_time_stamp TEXT,
+                end_time_stamp TEXT,
+                body_hash TEXT NOT NULL REFERENCES bodies(body_hash),
+                fetched_at TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_by_endpoint ON responses (endpoint, start_time_stamp)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_by_fetched_at ON responses (fetched_at)")
+
+    def put(self, endpoint, payload, body):
+        """Archives ``body`` (an ArchivedBody, or raw bytes) as the response to ``payload`` at ``endpoint``."""
+        if not isinstance(body, ArchivedBody):
+            raw, body = body, ArchivedBody()
+            body.write(raw)
+        body_hash, compressed = body.finish()
+        key, payload_json = request_key(endpoint, payload)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("INSERT OR IGNORE INTO bodies (body_hash, codec, raw_bytes, body) VALUES (?, ?, ?, ?)",
+                                   (body_hash, body.codec, body.raw_bytes, compressed))
+                self._conn.execute("""
+                    INSERT OR REPLACE INTO responses (request_key, endpoint, payload, start_time_stamp, end_time_stamp, body_hash, fetched_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (key, endpoint, payload_json, payload.get("start_time_stamp"), payload.get("end_time_stamp"), body_hash,
+                      datetime.now(timezone.utc).isoformat()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if self.retention_days and time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + PRUNE_INTERVAL_SECONDS
+            try:
+                self.prune()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not prune the response archive {self.path}: {e}")
+        return key
+
+    def prune(self, retention_days=None):
+        """Drops responses fetched more than ``retention_days`` (default: the archive's) ago and the bodies left unused.
+
+        Returns the number of responses dropped. Freed pages are reused, and returned to the OS for archives
+        created with incremental auto-vacuum.
+        """
+        retention_days = self.retention_days if retention_days is None else retention_days
+        if not retention_days:
+            return 0
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                dropped = self._conn.execute("DELETE FROM responses WHERE fetched_at < ?", (cutoff,)).rowcount
+                if dropped:
+                    self._conn.execute("DELETE FROM bodies WHERE body_hash NOT IN (SELECT body_hash FROM responses)")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if dropped:
+                self._conn.execute("PRAGMA incremental_vacuum")
+        if dropped:
+            logging.info(f"Pruned {dropped} archived responses older than {retention_days} days from {self.path}.")
+        return dropped
+
+    def read_body(self, key):
+        """Returns the raw (decompressed) body archived under request key ``key``, or None."""
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT bodies.codec, bodies.body FROM responses JOIN bodies USING (body_hash) WHERE responses.request_key = ?
+            """, (key,)).fetchone()
+        return _decompress(*row) if row else None
+
+    def request_keys(self, endpoint, start_dt=None, end_dt=None):
+        """Returns the request keys archived for ``endpoint`` in fetch order, optionally only those overlapping [start_dt, end_dt]."""
+        query = "SELECT request_key FROM responses WHERE endpoint = ?"
+        params = [endpoint]
+        if start_dt is not None:
+            query += " AND end_time_stamp >= ?"
+            params.append(start_dt.strftime('%Y%m%d%H%M%S'))
+        if end_dt is not None:
+            query += " AND start_time_stamp <= ?"
+            params.append(end_dt.strftime('%Y%m%d%H%M%S'))
+        with self._lock:
+            return [row[0] for row in self._conn.execute(query + " ORDER BY fetched_at", params)]
+
+    def summary(self):
+        """Returns entry, distinct-body, raw and compressed byte counts."""
+        with self._lock:
+            responses = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            bodies, raw_bytes, stored_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(LENGTH(body)), 0) FROM bodies").fetchone()
+        return {"responses": responses, "bodies": bodies, "raw_bytes": raw_bytes, "stored_bytes": stored_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Process-wide archive used by the api_client
+_default_archive = None
+_default_archive_lock = threading.Lock()
+
+def get_response_archive():
+    """Returns the shared ResponseArchive, opening it on first use."""
+    global _default_archive
+    with _default_archive_lock:
+        if _default_archive is None:
+            _default_archive = ResponseArchive()
+        return _default_archive
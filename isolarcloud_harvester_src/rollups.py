@@ -0,0 +1,188 @@
+"""Hourly and daily rollups of isolarcloud_historical_data, per device and per station.
+
+Both tables have the same long format, one row per entity, point and period, so adding rollup points
+in DEVICE_TYPE_MEASURING_POINTS needs no schema change:
+
+    CREATE TABLE isolarcloud_rollups_hourly (      -- and isolarcloud_rollups_daily
+        scope text NOT NULL,                       -- 'device' or 'station'
+        entity_id text NOT NULL,                   -- device_ps_key or ps_id
+        ps_id text NOT NULL,
+        device_type text,
+        point text NOT NULL,
+        period_start timestamp NOT NULL,           -- station-local, like the raw timestamps
+        value_sum double precision, value_avg double precision,
+        value_min double precision, value_max double precision, value_count integer,
+        PRIMARY KEY (scope, entity_id, point, period_start)
+    );
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .config import ROLLUP_POINT_TYPES, ROLLUP_HOURLY_TABLE, ROLLUP_DAILY_TABLE
+from .storage import _ps_id_from_ps_key, _to_float_or_none
+from .metrics import metrics
+
+
+def _add(aggregates, key, total, minimum, maximum, count):
+    aggregate = aggregates.get(key)
+    if aggregate is None:
+        aggregates[key] = [total, minimum, maximum, count]
+    else:
+        aggregate[0] += total
+        aggregate[1] = min(aggregate[1], minimum)
+        aggregate[2] = max(aggregate[2], maximum)
+        aggregate[3] += count
+
+
+def _rollup_rows(aggregates, ps_id):
+    """Turns {(scope, entity_id, point, period_start): [sum, min, max, count]} into rollup table rows."""
+    return [{"scope": scope, "entity_id": entity_id, "ps_id": str(ps_id), "device_type": ROLLUP_POINT_TYPES.get(point),
+             "point": point, "period_start": period_start.isoformat(), "value_sum": total, "value_avg": total / count,
+             "value_min": minimum, "value_max": maximum, "value_count": count}
+            for (scope, entity_id, point, period_start), (total, minimum, maximum, count) in aggregates.items()]
+
+
+def compute_hourly_rollups(rows, ps_id):
+    """Aggregates raw rows of one station into hourly rollup rows for the ROLLUP_POINT_TYPES points."""
+    aggregates = {}
+    for row in rows:
+        period_start = row["timestamp"].replace(minute=0, second=0, microsecond=0)
+        device_ps_key = str(row["device_ps_key"])
+        for point in ROLLUP_POINT_TYPES:
+            value = _to_float_or_none(row.get(point))
+            if value is None:
+                continue
+            for entity in (("device", device_ps_key), ("station", str(ps_id))):
+                _add(aggregates, (*entity, point, period_start), value, value, value, 1)
+    return _rollup_rows(aggregates, ps_id)
+
+
+def daily_rollups_from_hourly(hourly_rows, ps_id):
+    """Combines hourly rollup rows (sums, extremes and counts) into daily rollup rows."""
+    aggregates = {}
+    for row in hourly_rows:
+        period_start = row["period_start"]
+        if not isinstance(period_start, datetime):
+            period_start = datetime.fromisoformat(str(period_start))
+        count = int(row["value_count"] or 0)
+        if not count:
+            continue
+        _add(aggregates, (row["scope"], str(row["entity_id"]), row["point"], period_start.replace(hour=0)),
+             _to_float_or_none(row["value_sum"]), _to_float_or_none(row["value_min"]), _to_float_or_none(row["value_max"]), count)
+    return _rollup_rows(aggregates, ps_id)
+
+
+class RollupMaintainer:
+    """Keeps the rollup tables in step with the raw rows written to a StorageBackend.
+
+    HistoricalDataWriter reports every stored chunk through ``touch``; ``refresh`` then recomputes only the
+    touched station-hours from the raw rows stored for them, so re-ingested or gap-filled slots are never
+    counted twice, and rebuilds each affected day from its hourly rollups. Hours that fail stay queued for
+    the next refresh. The writer calls ``refresh_if_due`` after each flush, at most every ``refresh_interval_seconds``.
+    """
+
+    def __init__(self, storage, refresh_interval_seconds=0):
+        self.storage = storage
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self._next_refresh = 0.0
+        self.enabled = storage.supports_rollups
+        if not self.enabled:
+            logging.info(f"The {storage.name} sink does not support rollup tables; rollups are not maintained.")
+        else:
+            try:
+                for table_name in (ROLLUP_HOURLY_TABLE, ROLLUP_DAILY_TABLE):
+                    storage.check_table(table_name)
+            except Exception as e:
+                logging.error(f"Rollup tables are not usable ({e}); create them with the DDL in rollups.py. Rollups are not maintained.")
+                self.enabled = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._touched = set() # (ps_id, "YYYY-MM-DDTHH")
+        self.station_days_refreshed = 0
+        self.rows_upserted = 0
+
+    def touch(self, rows):
+        """Marks the station-hours of ``rows`` for the next refresh."""
+        if not self.enabled:
+            return
+        station_hours = {(_ps_id_from_ps_key(row.get("device_ps_key")), str(row.get("timestamp"))[:13].replace(" ", "T")) for row in rows}
+        with self._lock:
+            self._touched |= station_hours
+
+    def touch_range(self, ps_ids, start_date, end_date):
+        """Marks every hour from ``start_date`` to ``end_date`` (dates) of ``ps_ids`` for the next refresh."""
+        day = start_date
+        with self._lock:
+            while day <= end_date:
+                self._touched.update((str(ps_id), f"{day.isoformat()}T{hour:02d}") for ps_id in ps_ids for hour in range(24))
+                day += timedelta(days=1)
+
+    def refresh_if_due(self):
+        """Refreshes when ``refresh_interval_seconds`` have passed since the last due refresh."""
+        if not self.enabled or time.monotonic() < self._next_refresh:
+            return 0
+        self._next_refresh = time.monotonic() + self.refresh_interval_seconds
+        return self.refresh()
+
+    def refresh(self):
+        """Recomputes the rollups of every touched station-hour and their days. Returns the number of station-days refreshed."""
+        if not self.enabled:
+            return 0
+        with self._refresh_lock:
+            with self._lock:
+                touched, self._touched = self._touched, set()
+            hours_by_station_day = {}
+            for ps_id, hour in touched:
+                hours_by_station_day.setdefault((ps_id, hour[:10]), []).append(hour)
+            refreshed = 0
+            for (ps_id, date_str), hours in sorted(hours_by_station_day.items()):
+                try:
+                    self._refresh_station_hours(ps_id, date_str, sorted(hours))
+                    refreshed += 1
+                except Exception as e:
+                    logging.error(f"Could not refresh rollups for station {ps_id} on {date_str}: {e}")
+                    with self._lock:
+                        self._touched.update((ps_id, hour) for hour in hours)
+            if refreshed:
+                logging.info(f"Refreshed hourly/daily rollups for {refreshed} station-days ({len(touched)} station-hours).")
+            return refreshed
+
+    def _refresh_station_hours(self, ps_id, date_str, hours):
+        hour_starts = [datetime.strptime(hour, '%Y-%m-%dT%H') for hour in hours]
+        touched_hours = set(hour_starts)
+        rows = self.storage.fetch_rows(ps_id, hour_starts[0], hour_starts[-1] + timedelta(minutes=59, seconds=59),
+                                       ["device_ps_key", "timestamp", *ROLLUP_POINT_TYPES])
+        hourly_rows = compute_hourly_rollups([row for row in rows if row["timestamp"].replace(minute=0, second=0, microsecond=0) in touched_hours], ps_id)
+        with metrics.timer("isolarcloud_rollup_refresh_seconds", backend=self.storage.name):
+            if hourly_rows:
+                self.storage.upsert_rollups(ROLLUP_HOURLY_TABLE, hourly_rows)
+            if len(touched_hours) == 24:
+                day_hourly_rows = hourly_rows # The whole day was just recomputed
+            else:
+                day_start = datetime.strptime(date_str, '%Y-%m-%d')
+                day_hourly_rows = self.storage.fetch_rollups(ROLLUP_HOURLY_TABLE, ps_id, day_start, day_start.replace(hour=23))
+            daily_rows = daily_rollups_from_hourly(day_hourly_rows, ps_id)
+            if daily_rows:
+                self.storage.upsert_rollups(ROLLUP_DAILY_TABLE, daily_rows)
+        self.station_days_refreshed += 1
+        self.rows_upserted += len(hourly_rows) + len(daily_rows)
+        metrics.inc("isolarcloud_rollup_rows_upserted_total", len(hourly_rows) + len(daily_rows), backend=self.storage.name)
+
+
+def rebuild_rollups(storage, ps_ids, start_date_str, end_date_str):
+    """Recomputes the rollups of ``ps_ids`` for every day from start to end (YYYY-MM-DD), e.g. after a backfill."""
+    try:
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+    except ValueError:
+        logging.error("Invalid date format. Please use YYYY-MM-DD.")
+        return 0
+    rollups = RollupMaintainer(storage)
+    if not rollups.enabled:
+        return 0
+    rollups.touch_range(ps_ids, start_date, end_date)
+    refreshed = rollups.refresh()
+    logging.info(f"Rebuilt rollups for {refreshed} station-days ({rollups.rows_upserted} rollup rows) from {start_date_str} to {end_date_str}.")
+    return refreshed
@@ -0,0 +1,137 @@
+import math
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from .config import SOLAR_MARGIN_MINUTES, SOLAR_TRIMMED_DEVICE_TYPES
+from .metrics import metrics
+
+_UTC_OFFSET_PATTERN = re.compile(r"([+-])\s*(\d{1,2})(?::?(\d{2}))?")
+
+
+def parse_utc_offset_hours(time_zone, longitude=None):
+    """Parses iSolarCloud's ps_current_time_zone ("GMT+8", "UTC+05:30", "GMT-3", ...) into hours east of UTC.
+
+    Falls back to the nominal offset of ``longitude`` when the time zone is missing or unreadable.
+    """
+    if time_zone:
+        match = _UTC_OFFSET_PATTERN.search(str(time_zone))
+        if match:
+            hours = int(match.group(2)) + int(match.group(3) or 0) / 60
+            return hours if match.group(1) == "+" else -hours
+        if str(time_zone).strip().upper() in ("GMT", "UTC", "Z"):
+            return 0.0
+    if longitude is not None:
+        return round(float(longitude) / 15)
+    return None
+
+
+def station_now(location, utc_now=None):
+    """Returns the current naive local time at a station (a device's ``station_location``), the clock API timestamps use.
+
+    Falls back to the host's local time when neither the station's time zone nor its longitude is known.
+    """
+    utc_offset = parse_utc_offset_hours(location.get("time_zone"), location.get("longitude")) if location else None
+    if utc_offset is None:
+        return datetime.now()
+    return (utc_now or datetime.now(timezone.utc)).replace(tzinfo=None) + timedelta(hours=utc_offset)
+
+
+@lru_cache(maxsize=16384)
+def sun_times(latitude, longitude, day, utc_offset_hours):
+    """Returns (sunrise, sunset) as naive local datetimes for ``day`` (NOAA approximation, ~1-2 minutes).
+
+    Returns (None, None) during polar night and the whole day during polar day. Cached per station and date.
+    """
+    gamma = 2 * math.pi / 365 * (day.timetuple().tm_yday - 1)
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+                                 - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+    declination = (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma) - 0.006758 * math.cos(2 * gamma)
+                   + 0.000907 * math.sin(2 * gamma) - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+    lat = math.radians(latitude)
+    cos_hour_angle = (math.cos(math.radians(90.833)) / (math.cos(lat) * math.cos(declination))
+                      - math.tan(lat) * math.tan(declination))
+    midnight = datetime(day.year, day.month, day.day)
+    if cos_hour_angle > 1:
+        return None, None # Polar night
+    if cos_hour_angle < -1:
+        return midnight, midnight + timedelta(days=1) - timedelta(seconds=1) # Polar day
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    local_noon_offset = utc_offset_hours * 60 - equation_of_time
+    sunrise_minutes = 720 - 4 * (longitude + hour_angle) + local_noon_offset
+    sunset_minutes = 720 - 4 * (longitude - hour_angle) + local_noon_offset
+    return midnight + timedelta(minutes=sunrise_minutes), midnight + timedelta(minutes=sunset_minutes)
+
+
+class SolarTrimmer:
+    """Trims fetch windows of solar-only device types (inverters, meteo stations) to daylight plus a margin.
+
+    Devices need the ``station_location`` added by the device catalogue; devices without one, and device
+    types outside ``trimmed_types`` (e.g. meters), keep the full window. Windows are widened to whole hours
+    so nearby stations share windows and can still be batched together. Savings are counted for the run summary.
+    """
+
+    def __init__(self, margin_minutes=SOLAR_MARGIN_MINUTES, trimmed_types=SOLAR_TRIMMED_DEVICE_TYPES):
+        self.margin = timedelta(minutes=margin_minutes)
+        self.trimmed_types = frozenset(trimmed_types)
+        self.slots_requested = 0
+        self.slots_skipped = 0
+        self.calls_saved = 0
+
+    def _daylight_window(self, location, day):
+        latitude, longitude = location.get("latitude"), location.get("longitude")
+        if latitude is None or longitude is None:
+            return False # Unknown location: no trimming
+        utc_offset = parse_utc_offset_hours(location.get("time_zone"), longitude)
+        sunrise, sunset = sun_times(round(float(latitude), 2), round(float(longitude), 2), day, utc_offset)
+        if sunrise is None:
+            return None
+        midnight = datetime(day.year, day.month, day.day)
+        window_start = max(midnight, (sunrise - self.margin).replace(minute=0, second=0, microsecond=0))
+        window_end = sunset + self.margin
+        if window_end.minute or window_end.second or window_end.microsecond:
+            window_end = window_end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        window_end = min(midnight + timedelta(days=1), window_end) - timedelta(seconds=1)
+        return window_start, window_end
+
+    def windows_for(self, device, start_dt, end_dt):
+        """Returns the daylight windows of ``device`` within [start_dt, end_dt], or None if it is fetched around the clock."""
+        location = device.get("station_location")
+        if device.get("mapped_type") not in self.trimmed_types or not location:
+            return None
+        windows = []
+        day = start_dt.date()
+        while day <= end_dt.date():
+            daylight = self._daylight_window(location, day)
+            if daylight is False:
+                return None
+            if daylight is not None:
+                window_start, window_end = max(daylight[0], start_dt), min(daylight[1], end_dt)
+                if window_start <= window_end:
+                    windows.append((window_start, window_end))
+            day += timedelta(days=1)
+        return windows
+
+    def record(self, devices, start_dt, end_dt, minute_interval, device_windows, calls_saved=0):
+        """Counts requested vs. skipped slots for the devices whose windows were trimmed."""
+        step = timedelta(minutes=minute_interval)
+        full_slots = int((end_dt - start_dt) / step) + 1
+        requested = skipped = 0
+        for device in devices:
+            windows = device_windows(device)
+            if windows is None:
+                continue
+            kept = sum(int((window_end - window_start) / step) + 1 for window_start, window_end in windows)
+            requested += full_slots
+            skipped += max(0, full_slots - kept)
+        self.slots_requested += requested
+        self.slots_skipped += skipped
+        self.calls_saved += calls_saved
+        metrics.inc("isolarcloud_solar_slots_skipped_total", skipped)
+        metrics.inc("isolarcloud_solar_calls_saved_total", calls_saved)
+
+    def summary(self):
+        """One-line summary of what trimming saved so far."""
+        share = self.slots_skipped / self.slots_requested * 100 if self.slots_requested else 0.0
+        return (f"Solar trimming skipped {self.slots_skipped} of {self.slots_requested} inverter/meteo device-slots ({share:.1f}%) "
+                f"and saved {self.calls_saved} API calls.")
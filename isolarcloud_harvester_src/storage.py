@@ -0,0 +1,479 @@
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from .config import (MAX_PS_KEYS_PER_REQUEST, SUPABASE_PAGE_SIZE, SUPABASE_COVERAGE_FUNCTION, PARQUET_COMPRESSION, POSTGRES_DSN, POSTGRES_POOL_SIZE,
+                     POSTGRES_CONNECT_TIMEOUT_SECONDS, POSTGRES_COPY_ROWS, POSTGRES_FLUSH_BYTES, ROLLUP_KEY_COLUMNS, WRITER_CHUNK_ROWS)
+
+
+class StorageBackend:
+    """Destination for isolarcloud_historical_data rows used by HistoricalDataWriter.
+
+    ``write_rows`` must either store every row or raise; the writer handles retries.
+    ``writer_overrides`` replaces HistoricalDataWriter settings (e.g. larger flushes) for this backend.
+    ``sink_id`` identifies the destination (backend, location and table) without credentials, e.g. for the checkpoint journal.
+    Backends with ``supports_rollups`` also implement ``fetch_rows``, ``fetch_rollups``, ``upsert_rollups`` and ``check_table``.
+    """
+
+    name = "storage"
+    sink_id = "storage"
+    writer_overrides = {}
+    supports_rollups = False
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def fetch_coverage(self, device_ps_keys, start_dt, end_dt, minute_interval=5):
+        """Returns {device_ps_key: set(naive datetime)} of the slots already stored between start_dt and end_dt."""
+        raise NotImplementedError
+
+    def fetch_rows(self, ps_id, start_dt, end_dt, columns):
+        """Returns the stored rows of station ``ps_id`` between start_dt and end_dt (``timestamp`` as naive datetime)."""
+        raise NotImplementedError
+
+    def fetch_rollups(self, table_name, ps_id, start_dt, end_dt):
+        """Returns the rollup rows of station ``ps_id`` in ``table_name`` with period_start between start_dt and end_dt."""
+        raise NotImplementedError
+
+    def upsert_rollups(self, table_name, rows):
+        """Upserts rollup rows into ``table_name`` on ROLLUP_KEY_COLUMNS."""
+        raise NotImplementedError
+
+    def check_table(self, table_name):
+        """Raises if ``table_name`` does not exist or cannot be read."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _parse_stored_timestamp(value):
+    """Parses a stored timestamp into the naive datetime the harvester writes."""
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+class SupabaseStorage(StorageBackend):
+    """Upserts rows into a Supabase table through PostgREST.
+
+    ``fetch_coverage`` calls the SUPABASE_COVERAGE_FUNCTION SQL function, which returns the stored slots
+    as runs of consecutive slots, so incremental planning reads one row per run instead of one per slot:
+
+        CREATE FUNCTION isolarcloud_historical_coverage(ps_keys text[], start_ts timestamp, end_ts timestamp, step_minutes integer)
+        RETURNS TABLE (device_ps_key text, range_start timestamp, range_end timestamp)
+        LANGUAGE sql STABLE AS $$
+            SELECT device_ps_key, min("timestamp"), max("timestamp")
+            FROM (SELECT device_ps_key, "timestamp",
+                         "timestamp" - make_interval(mins => step_minutes) * row_number() OVER (PARTITION BY device_ps_key ORDER BY "timestamp") AS run
+                  FROM isolarcloud_historical_data
+                  WHERE device_ps_key = ANY(ps_keys) AND "timestamp" BETWEEN start_ts AND end_ts) AS slots
+            GROUP BY device_ps_key, run
+        $$;
+
+    Without the function every stored slot is paged through instead.
+    """
+
+    name = "supabase"
+    supports_rollups = True
+
+    def __init__(self, supabase_client, table_name="isolarcloud_historical_data", on_conflict="device_ps_key,timestamp"):
+        self.supabase_client = supabase_client
+        self.table_name = table_name
+        self.on_conflict = on_conflict
+        self._coverage_function = SUPABASE_COVERAGE_FUNCTION
+        self.sink_id = f"supabase:{str(getattr(supabase_client, 'supabase_url', '')).rstrip('/')}/{table_name}"
+
+    def write_rows(self, rows):
+        response = self.supabase_client.table(self.table_name).upsert(rows, on_conflict=self.on_conflict).execute()
+        if hasattr(response, 'error') and response.error:
+            raise RuntimeError(response.error)
+
+    def fetch_coverage(self, device_ps_keys, start_dt, end_dt, minute_interval=5):
+        if self._coverage_function:
+            try:
+                return self._fetch_coverage_ranges(device_ps_keys, start_dt, end_dt, minute_interval)
+            except Exception as e:
+                if getattr(e, "code", None) not in ("PGRST202", "42883"): # Function not found / undefined function
+                    raise
+                logging.warning(f"Supabase function {self._coverage_function} does not exist (DDL in storage.py); "
+                                f"incremental planning reads every stored slot instead.")
+                self._coverage_function = None
+        return self._fetch_coverage_slots(device_ps_keys, start_dt, end_dt)
+
+    def _fetch_coverage_ranges(self, device_ps_keys, start_dt, end_dt, minute_interval):
+        coverage = {ps_key: set() for ps_key in device_ps_keys}
+        params = {"ps_keys": list(device_ps_keys), "start_ts": start_dt.isoformat(), "end_ts": end_dt.isoformat(), "step_minutes": minute_interval}
+        step = timedelta(minutes=minute_interval)
+        offset = 0
+        while True:
+            response = self.supabase_client.rpc(self._coverage_function, params) \
+                                           .order("device_ps_key").order("range_start") \
+                                           .range(offset, offset + SUPABASE_PAGE_SIZE - 1) \
+                                           .execute()
+            ranges = response.data or []
+            for stored_range in ranges:
+                slots = coverage.setdefault(stored_range["device_ps_key"], set())
+                slot = _parse_stored_timestamp(stored_range["range_start"])
+                range_end = _parse_stored_timestamp(stored_range["range_end"])
+                while slot <= range_end:
+                    slots.add(slot)
+                    slot += step
+            if len(ranges) < SUPABASE_PAGE_SIZE:
+                return coverage
+            offset += SUPABASE_PAGE_SIZE
+
+    def _fetch_coverage_slots(self, device_ps_keys, start_dt, end_dt):
+        coverage = {ps_key: set() for ps_key in device_ps_keys}
+        start_iso = start_dt.isoformat()
+        end_iso = end_dt.isoformat()
+        for i in range(0, len(device_ps_keys), MAX_PS_KEYS_PER_REQUEST):
+            ps_key_chunk = device_ps_keys[i:i + MAX_PS_KEYS_PER_REQUEST]
+            offset = 0
+            while True:
+                response = self.supabase_client.table(self.table_name) \
+                                               .select("device_ps_key, timestamp") \
+                                               .in_("device_ps_key", ps_key_chunk) \
+                                               .gte("timestamp", start_iso) \
+                                               .lte("timestamp", end_iso) \
+                                               .order("device_ps_key").order("timestamp") \
+                                               .range(offset, offset + SUPABASE_PAGE_SIZE - 1) \
+                                               .execute()
+                rows = response.data or []
+                for row in rows:
+                    coverage.setdefault(row["device_ps_key"], set()).add(_parse_stored_timestamp(row["timestamp"]))
+                if len(rows) < SUPABASE_PAGE_SIZE:
+                    break
+                offset += SUPABASE_PAGE_SIZE
+        return coverage
+
+    def fetch_rows(self, ps_id, start_dt, end_dt, columns):
+        prefix = f"{ps_id}_"
+        rows = []
+        offset = 0
+        while True:
+            response = self.supabase_client.table(self.table_name) \
+                                           .select(",".join(columns)) \
+                                           .like("device_ps_key", f"{prefix}%") \
+                                           .gte("timestamp", start_dt.isoformat()) \
+                                           .lte("timestamp", end_dt.isoformat()) \
+                                           .order("device_ps_key").order("timestamp") \
+                                           .range(offset, offset + SUPABASE_PAGE_SIZE - 1) \
+                                           .execute()
+            page = response.data or []
+            for row in page:
+                if str(row["device_ps_key"]).startswith(prefix): # "_" is a LIKE wildcard, so e.g. 1001_... also matched 100_%
+                    row["timestamp"] = _parse_stored_timestamp(row["timestamp"])
+                    rows.append(row)
+            if len(page) < SUPABASE_PAGE_SIZE:
+                return rows
+            offset += SUPABASE_PAGE_SIZE
+
+    def fetch_rollups(self, table_name, ps_id, start_dt, end_dt):
+        rows = []
+        offset = 0
+        while True:
+            response = self.supabase_client.table(table_name) \
+                                           .select("*") \
+                                           .eq("ps_id", str(ps_id)) \
+                                           .gte("period_start", start_dt.isoformat()) \
+                                           .lte("period_start", end_dt.isoformat()) \
+                                           .order("scope").order("entity_id").order("point").order("period_start") \
+                                           .range(offset, offset + SUPABASE_PAGE_SIZE - 1) \
+                                           .execute()
+            page = response.data or []
+            for row in page:
+                row["period_start"] = _parse_stored_timestamp(row["period_start"])
+            rows.extend(page)
+            if len(page) < SUPABASE_PAGE_SIZE:
+                return rows
+            offset += SUPABASE_PAGE_SIZE
+
+    def upsert_rollups(self, table_name, rows):
+        for i in range(0, len(rows), WRITER_CHUNK_ROWS):
+            response = self.supabase_client.table(table_name).upsert(rows[i:i + WRITER_CHUNK_ROWS], on_conflict=",".join(ROLLUP_KEY_COLUMNS)).execute()
+            if hasattr(response, 'error') and response.error:
+                raise RuntimeError(response.error)
+
+    def check_table(self, table_name):
+        response = self.supabase_client.table(table_name).select("*").limit(1).execute()
+        if hasattr(response, 'error') and response.error:
+            raise RuntimeError(response.error)
+
+
+def _ps_id_from_ps_key(device_ps_key):
+    """iSolarCloud ps_keys are '<ps_id>_<device_type>_<...>'."""
+    return str(device_ps_key).split("_", 1)[0]
+
+
+def _to_float_or_none(value):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _part_file_name(sequence):
+    """Part files are named by a write sequence (nanoseconds) so that sorting them by name orders them by write time."""
+    return f"part-{sequence:020d}-{uuid.uuid4().hex[:8]}.parquet"
+
+
+def _part_sequence(path):
+    """Returns the write sequence of a part file; files without one (older uuid names) fall back to their mtime."""
+    try:
+        return int(os.path.basename(path).split("-")[1])
+    except (IndexError, ValueError):
+        return os.stat(path).st_mtime_ns
+
+
+class ParquetStorage(StorageBackend):
+    """Writes rows to local Parquet files partitioned as <base>/ps_id=<ps_id>/date=<YYYY-MM-DD>/part-*.parquet.
+
+    Every flush appends new part files; ``compact`` (run on close by default) merges each partition
+    into a single file with upsert semantics: for each (device_ps_key, timestamp) the last write wins for
+    every column it contained, nulls included, like the Supabase and Postgres sinks.
+    """
+
+    name = "parquet"
+
+    def __init__(self, base_path, compression=PARQUET_COMPRESSION, compact_on_close=True):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError("The Parquet sink requires pyarrow (pip install pyarrow).") from e
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.base_path = base_path
+        self.compression = compression
+        self.compact_on_close = compact_on_close
+        self.sink_id = f"parquet:{os.path.abspath(base_path)}"
+        self._touched_partitions = set()
+        os.makedirs(base_path, exist_ok=True)
+
+    def _partition_dir(self, ps_id, date_str):
+        return os.path.join(self.base_path, f"ps_id={ps_id}", f"date={date_str}")
+
+    def _table_from_rows(self, rows):
+        columns = {}
+        for row in rows:
+            for key in row:
+                columns.setdefault(key, None)
+        arrays = {
+            "device_ps_key": self.pa.array([str(row.get("device_ps_key")) for row in rows], self.pa.string()),
+            "timestamp": self.pa.array([_parse_stored_timestamp(row.get("timestamp")) for row in rows], self.pa.timestamp("s")),
+        }
+        for column in columns:
+            if column not in arrays:
+                arrays[column] = self.pa.array([_to_float_or_none(row.get(column)) for row in rows], self.pa.float64())
+        return self.pa.table(arrays)
+
+    def write_rows(self, rows):
+        partitions = {}
+        for row in rows:
+            key = (_ps_id_from_ps_key(row.get("device_ps_key")), str(row.get("timestamp"))[:10])
+            partitions.setdefault(key, []).append(row)
+        for (ps_id, date_str), partition_rows in partitions.items():
+            directory = self._partition_dir(ps_id, date_str)
+            os.makedirs(directory, exist_ok=True)
+            final_path = os.path.join(directory, _part_file_name(time.time_ns()))
+            temp_path = final_path + ".tmp"
+            self.pq.write_table(self._table_from_rows(partition_rows), temp_path, compression=self.compression)
+            os.replace(temp_path, final_path) # Readers never see half-written files
+            self._touched_partitions.add(directory)
+
+    def _partition_parts(self, directory):
+        """Returns the partition's part files in write order."""
+        return sorted((os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".parquet")), key=_part_sequence)
+
+    def _read_partition(self, directory, columns=None):
+        parts = self._partition_parts(directory)
+        if not parts:
+            return None, parts
+        tables = [self.pq.read_table(part, columns=columns) for part in parts]
+        return self.pa.concat_tables(tables, promote_options="default"), parts
+
+    def compact(self, directories=None):
+        """Merges the part files of each partition into one deduplicated file."""
+        compacted = 0
+        for directory in sorted(directories if directories is not None else self._touched_partitions):
+            parts = self._partition_parts(directory)
+            if len(parts) < 2:
+                continue
+            tables = [self.pq.read_table(part) for part in parts]
+            merged = {}
+            for table in tables: # In write order; each part holds the columns of one (homogeneous) write
+                for row in table.to_pylist():
+                    key = (row["device_ps_key"], row["timestamp"])
+                    existing = merged.get(key)
+                    if existing is None:
+                        merged[key] = row
+                    else:
+                        existing.update(row)
+            merged_table = self.pa.Table.from_pylist(list(merged.values()), schema=self.pa.unify_schemas([table.schema for table in tables]))
+            # Keeps the newest merged part's sequence, so parts written meanwhile still sort after it
+            final_path = os.path.join(directory, _part_file_name(_part_sequence(parts[-1])))
+            temp_path = final_path + ".tmp"
+            self.pq.write_table(merged_table, temp_path, compression=self.compression)
+            os.replace(temp_path, final_path)
+            for part in parts:
+                os.remove(part)
+            compacted += 1
+        if compacted:
+            logging.info(f"Compacted {compacted} Parquet partitions under {self.base_path}.")
+        return compacted
+
+    def fetch_coverage(self, device_ps_keys, start_dt, end_dt, minute_interval=5):
+        coverage = {ps_key: set() for ps_key in device_ps_keys}
+        wanted = set(coverage)
+        for ps_id in {_ps_id_from_ps_key(ps_key) for ps_key in device_ps_keys}:
+            station_dir = os.path.join(self.base_path, f"ps_id={ps_id}")
+            if not os.path.isdir(station_dir):
+                continue
+            for partition in os.listdir(station_dir):
+                date_str = partition.split("=", 1)[-1]
+                if not (start_dt.strftime('%Y-%m-%d') <= date_str <= end_dt.strftime('%Y-%m-%d')):
+                    continue
+                table, _ = self._read_partition(os.path.join(station_dir, partition), columns=["device_ps_key", "timestamp"])
+                if table is None:
+                    continue
+                for ps_key, timestamp in zip(table.column("device_ps_key").to_pylist(), table.column("timestamp").to_pylist()):
+                    if ps_key in wanted and start_dt <= timestamp <= end_dt:
+                        coverage[ps_key].add(timestamp)
+        return coverage
+
+    def close(self):
+        if self.compact_on_close:
+            self.compact()
+
+
+class PostgresStorage(StorageBackend):
+    """Bulk-loads rows straight into Postgres, bypassing PostgREST.
+
+    Each write is one transaction on a pooled connection: the rows are streamed with COPY into a
+    session-private temporary staging table (never WAL-logged, like an UNLOGGED table, and emptied
+    on commit) and merged with a single INSERT ... ON CONFLICT (device_ps_key, timestamp).
+    """
+
+    name = "postgres"
+    supports_rollups = True
+    writer_overrides = {"flush_rows": POSTGRES_COPY_ROWS, "flush_bytes": POSTGRES_FLUSH_BYTES, "chunk_rows": POSTGRES_COPY_ROWS,
+                        "max_pending_rows": 4 * POSTGRES_COPY_ROWS}
+
+    def __init__(self, dsn, table_name="isolarcloud_historical_data", key_columns=("device_ps_key", "timestamp"),
+                 pool_size=POSTGRES_POOL_SIZE, connect_timeout=POSTGRES_CONNECT_TIMEOUT_SECONDS):
+        try:
+            from psycopg import sql
+            from psycopg.conninfo import conninfo_to_dict
+            from psycopg.rows import dict_row
+            from psycopg_pool import ConnectionPool, PoolTimeout
+        except ImportError as e:
+            raise RuntimeError("The Postgres sink requires psycopg 3 and psycopg_pool (pip install 'psycopg[binary,pool]').") from e
+        self.sql = sql
+        self.dict_row = dict_row
+        self.table_name = table_name
+        self.key_columns = tuple(key_columns)
+        params = conninfo_to_dict(dsn) # The password is left out of sink_id
+        self.sink_id = f"postgres:{params.get('host', '')}:{params.get('port', '')}/{params.get('dbname', '')}/{table_name}"
+        self.pool = ConnectionPool(dsn, min_size=1, max_size=pool_size, name="harvester-postgres", open=True)
+        try:
+            self.pool.wait(timeout=connect_timeout)
+        except PoolTimeout as e:
+            self.pool.close()
+            raise RuntimeError(f"Could not connect to Postgres within {connect_timeout}s.") from e
+
+    def _merge_statement(self, table_name, key_columns, columns):
+        sql = self.sql
+        column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+        update_columns = [column for column in columns if column not in key_columns]
+        if update_columns:
+            conflict_action = sql.SQL("DO UPDATE SET ") + sql.SQL(", ").join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column)) for column in update_columns)
+        else:
+            conflict_action = sql.SQL("DO NOTHING")
+        return sql.SQL("INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT ({keys}) {action}").format(
+            table=sql.Identifier(table_name), columns=column_list, staging=sql.Identifier(f"{table_name}_staging"),
+            keys=sql.SQL(", ").join(map(sql.Identifier, key_columns)), action=conflict_action)
+
+    def _copy_merge(self, table_name, key_columns, rows):
+        sql = self.sql
+        staging = sql.Identifier(f"{table_name}_staging")
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        with self.pool.connection() as conn: # Commits on success, rolls back (and empties the staging table) on error
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS").format(
+                    staging=staging, table=sql.Identifier(table_name)))
+                copy_statement = sql.SQL("COPY {staging} ({columns}) FROM STDIN").format(
+                    staging=staging, columns=sql.SQL(", ").join(map(sql.Identifier, columns)))
+                with cursor.copy(copy_statement) as copy:
+                    for row in rows:
+                        copy.write_row([row.get(column) for column in columns])
+                cursor.execute(self._merge_statement(table_name, key_columns, columns))
+
+    def write_rows(self, rows):
+        self._copy_merge(self.table_name, self.key_columns, rows)
+
+    def upsert_rollups(self, table_name, rows):
+        self._copy_merge(table_name, ROLLUP_KEY_COLUMNS, rows)
+
+    def fetch_rollups(self, table_name, ps_id, start_dt, end_dt):
+        query = self.sql.SQL("SELECT * FROM {table} WHERE ps_id = %s AND period_start BETWEEN %s AND %s").format(
+            table=self.sql.Identifier(table_name))
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=self.dict_row) as cursor:
+                return cursor.execute(query, (str(ps_id), start_dt, end_dt)).fetchall()
+
+    def check_table(self, table_name):
+        with self.pool.connection() as conn:
+            if conn.execute("SELECT to_regclass(%s)", (self.sql.Identifier(table_name).as_string(conn),)).fetchone()[0] is None:
+                raise RuntimeError(f"table {table_name} does not exist")
+
+    def fetch_rows(self, ps_id, start_dt, end_dt, columns):
+        sql = self.sql
+        query = sql.SQL("SELECT {columns} FROM {table} WHERE device_ps_key LIKE %s AND {timestamp} BETWEEN %s AND %s").format(
+            columns=sql.SQL(", ").join(map(sql.Identifier, columns)), table=sql.Identifier(self.table_name),
+            timestamp=sql.Identifier("timestamp"))
+        prefix_pattern = str(ps_id).replace("\\", "\\\\").replace("_", "\\_").replace("%", "\\%") + "\\_%"
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=self.dict_row) as cursor:
+                rows = cursor.execute(query, (prefix_pattern, start_dt, end_dt)).fetchall()
+        for row in rows:
+            row["timestamp"] = _parse_stored_timestamp(row["timestamp"])
+        return rows
+
+    def fetch_coverage(self, device_ps_keys, start_dt, end_dt, minute_interval=5):
+        sql = self.sql
+        coverage = {ps_key: set() for ps_key in device_ps_keys}
+        query = sql.SQL("SELECT device_ps_key, {timestamp} FROM {table} WHERE device_ps_key = ANY(%s) AND {timestamp} BETWEEN %s AND %s").format(
+            timestamp=sql.Identifier("timestamp"), table=sql.Identifier(self.table_name))
+        with self.pool.connection() as conn:
+            for ps_key, timestamp in conn.execute(query, (list(device_ps_keys), start_dt, end_dt)):
+                coverage.setdefault(ps_key, set()).add(_parse_stored_timestamp(timestamp))
+        return coverage
+
+    def close(self):
+        self.pool.close()
+
+
+def create_storage_backend(sink_spec, supabase_client=None):
+    """Builds a StorageBackend from a --sink value.
+
+    'supabase', 'parquet:/path/to/dir', 'postgres' (uses HARVESTER_POSTGRES_DSN) or a
+    'postgresql://...' connection string.
+    """
+    if not sink_spec or sink_spec == "supabase":
+        return SupabaseStorage(supabase_client)
+    if sink_spec.startswith("parquet:"):
+        base_path = sink_spec[len("parquet:"):]
+        if not base_path:
+            raise ValueError("The parquet sink needs a directory, e.g. --sink parquet:/data/isolarcloud")
+        return ParquetStorage(base_path)
+    if sink_spec == "postgres":
+        if not POSTGRES_DSN:
+            raise ValueError("The postgres sink needs HARVESTER_POSTGRES_DSN, or pass the connection string as --sink postgresql://...")
+        return PostgresStorage(POSTGRES_DSN)
+    if sink_spec.startswith(("postgres://", "postgresql://")):
+        return PostgresStorage(sink_spec)
+    raise ValueError(f"Unknown sink '{sink_spec}'. Use 'supabase', 'parquet:/path', 'postgres' or 'postgresql://...'.")
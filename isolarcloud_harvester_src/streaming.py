@@ -0,0 +1,137 @@
+import json
+import logging
+import time
+
+import requests
+
+try:
+    import ijson # Optional: parses result_data one ps_key at a time
+except ImportError:
+    ijson = None
+try:
+    import orjson # Optional: fast fallback parser working on raw bytes
+except ImportError:
+    orjson = None
+
+from .config import STREAM_CHUNK_BYTES
+from .transform import rows_from_result_data
+from .metrics import metrics
+
+_SCALAR_EVENTS = ("string", "number", "boolean", "null")
+
+
+class ResponseReader:
+    """File-like view over a streamed requests.Response that counts the (decompressed) bytes read.
+
+    Reading through ``iter_content`` keeps gzip decoding and maps read timeouts and broken
+    connections to requests exceptions, just like ``response.json()`` would. ``tee`` is called
+    with every chunk received (used to archive the raw body while it is parsed).
+    """
+
+    def __init__(self, response, chunk_size=STREAM_CHUNK_BYTES, tee=None):
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+        self._buffer = b""
+        self._tee = tee
+        self.bytes_read = 0
+
+    def _next_chunk(self):
+        chunk = next(self._chunks, None)
+        if chunk is not None and self._tee:
+            self._tee(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        if size < 0: # Joined once; growing one bytes object chunk by chunk would be quadratic
+            chunks = [self._buffer]
+            for chunk in iter(self._next_chunk, None):
+                chunks.append(chunk)
+            data, self._buffer = b"".join(chunks), b""
+        else:
+            while len(self._buffer) < size:
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                self._buffer += chunk
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+
+def _iter_result_data_ijson(stream, header):
+    """Yields (ps_key, records) from result_data as each ps_key finishes parsing; top-level scalars go into ``header``."""
+    builder = None
+    depth = 0
+    ps_key = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                yield ps_key, builder.value
+                builder = None
+        elif prefix == "result_data" and event == "map_key":
+            ps_key = value
+            builder = ijson.ObjectBuilder()
+            depth = 0
+        elif event in _SCALAR_EVENTS and prefix and "." not in prefix:
+            header[prefix] = value
+
+
+def _iter_result_data_buffered(stream, header):
+    """Fallback without ijson: parses the body at once (orjson on raw bytes when available) and releases each ps_key after use."""
+    body = stream.read()
+    parsed = orjson.loads(body) if orjson else json.loads(body)
+    del body
+    result_data = parsed.pop("result_data", None)
+    header.update(parsed)
+    if not isinstance(result_data, dict):
+        return
+    for ps_key in list(result_data):
+        yield ps_key, result_data.pop(ps_key)
+
+
+def iter_result_data(stream, header):
+    """Generator over the (ps_key, records) pairs of a getDevicePointMinuteDataList response body.
+
+    ``header`` receives the top-level fields (result_code, result_msg, ...). Malformed or truncated
+    bodies raise requests.exceptions.InvalidJSONError so they are retried like other transport errors.
+    """
+    iterate = _iter_result_data_ijson if ijson else _iter_result_data_buffered
+    try:
+        yield from iterate(stream, header)
+    except (ValueError, getattr(ijson, "JSONError", ValueError)) as e:
+        raise requests.exceptions.InvalidJSONError(f"Malformed minute-data response: {e}") from e
+
+
+def parse_minute_data_stream(stream, on_rows=None):
+    """Stream parser for getDevicePointMinuteDataList: returns the top-level fields plus ``row_count``.
+
+    Only one ps_key's raw records (with ijson installed) and rows are held in memory at a time: each
+    ps_key's rows are handed to ``on_rows`` as soon as they are transformed. Without ``on_rows`` they
+    are collected into ``result_rows`` instead.
+    """
+    header = {}
+    started = time.monotonic()
+    transform_seconds = 0.0
+    row_count = 0
+    rows = []
+    for ps_key, records in iter_result_data(stream, header):
+        transform_started = time.monotonic()
+        ps_key_rows = rows_from_result_data({ps_key: records})
+        transform_seconds += time.monotonic() - transform_started
+        row_count += len(ps_key_rows)
+        if on_rows is None:
+            rows.extend(ps_key_rows)
+        elif ps_key_rows:
+            on_rows(ps_key_rows)
+    metrics.inc("isolarcloud_transform_seconds_total", transform_seconds)
+    metrics.inc("isolarcloud_rows_transformed_total", row_count)
+    metrics.inc("isolarcloud_response_parse_seconds_total", time.monotonic() - started - transform_seconds)
+    header["row_count"] = row_count
+    if on_rows is None:
+        header["result_rows"] = rows
+    logging.debug(f"Streamed minute-data response: result_code {header.get('result_code')}, {row_count} rows.")
+    return header
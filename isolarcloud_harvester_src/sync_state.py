@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from .config import SYNC_HASH_DB_PATH, SYNC_HASH_IGNORED_FIELDS
+
+
+class SyncHashStore:
+    """Local SQLite store of content hashes for synced station/device rows.
+
+    Sync jobs use it to upsert only new or changed rows and to report rows that disappeared upstream.
+    """
+
+    def __init__(self, path=SYNC_HASH_DB_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS row_hashes (
+                    kind TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    parent_key TEXT,
+                    content_hash TEXT NOT NULL,
+                    updated_at TEXT,
+                    PRIMARY KEY (kind, row_key)
+                )
+            """)
+
+    @staticmethod
+    def row_hash(row):
+        """Hashes a row's content, ignoring fields listed in SYNC_HASH_IGNORED_FIELDS."""
+        content = {key: value for key, value in row.items() if key not in SYNC_HASH_IGNORED_FIELDS}
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _known_hashes(self, kind):
+        with self._lock:
+            return dict(self._conn.execute("SELECT row_key, content_hash FROM row_hashes WHERE kind = ?", (kind,)).fetchall())
+
+    def diff(self, kind, rows, key_field):
+        """Splits rows into {'inserted': [...], 'updated': [...], 'unchanged': [...]} against the stored hashes."""
+        known = self._known_hashes(kind)
+        changes = {"inserted": [], "updated": [], "unchanged": []}
+        for row in rows:
+            previous = known.get(str(row.get(key_field)))
+            if previous is None:
+                changes["inserted"].append(row)
+            elif previous != self.row_hash(row):
+                changes["updated"].append(row)
+            else:
+                changes["unchanged"].append(row)
+        return changes
+
+    def record(self, kind, rows, key_field, parent_field=None):
+        """Stores the hashes of rows that were successfully written."""
+        now = datetime.now(timezone.utc).isoformat()
+        values = [(kind, str(row.get(key_field)), str(row.get(parent_field)) if parent_field else None, self.row_hash(row), now)
+                  for row in rows]
+        with self._lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO row_hashes (kind, row_key, parent_key, content_hash, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(kind, row_key) DO UPDATE SET
+                    parent_key = excluded.parent_key,
+                    content_hash = excluded.content_hash,
+                    updated_at = excluded.updated_at
+            """, values)
+
+    def pop_removed(self, kind, seen_keys, parent_keys=None):
+        """Returns (and forgets) known keys that were not seen in this sync.
+
+        With ``parent_keys`` only rows belonging to those parents are considered, so a partial
+        sync (e.g. one station's devices) does not report other stations' devices as removed.
+        """
+        seen = {str(key) for key in seen_keys}
+        with self._lock, self._conn:
+            if parent_keys is None:
+                known = self._conn.execute("SELECT row_key FROM row_hashes WHERE kind = ?", (kind,)).fetchall()
+            else:
+                parents = [str(parent) for parent in parent_keys]
+                known = []
+                for i in range(0, len(parents), 500): # Stay under SQLite's bound-parameter limit
+                    chunk = parents[i:i + 500]
+                    known.extend(self._conn.execute(
+                        f"SELECT row_key FROM row_hashes WHERE kind = ? AND parent_key IN ({','.join('?' * len(chunk))})",
+                        (kind, *chunk)).fetchall())
+            removed = [row_key for (row_key,) in known if row_key not in seen]
+            self._conn.executemany("DELETE FROM row_hashes WHERE kind = ? AND row_key = ?", [(kind, key) for key in removed])
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .config import TOKEN_CACHE_PATH, TOKEN_TTL_SECONDS, TOKEN_REFRESH_MARGIN_SECONDS
+
+
+class TokenManager:
+    """Owns the iSolarCloud auth token for every thread of the process.
+
+    The token is refreshed before its assumed expiry, concurrent refreshes collapse into a single
+    login (single-flight), and the token is cached on disk so consecutive cron runs skip the login.
+    ``login_func`` performs the actual login and returns the new token, or None on failure.
+    ``account_id`` identifies the account so a cached token is never reused for another one.
+    """
+
+    def __init__(self, login_func, account_id, path=TOKEN_CACHE_PATH, ttl_seconds=TOKEN_TTL_SECONDS,
+                 refresh_margin_seconds=TOKEN_REFRESH_MARGIN_SECONDS):
+        self.login_func = login_func
+        self.account_fingerprint = hashlib.sha256(account_id.encode("utf-8")).hexdigest()
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._refresh_lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0 # Wall-clock epoch seconds, so it stays meaningful across runs
+        self.login_count = 0
+        if path:
+            self._load()
+
+    @property
+    def token(self):
+        """The current token without refreshing it (None if there is none)."""
+        return self._token
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin_seconds
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get("account") != self.account_fingerprint:
+            return
+        self._token = cached.get("token")
+        self._expires_at = float(cached.get("expires_at", 0))
+        if self._is_fresh():
+            logging.info("Using cached iSolarCloud token; skipping login.")
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"account": self.account_fingerprint, "token": self._token, "expires_at": self._expires_at}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not cache the iSolarCloud token at {self.path}: {e}")
+
+    def get_token(self):
+        """Returns a token that is not about to expire, logging in first if needed. Returns None if login failed."""
+        if self._is_fresh():
+            return self._token
+        return self.refresh(self._token)
+
+    def refresh(self, stale_token=None):
+        """Replaces ``stale_token`` with a fresh one and returns it.
+
+        Callers that saw the same stale token wait on one login; if another caller has already
+        replaced it, its token is returned without logging in again.
+        """
+        with self._refresh_lock:
+            if self._token is not None and self._token != stale_token and self._is_fresh():
+                return self._token
+            token = self.login_func()
+            self.login_count += 1
+            if not token:
+                return None
+            self._token = token
+            self._expires_at = time.time() + self.ttl_seconds
+            if self.path:
+                self._save()
+            return token
+
+    async def get_token_async(self):
+        """Asyncio variant of get_token; the blocking login runs in the default executor."""
+        if self._is_fresh():
+            return self._token
+        return await asyncio.get_running_loop().run_in_executor(None, self.refresh, self._token)
@@ -0,0 +1,132 @@
+import logging
+from collections import namedtuple
+from datetime import datetime
+from operator import itemgetter
+
+import numpy as np
+
+# Columnar form of one getDevicePointMinuteDataList result_data payload: one entry per record in
+# ``device_ps_keys`` and ``timestamps`` (datetime64[s]), and a (records x point_names) float64 matrix
+# ``values`` with a same-shaped boolean ``missing`` mask.
+MinuteDataColumns = namedtuple("MinuteDataColumns", ["device_ps_keys", "timestamps", "point_names", "values", "missing"])
+
+_get_time_stamp = itemgetter("time_stamp")
+
+
+def _scan_result_data(result_data):
+    """Single pass over result_data collecting ps_keys, raw time_stamps and point-value tuples per record."""
+    seen_keys = {} # Insertion-ordered union of the keys of every record
+    for point_data_records in result_data.values():
+        if isinstance(point_data_records, list):
+            for point_data_item in point_data_records:
+                seen_keys.update(point_data_item) # Only the keys are used
+    point_names = [key for key in seen_keys if key.lower() != "time_stamp"] # Exclude the original time_stamp
+    get_points = itemgetter(*point_names) if len(point_names) > 1 else None
+
+    ps_keys = []
+    timestamp_strings = []
+    value_rows = []
+    for device_api_ps_key, point_data_records in result_data.items():
+        if not isinstance(point_data_records, list):
+            logging.warning(f"Expected a list of records for ps_key {device_api_ps_key}, got {type(point_data_records)}. Skipping.")
+            continue
+        for point_data_item in point_data_records:
+            timestamp_api_str = point_data_item.get("time_stamp")
+            if not timestamp_api_str or not device_api_ps_key:
+                logging.warning(f"Missing time_stamp or ps_key in record for {device_api_ps_key}: {point_data_item}")
+                continue
+            try:
+                values = get_points(point_data_item) if get_points else tuple(point_data_item.get(name) for name in point_names)
+            except KeyError:
+                # Records normally share one shape; tolerate the odd record missing a point
+                values = tuple(point_data_item.get(name) for name in point_names)
+            ps_keys.append(device_api_ps_key)
+            timestamp_strings.append(timestamp_api_str)
+            value_rows.append(values)
+    return ps_keys, timestamp_strings, point_names, value_rows
+
+
+def _parse_api_timestamps(timestamp_strings):
+    """Parses YYYYMMDDHHMMSS strings in bulk. Returns (datetime64[s] array, valid mask).
+
+    The API reports time_stamp in the station's local time (its ps_current_time_zone), and rows keep it
+    that way as naive timestamps; code comparing them with "now" uses solar.station_now. A payload only
+    holds a few hundred distinct slots, so each distinct value is parsed once.
+    """
+    unique_strings, inverse = np.unique(np.asarray(timestamp_strings, dtype="U14"), return_inverse=True)
+    parsed = np.empty(len(unique_strings), dtype="datetime64[s]")
+    for i, value in enumerate(unique_strings.tolist()):
+        try:
+            parsed[i] = np.datetime64(datetime.strptime(value, '%Y%m%d%H%M%S'), "s")
+        except ValueError:
+            parsed[i] = np.datetime64("NaT")
+    timestamps = parsed[inverse]
+    return timestamps, ~np.isnat(timestamps)
+
+
+def _value_matrix(value_rows, point_count):
+    """Returns the raw values as an object matrix plus a mask of missing (None or empty string) entries."""
+    matrix = np.empty((len(value_rows), point_count), dtype=object)
+    if value_rows:
+        matrix[:] = value_rows
+    missing = np.equal(matrix, None) | np.equal(matrix, "")
+    return matrix, missing
+
+
+def _log_invalid_timestamps(valid, timestamp_strings, ps_keys):
+    for index in np.flatnonzero(~valid):
+        logging.error(f"Error parsing time_stamp '{timestamp_strings[index]}' for ps_key {ps_keys[index]}. Skipping record.")
+
+
+def columnar_from_result_data(result_data):
+    """Converts a result_data payload ({ps_key: [records]}) into MinuteDataColumns with float64 values."""
+    ps_keys, timestamp_strings, point_names, value_rows = _scan_result_data(result_data)
+    if not value_rows:
+        return MinuteDataColumns(np.array([], dtype=object), np.array([], dtype="datetime64[s]"), point_names,
+                                 np.empty((0, len(point_names))), np.empty((0, len(point_names)), dtype=bool))
+
+    timestamps, valid = _parse_api_timestamps(timestamp_strings)
+    if not valid.all():
+        _log_invalid_timestamps(valid, timestamp_strings, ps_keys)
+
+    matrix, missing = _value_matrix(value_rows, len(point_names))
+    matrix[missing] = np.nan
+    try:
+        values = matrix.astype(np.float64)
+    except (TypeError, ValueError):
+        # Some value is not numeric: convert one by one and treat the offenders as missing
+        values = np.empty(matrix.shape, dtype=np.float64)
+        for index, value in np.ndenumerate(matrix):
+            try:
+                values[index] = float(value)
+            except (TypeError, ValueError):
+                values[index] = np.nan
+    missing |= np.isnan(values)
+
+    return MinuteDataColumns(np.array(ps_keys, dtype=object)[valid], timestamps[valid], point_names, values[valid], missing[valid])
+
+
+def rows_from_result_data(result_data):
+    """Converts a result_data payload straight into Supabase upsert rows.
+
+    Values are passed through as returned by the API (PostgREST casts them to the column types) with
+    missing values normalised to None, which avoids a float round trip on the write path.
+    """
+    ps_keys, timestamp_strings, point_names, value_rows = _scan_result_data(result_data)
+    if not value_rows:
+        return []
+
+    timestamps, valid = _parse_api_timestamps(timestamp_strings)
+    # Station-local timestamps are stored as naive ISO strings (see _parse_api_timestamps)
+    iso_timestamps = np.datetime_as_string(timestamps, unit="s").tolist()
+
+    matrix, missing = _value_matrix(value_rows, len(point_names))
+    matrix[missing] = None
+    keys = ["device_ps_key", "timestamp"] + point_names
+    if valid.all():
+        return [dict(zip(keys, (ps_key, timestamp, *values)))
+                for ps_key, timestamp, values in zip(ps_keys, iso_timestamps, matrix.tolist())]
+
+    _log_invalid_timestamps(valid, timestamp_strings, ps_keys)
+    return [dict(zip(keys, (ps_key, timestamp, *values)))
+            for ps_key, timestamp, values, is_valid in zip(ps_keys, iso_timestamps, matrix.tolist(), valid.tolist()) if is_valid]